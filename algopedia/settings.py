@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'users.User'
 
 MIDDLEWARE = [
+    # リクエストごとのクエリ数や処理時間の記録 (他のミドルウェアの時間も含めるために先頭に置く)
+    'cms.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,7 +60,8 @@ ROOT_URLCONF = 'algopedia.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # 描画時間を記録する (cms.metrics)
+        'BACKEND': 'cms.backends.templates.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -81,12 +84,74 @@ WSGI_APPLICATION = 'algopedia.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# 環境変数 ALGOPEDIA_DB_PROFILE で選ぶ (省略すると development)
+DATABASE_PROFILES = {
+    'development': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': str(os.path.join(BASE_DIR, "db.sqlite3")),
         'ATOMIC_REQUESTS': True,
-    }
+    },
+    # 本番用: WAL で読み込みが書き込みを待たないようにし, 接続をリクエストをまたいで使い回す
+    'production': {
+        'ENGINE': 'cms.backends.sqlite3',
+        'NAME': str(os.path.join(BASE_DIR, "db.sqlite3")),
+        'ATOMIC_REQUESTS': True,
+        # 接続を使い回す秒数
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            # 他の接続が書き込み中のときに待つ秒数 (busy timeout)
+            'timeout': 20,
+            # 書き込むトランザクションは始めた時点でロックを取る (cms.backends.sqlite3)
+            'transaction_mode': 'IMMEDIATE',
+            # 接続のたびに設定する PRAGMA
+            # WAL, WAL での同期は checkpoint 時のみ, ページキャッシュ 64 MiB, mmap 256 MiB, 一時テーブルはメモリ上
+            'init_command': ';'.join([
+                'PRAGMA journal_mode=WAL',
+                'PRAGMA synchronous=NORMAL',
+                'PRAGMA cache_size=-65536',
+                'PRAGMA mmap_size=268435456',
+                'PRAGMA temp_store=MEMORY',
+            ]),
+        },
+    },
+}
+
+DATABASES = {
+    'default': dict(DATABASE_PROFILES[os.environ.get('ALGOPEDIA_DB_PROFILE', 'development')]),
+}
+
+# Cache
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # 記事ページの描画結果 (cms.pagecache)
+    'article_pages': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'article_pages',
+        # 記事の更新時に破棄するので期限は設けない
+        'TIMEOUT': None,
+        'OPTIONS': {
+            # 保持する記事数の上限
+            'MAX_ENTRIES': 1000,
+            # 上限に達したら最も長く参照されていないものを 1 件ずつ追い出す (MAX_ENTRIES と同じ値にする)
+            'CULL_FREQUENCY': 1000,
+        },
+    },
+    # 記事検索の結果 (cms.searchcache)
+    'search_results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'search_results',
+        # 内容のバージョンが変わると使われなくなるので期限は設けない
+        'TIMEOUT': None,
+        'OPTIONS': {
+            # 保持する検索結果 (1 ページ分) の数の上限
+            'MAX_ENTRIES': 1000,
+            # 上限に達したら最も長く参照されていないものを 1 件ずつ追い出す (MAX_ENTRIES と同じ値にする)
+            'CULL_FREQUENCY': 1000,
+        },
+    },
 }
 
 # Password validation
@@ -137,12 +202,75 @@ LOGGING = {
         },
     },
     'loggers': {
-        'django.db.backends': {
+        # 遅いクエリ (cms.metrics). 既定では表示しない (テストや開発中の出力が埋もれないように)
+        # ALGOPEDIA_METRICS_LOG_LEVEL=INFO で, 遅いクエリをターミナルに表示する
+        'cms.metrics': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': os.environ.get('ALGOPEDIA_METRICS_LOG_LEVEL', 'WARNING'),
         },
     },
 }
 
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
+
+# お気に入り数の増減をメモリ上にためて, まとめて DB に反映する (cms.buffers.FavNumBuffer)
+# 無効の場合はお気に入りの登録 / 解除のたびに UPDATE で反映する
+FAV_NUM_BUFFER = {
+    'ENABLED': False,
+    # 反映する間隔 (秒)
+    'FLUSH_INTERVAL': 1.0,
+    # この件数の記事がたまったら間隔を待たずに反映する
+    'MAX_PENDING': 1000,
+    # 反映にこの回数失敗した書き込みは捨てる
+    'MAX_RETRIES': 3,
+    # リクエストが来なくても, 裏のスレッドで FLUSH_INTERVAL 秒ごとに反映する
+    'FLUSH_IN_BACKGROUND': True,
+}
+
+# 記事の閲覧履歴をメモリ上にためて, まとめて DB に反映する (cms.buffers.ReadingHistoryBuffer)
+# 同じユーザーが同じ記事を何度閲覧しても 1 件にまとめられる
+# プロセスが異常終了した場合に失われるのは, 前回の反映以降の履歴 (おおよそ MAX_PENDING 件以内) だけ
+READING_HISTORY_BUFFER = {
+    'ENABLED': True,
+    'FLUSH_INTERVAL': 5.0,
+    'MAX_PENDING': 1000,
+    'MAX_RETRIES': 3,
+    'FLUSH_IN_BACKGROUND': True,
+}
+
+# 入力補完の索引 (cms.autocomplete)
+AUTOCOMPLETE = {
+    # 他のプロセスでの書き込みを反映するために索引を作り直す間隔 (秒)
+    'MAX_AGE': 60.0,
+}
+
+# リクエストごとのクエリ数・DB の時間・テンプレートの描画時間・処理時間の集計 (cms.metrics)
+# スタッフは /metrics/ で Prometheus のテキスト形式で見られる
+METRICS = {
+    'ENABLED': True,
+    # ビューごとに覚えておく (ログに出す) 遅いクエリの件数
+    'SLOW_QUERIES': 5,
+    # これより速いクエリ (秒) は遅いクエリとして扱わない
+    'SLOW_QUERY_MIN_DURATION': 0.01,
+}
+
+# 非同期のビュー (Ajax) から DB を使う処理を実行するスレッドプール (cms.asyncdb)
+ASYNC_VIEWS = {
+    # スレッド数 (= DB の接続数) の上限. 0 なら Django の既定どおり sync_to_async (thread_sensitive) で実行する
+    'MAX_WORKERS': 8,
+}
+
+# 記事検索の結果のキャッシュ (cms.searchcache). 大きさの上限は CACHES の 'search_results'
+# ヒット数・ミス数は /metrics/ で見られる
+SEARCH_CACHE = {
+    'ENABLED': True,
+}
+
+# 記事検索の分野・タグの条件をメモリ上のビットマップで求める索引 (cms.tagindex)
+# プロセスごとに全ての記事のタグ付けを持つ (記事 50 万件で数 MB 程度)
+TAG_INDEX = {
+    'ENABLED': False,
+    # 他のプロセスでの書き込みを反映するために作り直す間隔 (秒)
+    'MAX_AGE': 300.0,
+}
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'algopedia.settings')
 
 application = get_wsgi_application()
+
+# 記事検索の分野・タグの索引を裏で作っておく (settings.TAG_INDEX が有効な場合)
+from cms import tagindex
+
+tagindex.warm()
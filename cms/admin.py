@@ -1,4 +1,5 @@
 from django.contrib import admin
+from cms import bulk
 from cms.models import *
 
 # Register your models here.
@@ -8,6 +9,10 @@ class ArticleAdmin(admin.ModelAdmin):
     list_display = ('article_id', 'title', 'fav_num', 'created_at', 'updated_at')
     list_display_links = ('title',)
 
+    # 一括削除 (delete_selected) でも分野・タグの記事数と執筆者の統計を減らす
+    def delete_queryset(self, request, queryset):
+        bulk.delete_articles(queryset.values_list('pk', flat=True))
+
 
 class FavoriteAdmin(admin.ModelAdmin):
     list_display = ('user', 'article')
@@ -37,6 +42,10 @@ class TagAdmin(admin.ModelAdmin):
     list_display = ('tag', 'article_num')
 
 
+class UserStatsAdmin(admin.ModelAdmin):
+    list_display = ('user', 'article_num', 'liked_num')
+
+
 admin.site.register(Article, ArticleAdmin)
 admin.site.register(Favorite, FavoriteAdmin)
 admin.site.register(Author, AuthorAdmin)
@@ -45,3 +54,4 @@ admin.site.register(Category, CategoryAdmin)
 admin.site.register(Tag, TagAdmin)
 admin.site.register(ArticleCategory, ArticleCategoryAdmin)
 admin.site.register(ArticleTags, ArticleTagsAdmin)
+admin.site.register(UserStats, UserStatsAdmin)
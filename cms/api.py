@@ -0,0 +1,63 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import JsonResponse
+from django.utils import timezone
+
+# 記事一覧の JSON API (search_api, user_page_api). URL にバージョンを含める (/api/v1/...)
+# 行は列名を繰り返さないように COLUMNS の順の配列にする. 表の描画はクライアント (cms/js/article_list.js.html) が行う
+# 例: {"version": 1, "columns": [...], "rows": [[1, "DFS", [2, "alice"], "グラフ", ["探索"], 3, "2020-11-24T23:16:03+09:00"]],
+#      "page": {"number": 1, "has_next": true, ...}, "search_or_order": "-fav_num", "facets": null}
+# facets は分野・タグごとの記事数 (search_api で facets を指定した場合. ArticleSearch.facets を参照)
+
+VERSION = 1
+
+# 行の列. author は [ユーザー ID, ユーザー名] (執筆者がまだいなければ null), category は分野名 (なければ null), tags はタグ名の配列, updated_at は TIME_ZONE の時刻 (ISO 8601)
+COLUMNS = ('id', 'title', 'author', 'category', 'tags', 'fav_num', 'updated_at')
+
+
+# 記事の執筆者・分野 (まだなければ None)
+def _related(article, name):
+    try:
+        return getattr(article, name)
+    except ObjectDoesNotExist:
+        return None
+
+
+# 記事 (Article.objects.for_rows() で取得したもの) を 1 行にする
+def row(article):
+    author = _related(article, 'author')
+    category = _related(article, 'articlecategory')
+    return (
+        article.article_id,
+        article.title,
+        (author.user_id, author.user.username) if author else None,
+        category.category_id if category else None,
+        [tag.tag_id for tag in article.articletags_set.all()],
+        article.fav_num,
+        timezone.localtime(article.updated_at).isoformat(timespec='seconds'),
+    )
+
+
+# 1 ページ分 (cms.paging.KeysetPage) の dict
+def payload(page_obj, search_or_order=None, facets=None):
+    return dict(
+        version=VERSION,
+        columns=COLUMNS,
+        rows=[row(article) for article in page_obj.object_list],
+        page=dict(
+            number=page_obj.number,
+            has_next=page_obj.has_next,
+            has_previous=page_obj.has_previous,
+            next_cursor=page_obj.next_cursor,
+            previous_cursor=page_obj.previous_cursor,
+            count=page_obj.count,
+            count_capped=page_obj.count_capped,
+        ),
+        search_or_order=search_or_order,
+        facets=facets,
+    )
+
+
+def response(page_obj, search_or_order=None, facets=None):
+    # 日本語はエスケープせず, 区切りの空白も省く
+    return JsonResponse(payload(page_obj, search_or_order, facets),
+                        json_dumps_params=dict(ensure_ascii=False, separators=(',', ':')))
@@ -1,5 +1,31 @@
 from django.apps import AppConfig
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 
 class CmsConfig(AppConfig):
     name = 'cms'
+
+    def ready(self):
+        from cms.buffers import flush_buffers_if_due
+        # 反映してから接続を閉じるように, close_old_connections をつなぎ直して後に回す
+        # (後だと, 閉じた接続を反映のために開き直し, 次のリクエストまで開いたままになる)
+        request_finished.disconnect(close_old_connections)
+        request_finished.connect(flush_buffers_if_due, dispatch_uid='cms.buffers.flush_buffers_if_due')
+        request_finished.connect(close_old_connections)
+
+        from cms.metrics import install_query_recorder
+        connection_created.connect(install_query_recorder, dispatch_uid='cms.metrics.install_query_recorder')
+
+        # 入力補完の索引に関係するモデルだけに接続する
+        # (受け手のあるモデルでは QuerySet.delete() が対象を SELECT してから削除するようになるため)
+        from cms.autocomplete import update_for_deleted, update_for_saved
+        from cms.models import Article, Author, Category, Tag
+        from users.models import User
+        for model in (Article, Author, Category, Tag, User):
+            post_save.connect(update_for_saved, sender=model,
+                              dispatch_uid=f'cms.autocomplete.update_for_saved.{model.__name__}')
+            post_delete.connect(update_for_deleted, sender=model,
+                                dispatch_uid=f'cms.autocomplete.update_for_deleted.{model.__name__}')
@@ -0,0 +1,273 @@
+import copy
+
+from django.db import connection
+from django.db.models import Exists, OuterRef
+
+from cms import conditional, fulltext, tagindex
+from cms.models import Article, ArticleCategory, ArticleTags, Author, Category, Favorite, ReadingHistory, Tag
+
+# 記事検索の条件から記事の QuerySet を組み立てる
+# 絞り込みは条件ごとに記事 ID の部分問い合わせ (準結合) にし, JOIN + DISTINCT は使わない
+# (タグやお気に入りと JOIN すると 1 記事が複数行になり, SQLite は結合した全件を重複除去・並び替えしてから LIMIT を適用する)
+# 部分問い合わせの形は, 条件に当てはまる記事の数の見積もりで選ぶ
+#   多い: EXISTS. 並び替えの索引の順に記事を走査し, 1 ページ分見つかった時点で止まる
+#   少ない: IN. 当てはまる記事だけを取得して並び替える
+# メモリ上の索引 (cms.tagindex) を使う場合は, 分野・タグの条件をビットマップの演算で求め,
+# 当てはまる記事が ID_LIST_MAX 件以下ならその ID だけを DB に渡す
+
+# 並び替えに使える列. 利用者の指定 (search_or_order) はこれ以外を受け付けない
+ORDER_FIELDS = ('title', 'fav_num', 'updated_at', 'author__user__username', 'articlecategory__category')
+
+# 記事の表の索引の順に走査できる並び替え (他の表の列での並び替えは, EXISTS にしても途中で止まらない)
+STREAMING_FIELDS = ('title', 'fav_num', 'updated_at')
+
+# タグの指定の仕方: いずれかを持つ記事 / 全てを持つ記事
+TAG_ANY = 'any'
+TAG_ALL = 'all'
+
+# ログイン中のユーザーによる絞り込み (チェックボックスの値と, 記事とユーザーを結ぶモデル)
+CHECK_MODELS = {
+    'author': Author,
+    'fav': Favorite,
+    'read': ReadingHistory,
+}
+
+# 索引で求めた記事 ID をそのまま DB に渡す件数の上限
+# これより多いと準結合の方が速い (SQLite の古い版の変数の数の上限 999 よりも少なくしておく)
+ID_LIST_MAX = 900
+
+# ユーザーごとの記事 (執筆・お気に入り・閲覧) はこの件数までしか数えない (これ以上なら, 条件が 1 つでも記事が 900 万件程度までは EXISTS を選ぶ)
+ESTIMATE_CAP = 10000
+
+# 分野・タグごとの記事数 (ファセット) はこの件数までの記事で数える (これより多ければ, 数は「以上」として扱う)
+FACET_CAP = 5000
+# 分野・タグごとの記事数は多い順にこの数まで返す
+FACET_LIMIT = 20
+
+
+# 並び替えの指定を検証する. 不正な指定ならば default を使う
+def get_ordering(search_or_order, default):
+    if not search_or_order:
+        return default
+    # '-' は 1 つだけ許す ('--title' などは不正)
+    field = search_or_order[1:] if search_or_order.startswith('-') else search_or_order
+    return search_or_order if field in ORDER_FIELDS else default
+
+
+class ArticleSearch:
+
+    def __init__(self, username=None, title=None, category=None, tags=(), tag_mode=TAG_ANY, exclude_tags=(),
+                 checks=(), user=None, search_or_order=None, per_page=10, version=None):
+        self.username = username or None
+        self.title = title or ''
+        self.category = category or None
+        self.tags = tuple(sorted(set(tags)))
+        self.tag_mode = TAG_ALL if tag_mode == TAG_ALL else TAG_ANY
+        self.exclude_tags = tuple(sorted(set(exclude_tags)))
+        # 未ログインならログイン中のユーザーによる絞り込みはしない
+        self.user = user if user is not None and user.is_authenticated else None
+        self.checks = tuple(sorted(set(checks) & set(CHECK_MODELS))) if self.user else ()
+        self.per_page = per_page
+        # 例えば, "fav_num" ならお気に入り数の昇順, "-fav_num" なら降順
+        # 指定がなければ, キーワード検索では関連度順, それ以外ではお気に入り数の降順
+        self.ordering = get_ordering(search_or_order, default=None) or ('search_rank' if self.title else '-fav_num')
+        # 検索の時点の内容のバージョン (メモリ上の索引が古くないかを確かめる. None なら索引を引くときに読む)
+        self.version = version
+        # estimate の結果 (ページと分野・タグごとの記事数で同じものを使う)
+        self._estimate = None
+
+    # 検索フォーム (search_ajax, search_api の GET パラメータ) から
+    @staticmethod
+    def from_request(request, per_page=10):
+        return ArticleSearch(
+            username=request.GET.get("username"),
+            title=request.GET.get("title"),
+            category=request.GET.get("category"),
+            tags=request.GET.getlist("selected_tags"),
+            tag_mode=request.GET.get("tag_mode"),
+            exclude_tags=request.GET.getlist("excluded_tags"),
+            checks=request.GET.getlist("check"),
+            user=request.user,
+            search_or_order=request.GET.get("search_or_order"),
+            per_page=per_page,
+            # 検索結果のキャッシュや ETag と同じバージョン
+            version=conditional.content_version(request).version if tagindex.enabled() else None,
+        )
+
+    # 絞り込みの条件ごとの (当てはまる記事と結ぶ行の QuerySet, 当てはまる記事の数を求める SQL と引数)
+    # QuerySet はどれも (条件の列, article) の索引で引ける
+    # 記事の数は, タグと分野は保存しておいた記事数 (article_num) を使い, ユーザーごとの記事は ESTIMATE_CAP 件まで数える
+    # indexed が False なら, 分野・タグ (索引で求める条件) は除く
+    def semi_joins(self, indexed=True):
+        joins = []
+        if self.username:
+            # 指定したユーザーが執筆した記事
+            join = Author.objects.filter(user__username=self.username)
+            joins.append((join, self._count(join)))
+        if self.category and indexed:
+            # 指定したカテゴリを持つ記事
+            joins.append((ArticleCategory.objects.filter(category=self.category),
+                          self._article_num(Category.objects.filter(pk=self.category))))
+        if self.tags and self.tag_mode == TAG_ALL and indexed:
+            # 指定した全てのタグを持つ記事
+            for tag in self.tags:
+                joins.append((ArticleTags.objects.filter(tag=tag), self._article_num(Tag.objects.filter(pk=tag))))
+        elif self.tags and indexed:
+            # 指定したいずれかのタグを持つ記事 (記事の数は各タグの記事数の和で見積もる)
+            joins.append((ArticleTags.objects.filter(tag__in=self.tags),
+                          self._article_num(Tag.objects.filter(pk__in=self.tags))))
+        for check in self.checks:
+            # 書いた記事, お気に入りした記事, 閲覧した記事
+            join = CHECK_MODELS[check].objects.filter(user=self.user)
+            joins.append((join, self._count(join)))
+        return [(join.order_by(), estimate) for join, estimate in joins]
+
+    @staticmethod
+    def _article_num(queryset):
+        sql, params = queryset.order_by().values_list('article_num').query.sql_with_params()
+        return f'SELECT COALESCE(SUM(article_num), 0) FROM ({sql})', params
+
+    @staticmethod
+    def _count(join):
+        sql, params = join.order_by().values('article').query.sql_with_params()
+        return f'SELECT COUNT(*) FROM ({sql} LIMIT {ESTIMATE_CAP})', params
+
+    # 各条件を EXISTS にするかどうか
+    # 全 N 件のうち条件 i に当てはまる記事が c_i 件なら (条件どうしは独立と見なす),
+    #   全て EXISTS: 並び替えの索引の順に, 1 ページ (L 件) を見つけるまでに約 L / Π(c_i / N) 件を走査する
+    #   最も少ない条件だけ IN: その min(c_i) 件を取得し, 残りの条件を EXISTS で確かめてから並び替える
+    # の小さい方を選ぶ. 索引の順に走査できない並び替えでは後者にする
+    def plan(self, joins):
+        if not joins:
+            return []
+        streaming = self.ordering.lstrip('-') in STREAMING_FIELDS
+        if self.ordering == 'search_rank':
+            # 全文検索で当てはまった記事から引く
+            return [True] * len(joins)
+        if len(joins) <= 1 and not streaming:
+            return [False] * len(joins)
+        if self._estimate is None:
+            self._estimate = self.estimate(joins)
+        total, counts = self._estimate
+        scan = self.per_page + 1
+        for count in counts:
+            scan = scan * total / count if count else float('inf')
+        if streaming and scan <= min(counts):
+            return [True] * len(joins)
+        driver = counts.index(min(counts))
+        return [i != driver for i in range(len(joins))]
+
+    # (記事の数, 各条件に当てはまる記事の数) の見積もりを 1 回のクエリで求める
+    # 記事の数は ID の最大値で代える (COUNT(*) は全件を数えるため)
+    @staticmethod
+    def estimate(joins):
+        meta = Article._meta
+        columns, params = [f'(SELECT MAX({meta.pk.column}) FROM {meta.db_table})'], []
+        for _, (sql, estimate_params) in joins:
+            columns.append(f'({sql})')
+            params.extend(estimate_params)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT ' + ', '.join(columns), params)
+            row = cursor.fetchone()
+        return row[0] or 0, list(row[1:])
+
+    # 分野・タグの条件に当てはまる記事 ID の集合をメモリ上の索引で求める
+    # 索引を使わない場合や, 索引に他のプロセスでの書き込みがまだ反映されていない場合は None
+    def indexed_ids(self):
+        if not tagindex.enabled() or not (self.category or self.tags):
+            return None
+        return tagindex.lookup(self.category, self.tags, self.tag_mode == TAG_ALL, self.exclude_tags, self.version)
+
+    # 記事の QuerySet (post_list) を絞り込み, 関連度順ならその値を付ける
+    def filter(self, post_list):
+        if self.title:
+            # 指定した文字列をタイトルか本文に含む記事 (全文検索)
+            post_list = fulltext.search(post_list, self.title)
+        ids = self.indexed_ids()
+        if ids is not None and len(ids) <= ID_LIST_MAX:
+            # 索引で求めた記事から引き, 残りの条件は EXISTS で確かめる
+            post_list = post_list.filter(pk__in=list(ids))
+            for join, _ in self.semi_joins(indexed=False):
+                post_list = post_list.filter(Exists(join.filter(article=OuterRef('pk'))))
+        else:
+            joins = self.semi_joins()
+            for (join, _), exists in zip(joins, self.plan(joins)):
+                if exists:
+                    post_list = post_list.filter(Exists(join.filter(article=OuterRef('pk'))))
+                else:
+                    post_list = post_list.filter(pk__in=join.values('article'))
+            if self.exclude_tags:
+                # 指定したタグをどれも持たない記事
+                post_list = post_list.filter(
+                    ~Exists(ArticleTags.objects.filter(article=OuterRef('pk'), tag__in=self.exclude_tags)))
+        if self.ordering == 'search_rank':
+            post_list = fulltext.rank(post_list, self.title)
+        return post_list
+
+    # 絞り込みの条件があるか (並び替えは含めない)
+    def has_conditions(self):
+        return bool(self.username or self.title or self.category or self.tags or self.exclude_tags or self.checks)
+
+    # 絞り込んだ結果の, 分野・タグごとの記事数 (ファセット)
+    # {'categories': [[分野, 記事数], ...], 'tags': [[タグ, 記事数], ...], 'capped': bool} (記事数の多い順に FACET_LIMIT 件まで)
+    # 当てはまる記事を FACET_CAP 件まで取り出し, 分野とタグの表をそれぞれ GROUP BY して 1 回のクエリで数える
+    # 当てはまる記事が FACET_CAP 件より多ければ capped を True にする (数は取り出した記事の中での数なので, それ以上)
+    # 条件がなければ保存しておいた記事数 (article_num) を使う
+    def facets(self):
+        if not self.has_conditions():
+            return dict(categories=self._top_article_num(Category), tags=self._top_article_num(Tag), capped=False)
+        # 1 ページ分ではなく全件 (FACET_CAP 件まで) を取り出すものとして, EXISTS と IN を選び直す
+        search = copy.copy(self)
+        search.per_page = FACET_CAP
+        hits = search.filter(Article.objects.order_by()).order_by().values('pk')[:FACET_CAP + 1]
+        sql, params = hits.query.sql_with_params()
+        groups = []
+        for model, field in ((ArticleCategory, 'category'), (ArticleTags, 'tag')):
+            meta = model._meta
+            column, article = meta.get_field(field).column, meta.get_field('article').column
+            groups.append(f'SELECT {column}, COUNT(*) FROM {meta.db_table} '
+                          f'WHERE {article} IN (SELECT id FROM hits) GROUP BY {column}')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'WITH hits(id) AS ({sql}) '
+                f'SELECT 0, NULL, COUNT(*) FROM hits '
+                f'UNION ALL SELECT 1, * FROM ({groups[0]}) '
+                f'UNION ALL SELECT 2, * FROM ({groups[1]})', params)
+            rows = cursor.fetchall()
+        counts = {1: [], 2: []}
+        capped = False
+        for kind, name, count in rows:
+            if kind == 0:
+                capped = count > FACET_CAP
+            else:
+                counts[kind].append([name, min(count, FACET_CAP)])
+        return dict(categories=self._top(counts[1]), tags=self._top(counts[2]), capped=capped)
+
+    # 記事数の多い順 (同じなら名前順) に FACET_LIMIT 件
+    @staticmethod
+    def _top(counts):
+        return sorted(counts, key=lambda item: (-item[1], item[0]))[:FACET_LIMIT]
+
+    @staticmethod
+    def _top_article_num(model):
+        name = model._meta.pk.name
+        return [list(row) for row in model.objects.filter(article_num__gt=0)
+                .order_by('-article_num', name).values_list(name, 'article_num')[:FACET_LIMIT]]
+
+    # 検索結果のキャッシュ (cms.searchcache) に使う, 正規化した検索条件
+    # 同じ結果になる条件は同じ値にする (タグは順序と重複を無視, 並び替えは既定のものも明示)
+    # ログイン中のユーザーによって結果が変わる検索 (check) はキャッシュしないので None
+    def cache_params(self):
+        if self.checks:
+            return None
+        return (
+            self.username,
+            # 全文検索では MATCH 式が同じなら結果も同じ
+            fulltext.match_expression(self.title) if fulltext.available() else self.title,
+            self.category,
+            self.tags,
+            # タグが 1 つ以下ならどちらの指定でも同じ
+            self.tag_mode if len(self.tags) > 1 else TAG_ANY,
+            self.exclude_tags,
+            self.ordering,
+        )
@@ -0,0 +1,127 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, close_old_connections, connections
+
+from cms import metrics
+
+# 非同期のビューから, DB を使う処理 (同期の関数) をスレッド数に上限のあるプールで実行する
+# ASGI で動かす場合, DB を待つ間もイベントループのスレッドを塞がないので, 1 プロセスで多くのリクエストを同時に受けられる
+# プールのスレッドはそれぞれ DB の接続を持ち, 処理をまたいで使い回す
+# (Django がリクエストの前後で行うのと同じく, 古くなった接続や壊れた接続は処理の前後で閉じる)
+# ASYNC_VIEWS['MAX_WORKERS'] が 0 の場合は, Django の既定どおり sync_to_async (thread_sensitive) で実行する
+#
+# supersede に同じキーを指定した処理が後から始まると, 先の処理は中断して Superseded を送出する
+# 順番待ちのものは実行せずに取り除き, 実行中のものはクエリを中断する
+# (SQLite の接続は他のスレッドから interrupt() で実行中のクエリを止められる. それ以外でも次のクエリの前に止まる)
+
+
+class Superseded(Exception):
+    pass
+
+
+def _setting(key, default):
+    return getattr(settings, 'ASYNC_VIEWS', {}).get(key, default)
+
+
+# 1 回分の処理. 中断の要求と, 実行中のスレッドの DB 接続を持つ
+class Job:
+    def __init__(self):
+        self.superseded = False
+        self.future = None
+        self.connection = None
+
+    # connection.execute_wrapper に渡して, 中断を要求されていればクエリを実行しない
+    def check(self, execute, sql, params, many, context):
+        if self.superseded:
+            raise Superseded()
+        return execute(sql, params, many, context)
+
+    def supersede(self):
+        with _lock:
+            self.superseded = True
+            if self.future is not None:
+                # 順番待ちなら取り除く (実行中なら何もしない)
+                self.future.cancel()
+            raw = self.connection.connection if self.connection is not None else None
+            if raw is not None and hasattr(raw, 'interrupt'):
+                raw.interrupt()
+
+
+_lock = threading.Lock()
+_executor = None
+# キー -> 実行中 (または順番待ち) の Job
+_jobs = {}
+
+
+def _get_executor(max_workers):
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='asyncdb')
+        return _executor
+
+
+# プールを止める (実行中の処理は終わるのを待つ). 次に run が呼ばれたら作り直す
+def shutdown():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _call(job, request_metrics, manage_connections, func, args, kwargs):
+    if manage_connections:
+        close_old_connections()
+    with _lock:
+        if job.superseded:
+            raise Superseded()
+        # (connection は参照したスレッドの接続になるので, 他のスレッドから中断できるように実体を覚える)
+        job.connection = connections[DEFAULT_DB_ALIAS]
+    try:
+        with metrics.recording(request_metrics), job.connection.execute_wrapper(job.check):
+            return func(*args, **kwargs)
+    except OperationalError:
+        # interrupt() で止めたクエリ
+        if job.superseded:
+            raise Superseded()
+        raise
+    finally:
+        with _lock:
+            job.connection = None
+        if manage_connections:
+            close_old_connections()
+
+
+# func(*args, **kwargs) を実行して結果を返す. supersede はキャンセルのためのキー (None なら中断しない)
+async def run(func, *args, supersede=None, **kwargs):
+    job = Job()
+    if supersede is not None:
+        with _lock:
+            previous = _jobs.get(supersede)
+            _jobs[supersede] = job
+        if previous is not None:
+            previous.supersede()
+    max_workers = _setting('MAX_WORKERS', 8)
+    call = functools.partial(_call, job, metrics.current(), bool(max_workers), func, args, kwargs)
+    try:
+        if not max_workers:
+            return await sync_to_async(call, thread_sensitive=True)()
+        future = _get_executor(max_workers).submit(call)
+        with _lock:
+            job.future = future
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        if job.superseded:
+            raise Superseded() from None
+        raise
+    finally:
+        if supersede is not None:
+            with _lock:
+                if _jobs.get(supersede) is job:
+                    del _jobs[supersede]
@@ -0,0 +1,327 @@
+import bisect
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+# 入力補完 (タグ・分野・記事タイトル・ユーザー名の前方一致検索)
+# 名前を小文字にしたキーで整列したリストをメモリ上に持ち, 二分探索で前方一致する範囲を求める
+# このプロセスでの書き込みは, コミット時に (シグナルや cms.bulk から) 該当する候補だけを挿入・削除・更新する
+# 他のプロセスでの書き込みは MAX_AGE 秒ごとの作り直し (裏のスレッドで行い, その間は古い索引を使う) で反映される
+
+# 1 回に返す候補の数の上限
+MAX_LIMIT = 20
+
+# 候補に添えるスコアの説明
+LABELS = {
+    'tag': '記事数',
+    'category': '記事数',
+    'title': '★',
+    'user': '記事数',
+}
+
+# 範囲の広い (短い) 接頭辞の結果を覚えておく数の上限
+MAX_CACHED_PREFIXES = 10000
+
+# まとめて追加する候補がこれ以上なら, 1 件ずつ挿入せずに整列し直す
+BULK_MIN = 1000
+
+
+def _setting(key, default):
+    return getattr(settings, 'AUTOCOMPLETE', {}).get(key, default)
+
+
+def normalize(text):
+    return text.strip().lower()
+
+
+# 1 種類 (タグなど) の前方一致の索引
+# 候補は (キー, -スコア, 名前, その他の情報) の組で, キーの順に並べる
+class PrefixIndex:
+    # loader は (名前, スコア, その他の情報の dict) を返す関数
+    # id_field は候補を識別するその他の情報の項目 (None なら名前で識別する)
+    def __init__(self, loader, id_field=None):
+        self.loader = loader
+        self.id_field = id_field
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._entries = None
+        self._keys = None
+        # 識別子から候補へ
+        self._ids = None
+        self._built_at = None
+        self._rebuilding = False
+        # 接頭辞から {件数: 結果} へ
+        self._cache = {}
+        # 作り直しの間に反映した挿入・削除 (作り直した索引にも反映する)
+        self._pending = None
+
+    def _identity(self, name, extra):
+        return extra[self.id_field] if self.id_field else name
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = self._keys = self._ids = self._built_at = None
+            self._cache = {}
+
+    # DB から作り直す
+    def build(self):
+        with self._build_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                entries = sorted(
+                    ((normalize(name), -score, name, extra) for name, score, extra in self.loader() if name),
+                    key=lambda entry: entry[:3])
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            # 読み込みの後に反映された差分を取りこぼさないよう, 差し替えと同じロックの中で受け取る
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._entries, self._keys, self._cache = entries, [entry[0] for entry in entries], {}
+                self._ids = {self._identity(entry[2], entry[3]): entry for entry in entries}
+                # 記事数などの増減は, 読み込んだ値に含まれているかが分からないので反映しない (次の作り直しで正しくなる)
+                for method, args in pending:
+                    getattr(self, method)(*args)
+                self._built_at = time.monotonic()
+
+    def _rebuild_in_background(self):
+        def rebuild():
+            from django.db import connection
+
+            try:
+                self.build()
+            finally:
+                self._rebuilding = False
+                connection.close()
+
+        self._rebuilding = True
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def _ensure_built(self):
+        if self._entries is None:
+            self.build()
+        elif not self._rebuilding and time.monotonic() - self._built_at >= _setting('MAX_AGE', 60.0):
+            self._rebuild_in_background()
+
+    # 以下の _insert, _remove, _put, _put_many, _delete, _add_scores は self._lock を取ってから呼ぶ
+
+    def _insert(self, entry):
+        i = self._position(entry)
+        self._entries.insert(i, entry)
+        self._keys.insert(i, entry[0])
+        self._ids[self._identity(entry[2], entry[3])] = entry
+        self._forget(entry[0])
+
+    def _remove(self, identity):
+        entry = self._ids.pop(identity, None)
+        if entry is None:
+            return None
+        i = self._position(entry)
+        # (キー, -スコア, 名前) が同じ候補 (同じタイトルの記事など) もあるので, 同じものを探す
+        while self._entries[i] is not entry:
+            i += 1
+        del self._entries[i]
+        del self._keys[i]
+        self._forget(entry[0])
+        return entry
+
+    # entry を挿入する位置 (同じキーの範囲の中から (キー, -スコア, 名前) の順で探す)
+    def _position(self, entry):
+        lo = bisect.bisect_left(self._keys, entry[0])
+        hi = bisect.bisect_right(self._keys, entry[0])
+        order = entry[:3]
+        while lo < hi and self._entries[lo][:3] < order:
+            lo += 1
+        return lo
+
+    # 変化したキーに前方一致する接頭辞 (キー自身の接頭辞) の結果だけを忘れる
+    def _forget(self, key):
+        for i in range(len(key) + 1):
+            self._cache.pop(key[:i], None)
+
+    # 候補を追加するか置き換える. score が None なら今のスコア (なければ 0) のまま
+    def _put(self, name, score, extra):
+        old = self._remove(self._identity(name, extra))
+        if score is None:
+            score = -old[1] if old is not None else 0
+        if name:
+            self._insert((normalize(name), -score, name, extra))
+
+    # 候補をまとめて追加するか置き換える. 数が多ければ 1 件ずつ挿入せず, 整列し直す (整列済みの列の併合になる)
+    def _put_many(self, items):
+        if len(items) < BULK_MIN:
+            for name, score, extra in items:
+                self._put(name, score, extra)
+            return
+        new = []
+        for name, score, extra in items:
+            old = self._remove(self._identity(name, extra))
+            if score is None:
+                score = -old[1] if old is not None else 0
+            if name:
+                new.append((normalize(name), -score, name, extra))
+        new.sort(key=lambda entry: entry[:3])
+        self._entries = sorted(self._entries + new, key=lambda entry: entry[:3])
+        self._keys = [entry[0] for entry in self._entries]
+        self._ids.update((self._identity(entry[2], entry[3]), entry) for entry in new)
+        self._cache = {}
+
+    def _delete(self, identities):
+        for identity in identities:
+            self._remove(identity)
+
+    # スコアを増減する {識別子: 増減}. 名前で識別する種類では, ない候補は追加する
+    def _add_scores(self, deltas):
+        for identity, delta in deltas.items():
+            old = self._remove(identity)
+            if old is not None:
+                self._insert(old[:1] + (old[1] - delta,) + old[2:])
+            elif not self.id_field:
+                self._insert((normalize(identity), -delta, identity, {}))
+
+    # 差分を反映する (作っていなければ何もしない. 最初の検索の際に DB から作る)
+    # 作っている間の挿入・削除は, 読み込みに含まれていないかもしれないので覚えておき, 作り終えたら反映する
+    def apply(self, method, *args):
+        with self._lock:
+            if self._pending is not None and method != '_add_scores':
+                self._pending.append((method, args))
+            if self._entries is not None:
+                getattr(self, method)(*args)
+
+    # 接頭辞 prefix に一致するものをスコアの大きい順 (同じなら名前順) に limit 件返す
+    def search(self, prefix, limit=10):
+        self._ensure_built()
+        key = normalize(prefix)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and limit in cached:
+                return cached[limit]
+            lo = bisect.bisect_left(self._keys, key)
+            hi = bisect.bisect_left(self._keys, key + '\U0010ffff')
+            # 範囲を複製せずに (添字で) 走査する. ロックの中なので書き込みとは重ならない
+            entries = self._entries
+            top = heapq.nsmallest(limit, (entries[i] for i in range(lo, hi)), key=lambda entry: (entry[1], entry[0]))
+            results = [dict(extra, value=name, score=-score) for _, score, name, extra in top]
+            if hi - lo > limit * 10 and (cached is not None or len(self._cache) < MAX_CACHED_PREFIXES):
+                self._cache.setdefault(key, {})[limit] = results
+        return results
+
+
+def _load_tags():
+    from cms.models import Tag
+
+    return ((tag, article_num, {}) for tag, article_num in Tag.objects.values_list('tag', 'article_num').iterator())
+
+
+def _load_categories():
+    from cms.models import Category
+
+    return ((category, article_num, {}) for category, article_num
+            in Category.objects.values_list('category', 'article_num').iterator())
+
+
+def _load_titles():
+    from cms.models import Article
+
+    return ((title, fav_num, dict(article_id=article_id)) for article_id, title, fav_num
+            in Article.objects.values_list('article_id', 'title', 'fav_num').iterator())
+
+
+def _load_users():
+    from users.models import User
+
+    users = User.objects.filter(is_active=True).annotate(article_num=Count('author')).order_by()
+    return ((username, article_num, dict(user_id=user_id)) for user_id, username, article_num
+            in users.values_list('id', 'username', 'article_num').iterator())
+
+
+indexes = {
+    'tag': PrefixIndex(_load_tags),
+    'category': PrefixIndex(_load_categories),
+    'title': PrefixIndex(_load_titles, id_field='article_id'),
+    'user': PrefixIndex(_load_users, id_field='user_id'),
+}
+
+
+# 候補を返す. kind が不正なら KeyError
+def complete(kind, prefix, limit=10):
+    return indexes[kind].search(prefix, max(1, min(limit, MAX_LIMIT)))
+
+
+# 索引を捨てる (次に検索されたときに DB から作る. kinds を省略すると全て)
+def invalidate(*kinds):
+    for kind in kinds or indexes:
+        indexes[kind].invalidate()
+
+
+def _on_commit(kind, method, *args):
+    transaction.on_commit(lambda: indexes[kind].apply(method, *args))
+
+
+# 以下は書き込みの際に呼ぶ (コミットされたら索引に反映する)
+
+# 候補を追加するか置き換える (score が None ならスコアはそのまま)
+def put(kind, name, score=None, extra=None):
+    _on_commit(kind, '_put', name, score, extra or {})
+
+
+# 候補をまとめて追加するか置き換える. items は (名前, スコア, その他の情報の dict) の組
+def put_many(kind, items):
+    items = list(items)
+    if items:
+        _on_commit(kind, '_put_many', items)
+
+
+# 候補を除く. identities は名前 (タグ・分野) か ID (記事・ユーザー)
+def remove(kind, identities):
+    _on_commit(kind, '_delete', list(identities))
+
+
+# スコア (記事数など) を増減する {名前か ID: 増減}
+def add_scores(kind, deltas):
+    deltas = {identity: delta for identity, delta in deltas.items() if delta}
+    if deltas:
+        _on_commit(kind, '_add_scores', deltas)
+
+
+# post_save のシグナルを受け取る
+def update_for_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    from cms.models import Article, Author, Category, Tag
+    from users.models import User
+
+    if sender in (Tag, Category):
+        score = instance.article_num if isinstance(instance.article_num, int) else None
+        put('tag' if sender is Tag else 'category', instance.pk, score)
+    elif sender is Article:
+        # お気に入り数は別に (UPDATE で) 増減するので, 作成したときだけ使う
+        put('title', instance.title, instance.fav_num if created else None, dict(article_id=instance.pk))
+    elif sender is User:
+        # ログインのたびの最終ログイン日時の更新は無視する
+        if set(update_fields or ()) == {'last_login'}:
+            return
+        if instance.is_active:
+            put('user', instance.username, 0 if created else None, dict(user_id=instance.pk))
+        else:
+            remove('user', [instance.pk])
+    elif sender is Author and created:
+        # 執筆者の記事数はユーザーの順位に影響する
+        add_scores('user', {instance.user_id: 1})
+
+
+# post_delete のシグナルを受け取る
+def update_for_deleted(sender, instance, **kwargs):
+    from cms.models import Article, Author, Category, Tag
+    from users.models import User
+
+    if sender in (Tag, Category):
+        remove('tag' if sender is Tag else 'category', [instance.pk])
+    elif sender in (Article, User):
+        remove('title' if sender is Article else 'user', [instance.pk])
+    elif sender is Author:
+        add_scores('user', {instance.user_id: -1})
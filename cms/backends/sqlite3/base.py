@@ -0,0 +1,29 @@
+from django.db.backends.sqlite3 import base
+
+
+# 接続時の PRAGMA とトランザクションの開始方法を OPTIONS で指定できる SQLite のバックエンド
+# (どちらも Django 5.1 の SQLite バックエンドの OPTIONS と同じ名前・意味)
+# init_command: 接続のたびに実行する文 (";" 区切り). 例: "PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL"
+# transaction_mode: "BEGIN <transaction_mode>" でトランザクションを始める. 例: "IMMEDIATE"
+#   WAL では読み込んだ後に書き込むトランザクションが, 他の書き込みと重なると待たずに "database is locked" になる.
+#   IMMEDIATE なら始めた時点で書き込みのロックを取る (取れなければ timeout 秒まで待つ) ので, これが起きない
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        # sqlite3.connect() には渡さない
+        kwargs.pop('init_command', None)
+        kwargs.pop('transaction_mode', None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        init_command = self.settings_dict['OPTIONS'].get('init_command', '')
+        for statement in init_command.split(';'):
+            if statement.strip():
+                conn.execute(statement)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        transaction_mode = self.settings_dict['OPTIONS'].get('transaction_mode')
+        self.cursor().execute(f'BEGIN {transaction_mode}' if transaction_mode else 'BEGIN')
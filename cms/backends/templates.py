@@ -0,0 +1,26 @@
+import time
+
+from django.template.backends import django
+
+from cms import metrics
+
+
+# 描画時間を処理中のリクエストの記録 (cms.metrics) に加える Django テンプレートのバックエンド
+# {% include %} などで中から描画されるテンプレートはここを通らないので, 二重には数えない
+class DjangoTemplates(django.DjangoTemplates):
+
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name).template, self)
+
+
+class Template(django.Template):
+
+    def render(self, context=None, request=None):
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.add_template_time(time.perf_counter() - start)
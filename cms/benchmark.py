@@ -0,0 +1,451 @@
+import math
+import random
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.http import HttpRequest
+from django.middleware.csrf import get_token
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from cms import bulk
+from cms.articlesearch import ORDER_FIELDS
+from cms.models import Article, Author, Category, Tag
+from users.models import User
+
+# cms.urls の全てのルートのベンチマーク
+# ルートごとのシナリオが実際の使われ方に近いパラメータ (検索条件・並び替え・ページ・ログインの有無) のリクエストを作り,
+# プロセス内 (Django のテストクライアント) か, 起動中のサーバーへの HTTP (並行) で実行する
+# 結果はルートごとの p50 / p95 / p99 (ミリ秒), スループット, 1 リクエストあたりのクエリ数 (プロセス内のみ) の dict
+
+# 記録する百分位数
+PERCENTILES = (50, 95, 99)
+
+# 成功とみなすステータス
+OK_STATUSES = (200, 302, 304)
+
+# ベンチマーク用のユーザー (なければ作る)
+USERNAME = 'benchmark'
+STAFF_USERNAME = 'benchmark-staff'
+
+# ページングのボタンから次のページのカーソルを取り出す
+NEXT_CURSOR_RE = re.compile(r'value="([^"]+)"\s+name="[^"]*"\s+aria-label="Next"')
+
+
+# 1 回分のリクエスト. session は 'anonymous', 'user', 'staff' のいずれか
+class BenchmarkRequest:
+    def __init__(self, route, path, data=None, method='GET', session='anonymous'):
+        self.route = route
+        self.path = path
+        self.data = data or {}
+        self.method = method
+        self.session = session
+
+
+# シナリオが使うデータ (DB から取った記事・ユーザー・分野・タグ) とセッション
+class Context:
+    def __init__(self, rng):
+        self.rng = rng
+        self.article_ids = list(Article.objects.values_list('pk', flat=True))
+        if not self.article_ids:
+            raise ValueError('記事がありません (generate_corpus でデータを作ってください)')
+        self.popular_ids = list(Article.objects.order_by('-fav_num').values_list('pk', flat=True)[:100])
+        author_ids = Author.objects.order_by().values_list('user_id', flat=True).distinct()[:1000]
+        self.authors = list(User.objects.filter(pk__in=list(author_ids)).values_list('pk', 'username'))
+        self.categories = list(Category.objects.order_by('-article_num').values_list('pk', flat=True)[:50])
+        self.tags = list(Tag.objects.order_by('-article_num').values_list('pk', flat=True)[:200])
+        titles = Article.objects.filter(pk__in=self.popular_ids).values_list('title', flat=True)
+        self.words = sorted({word for title in titles for word in title.split() if len(word) >= 2}) or ['a']
+        # 最近更新された 100 件目の更新日時 (差分の書き出しに使う)
+        recent = Article.objects.order_by('-updated_at').values_list('updated_at', flat=True)[:100]
+        self.recent = list(recent)[-1]
+
+        self.user = self._user(USERNAME, is_staff=False)
+        self.staff = self._user(STAFF_USERNAME, is_staff=True)
+        host = (settings.ALLOWED_HOSTS or ['localhost'])[0].lstrip('.')
+        self.clients = dict(anonymous=Client(HTTP_HOST='localhost' if host == '*' else host))
+        for session, user in (('user', self.user), ('staff', self.staff)):
+            self.clients[session] = Client(HTTP_HOST=self.clients['anonymous'].defaults['HTTP_HOST'])
+            self.clients[session].force_login(user)
+        self.own_article_ids = list(Author.objects.filter(user=self.user).values_list('article_id', flat=True))
+
+    @staticmethod
+    def _user(username, is_staff):
+        user, created = User.objects.get_or_create(username=username, defaults=dict(is_staff=is_staff))
+        if created:
+            user.set_unusable_password()
+            user.save()
+        return user
+
+    # 人気の記事に偏らせて選ぶ
+    def article(self):
+        if self.popular_ids and self.rng.random() < 0.5:
+            return self.rng.choice(self.popular_ids)
+        return self.rng.choice(self.article_ids)
+
+    def author(self):
+        return self.rng.choice(self.authors) if self.authors else (self.user.pk, self.user.username)
+
+    # ログインしているかどうかを半々にする
+    def session(self):
+        return self.rng.choice(('anonymous', 'user'))
+
+    # ベンチマーク用のユーザーが書いた記事を作り, その記事 ID を返す
+    def new_own_article(self):
+        row = dict(title=f'ベンチマーク {self.rng.choice(self.words)}', content='ベンチマーク用の記事',
+                   category=self.categories[0] if self.categories else 'ベンチマーク', tags=[], author=self.user.pk)
+        article_id = bulk.create_articles([row])[0].article_id
+        self.own_article_ids.append(article_id)
+        return article_id
+
+    def own_article(self):
+        if not self.own_article_ids:
+            self.new_own_article()
+        return self.rng.choice(self.own_article_ids)
+
+    # 一覧の 1 ページ目を (計測せずに) 取得し, 次のページのカーソルを返す (なければ None)
+    def next_cursor(self, path, data, session):
+        response = self.clients[session].get(path, data)
+        if response['Content-Type'].startswith('application/json'):
+            return response.json()['page']['next_cursor']
+        match = NEXT_CURSOR_RE.search(response.content.decode())
+        return match.group(1) if match else None
+
+    def search_params(self):
+        rng = self.rng
+        data = {}
+        roll = rng.random()
+        if roll < 0.3:
+            data['title'] = rng.choice(self.words)
+        elif roll < 0.45 and self.categories:
+            data['category'] = rng.choice(self.categories)
+        elif roll < 0.6 and self.tags:
+            data['selected_tags'] = rng.sample(self.tags, min(len(self.tags), rng.randint(1, 2)))
+        elif roll < 0.7:
+            data['username'] = self.author()[1]
+        if rng.random() < 0.5:
+            data['search_or_order'] = f'{rng.choice(("", "-"))}{rng.choice(ORDER_FIELDS)}'
+        return data
+
+
+def _index(ctx):
+    return BenchmarkRequest('index', reverse('cms:index'), session=ctx.session())
+
+
+def _signup(ctx):
+    return BenchmarkRequest('signup', reverse('cms:signup'))
+
+
+def _login(ctx):
+    return BenchmarkRequest('login', reverse('cms:login'))
+
+
+def _logout(ctx):
+    # ログイン中のセッションを失わないように, ログインしていないセッションで行う
+    return BenchmarkRequest('logout', reverse('cms:logout'))
+
+
+def _user_page(ctx):
+    return BenchmarkRequest('user_page', reverse('cms:user_page', args=[ctx.author()[0]]), session=ctx.session())
+
+
+def _article_view(ctx):
+    return BenchmarkRequest('article_view', reverse('cms:article_view', args=[ctx.article()]), session=ctx.session())
+
+
+def _article_add(ctx):
+    if ctx.rng.random() < 0.8:
+        return BenchmarkRequest('article_add', reverse('cms:article_add'), session='user')
+    data = dict(title=f'ベンチマーク {ctx.rng.choice(ctx.words)}', content='ベンチマーク用の記事',
+                category=ctx.rng.choice(ctx.categories) if ctx.categories else 'ベンチマーク',
+                selected_tags=ctx.rng.sample(ctx.tags, min(len(ctx.tags), 2)))
+    return BenchmarkRequest('article_add', reverse('cms:article_add'), data, method='POST', session='user')
+
+
+def _article_edit(ctx):
+    path = reverse('cms:article_edit', args=[ctx.own_article()])
+    if ctx.rng.random() < 0.8:
+        return BenchmarkRequest('article_edit', path, session='user')
+    data = dict(title=f'ベンチマーク {ctx.rng.choice(ctx.words)}', content='ベンチマーク用の記事 (編集)',
+                category=ctx.rng.choice(ctx.categories) if ctx.categories else 'ベンチマーク',
+                selected_tags=ctx.rng.sample(ctx.tags, min(len(ctx.tags), ctx.rng.randint(0, 3))))
+    return BenchmarkRequest('article_edit', path, data, method='POST', session='user')
+
+
+def _article_del(ctx):
+    # 削除する記事は計測の前に作っておく
+    article_id = ctx.new_own_article()
+    ctx.own_article_ids.remove(article_id)
+    return BenchmarkRequest('article_del', reverse('cms:article_del', args=[article_id]), session='user')
+
+
+def _category_create(ctx):
+    return BenchmarkRequest('category_create', reverse('cms:category_create'), session=ctx.session())
+
+
+def _tag_create(ctx):
+    return BenchmarkRequest('tag_create', reverse('cms:tag_create'), session=ctx.session())
+
+
+def _export_articles(ctx):
+    data = dict(format=ctx.rng.choice(('jsonl', 'csv')), since=ctx.recent.isoformat())
+    return BenchmarkRequest('export_articles', reverse('cms:export_articles'), data, session='staff')
+
+
+def _metrics(ctx):
+    return BenchmarkRequest('metrics', reverse('cms:metrics'), session='staff')
+
+
+def _autocomplete_ajax(ctx):
+    rng = ctx.rng
+    kind = rng.choice(('tag', 'tag', 'category', 'title', 'user'))
+    names = dict(tag=ctx.tags, category=ctx.categories, title=ctx.words, user=[name for _, name in ctx.authors])
+    name = rng.choice(names[kind] or ['a'])
+    data = dict(kind=kind, q=name[:rng.randint(1, 3)])
+    return BenchmarkRequest('autocomplete_ajax', reverse('cms:autocomplete_ajax'), data, session=ctx.session())
+
+
+def _search(ctx, route):
+    path = reverse(f'cms:{route}')
+    session = ctx.session()
+    data = ctx.search_params()
+    if session == 'user' and ctx.rng.random() < 0.3:
+        data['check'] = [ctx.rng.choice(('author', 'fav', 'read'))]
+    # 2 ページ目以降も見る
+    if ctx.rng.random() < 0.3:
+        cursor = ctx.next_cursor(path, data, session)
+        if cursor:
+            data['cursor'] = cursor
+    return BenchmarkRequest(route, path, data, session=session)
+
+
+def _search_ajax(ctx):
+    return _search(ctx, 'search_ajax')
+
+
+def _search_api(ctx):
+    return _search(ctx, 'search_api')
+
+
+def _fav_ajax(ctx):
+    return BenchmarkRequest('fav_ajax', reverse('cms:fav_ajax', args=[ctx.article()]), session='user')
+
+
+def _user_page_articles(ctx, route):
+    path = reverse(f'cms:{route}', args=[ctx.author()[0]])
+    session = ctx.session()
+    data = dict(search_or_order=f'{ctx.rng.choice(("", "-"))}{ctx.rng.choice(ORDER_FIELDS)}')
+    if ctx.rng.random() < 0.3:
+        cursor = ctx.next_cursor(path, data, session)
+        if cursor:
+            data['cursor'] = cursor
+    return BenchmarkRequest(route, path, data, session=session)
+
+
+def _user_page_ajax(ctx):
+    return _user_page_articles(ctx, 'user_page_ajax')
+
+
+def _user_page_api(ctx):
+    return _user_page_articles(ctx, 'user_page_api')
+
+
+# URL の名前 -> シナリオ (Context を受け取り BenchmarkRequest を返す)
+SCENARIOS = {
+    'index': _index,
+    'signup': _signup,
+    'login': _login,
+    'logout': _logout,
+    'user_page': _user_page,
+    'article_view': _article_view,
+    'article_add': _article_add,
+    'article_edit': _article_edit,
+    'article_del': _article_del,
+    'category_create': _category_create,
+    'tag_create': _tag_create,
+    'export_articles': _export_articles,
+    'metrics': _metrics,
+    'autocomplete_ajax': _autocomplete_ajax,
+    'search_ajax': _search_ajax,
+    'fav_ajax': _fav_ajax,
+    'user_page_ajax': _user_page_ajax,
+    'search_api': _search_api,
+    'user_page_api': _user_page_api,
+}
+
+# DB に書き込むルート (--skip-writes で除く)
+WRITE_ROUTES = ('article_add', 'article_edit', 'article_del', 'fav_ajax')
+
+
+# ルートごとに count 回ずつのリクエストを作り, 混ぜた順に並べて返す
+def plan(ctx, routes, count):
+    requests = [SCENARIOS[route](ctx) for route in routes for _ in range(count)]
+    ctx.rng.shuffle(requests)
+    return requests
+
+
+# (ルート, 秒, クエリ数, ステータス) を返す
+def _run_in_process(ctx, request):
+    client = ctx.clients[request.session]
+    queries = [0]
+
+    def count_query(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    # 非同期のビューの DB の処理もこのスレッドで実行して, クエリを数えられるようにする (cms.asyncdb)
+    async_views = dict(getattr(settings, 'ASYNC_VIEWS', {}), MAX_WORKERS=0)
+    start = time.perf_counter()
+    with connection.execute_wrapper(count_query), override_settings(ASYNC_VIEWS=async_views):
+        if request.method == 'POST':
+            response = client.post(request.path, request.data)
+        else:
+            response = client.get(request.path, request.data)
+        if response.streaming:
+            b''.join(response.streaming_content)
+    return request.route, time.perf_counter() - start, queries[0], response.status_code
+
+
+# リダイレクトをたどらない (リダイレクトを返すまでの時間を測る)
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+# 起動中のサーバーに送るための, セッションごとの Cookie と CSRF トークン
+# ページを返すときのミドルウェアと同じく get_token で作る (Cookie の値は request.META['CSRF_COOKIE'] に入る)
+def _live_headers(ctx):
+    request = HttpRequest()
+    token = get_token(request)
+    headers = {}
+    for session, client in ctx.clients.items():
+        cookies = [f'{settings.CSRF_COOKIE_NAME}={request.META["CSRF_COOKIE"]}']
+        if settings.SESSION_COOKIE_NAME in client.cookies:
+            cookies.append(f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}')
+        headers[session] = {'Cookie': '; '.join(cookies), 'X-CSRFToken': token}
+    return headers
+
+
+def _run_live(base_url, headers, request):
+    opener = urllib.request.build_opener(_NoRedirect)
+    query = urllib.parse.urlencode(request.data, doseq=True)
+    url = base_url.rstrip('/') + request.path
+    body = None
+    if request.method == 'POST':
+        body = query.encode()
+    elif query:
+        url = f'{url}?{query}'
+    http_request = urllib.request.Request(url, data=body, headers=headers[request.session], method=request.method)
+    start = time.perf_counter()
+    try:
+        with opener.open(http_request) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        status = e.code
+    return request.route, time.perf_counter() - start, None, status
+
+
+# 計画したリクエストを実行し, (結果のリスト, 全体の秒数) を返す
+# base_url を指定すると起動中のサーバーに concurrency 並列で送る
+def execute(ctx, requests, base_url=None, concurrency=1):
+    start = time.perf_counter()
+    if base_url is None:
+        results = [_run_in_process(ctx, request) for request in requests]
+    else:
+        headers = _live_headers(ctx)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda request: _run_live(base_url, headers, request), requests))
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _stats(results, wall):
+    latencies = sorted(seconds * 1000 for _, seconds, _, _ in results)
+    queries = [n for _, _, n, _ in results if n is not None]
+    stats = dict(
+        requests=len(results),
+        errors=sum(1 for _, _, _, status in results if status not in OK_STATUSES),
+        mean_ms=sum(latencies) / len(latencies) if latencies else None,
+        throughput_rps=len(results) / wall if wall > 0 else None,
+        queries_per_request=sum(queries) / len(queries) if queries else None,
+    )
+    for p in PERCENTILES:
+        stats[f'p{p}_ms'] = percentile(latencies, p)
+    return stats
+
+
+# 結果をまとめる. ルートごとのスループットはそのルートにかかった時間の合計から求める
+# (並列の場合はルートごとの時間が重なって分けられないので, 全体のスループットだけを求める)
+def summarize(results, wall, meta):
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result[0], []).append(result)
+    routes = {}
+    for route, route_results in sorted(by_route.items()):
+        busy = 0 if meta.get('concurrency', 1) > 1 else sum(seconds for _, seconds, _, _ in route_results)
+        routes[route] = _stats(route_results, busy)
+    return dict(meta=meta, total=_stats(results, wall), routes=routes)
+
+
+# 実行環境などの情報
+def describe(mode, **extra):
+    return dict(
+        mode=mode,
+        started_at=timezone.now().isoformat(),
+        django=django.get_version(),
+        database=connection.vendor,
+        **extra,
+    )
+
+
+# 2 回の結果を比べ, ルートごとの行と悪化したルートのリストを返す
+# p95 が threshold (割合) 以上かつ min_ms 以上遅くなったか, クエリ数が 1 以上増えたルートを悪化とする
+def compare(base, new, threshold=0.1, min_ms=1.0):
+    rows = []
+    regressions = []
+    for route in sorted(set(base['routes']) | set(new['routes'])):
+        old_stats, new_stats = base['routes'].get(route), new['routes'].get(route)
+        row = dict(route=route, base=old_stats, new=new_stats, reasons=[])
+        if old_stats and new_stats:
+            old_p95, new_p95 = old_stats['p95_ms'], new_stats['p95_ms']
+            if new_p95 > old_p95 * (1 + threshold) and new_p95 - old_p95 >= min_ms:
+                row['reasons'].append(f'p95 {old_p95:.1f} -> {new_p95:.1f} ms')
+            old_queries, new_queries = old_stats['queries_per_request'], new_stats['queries_per_request']
+            if old_queries is not None and new_queries is not None and new_queries - old_queries >= 1:
+                row['reasons'].append(f'クエリ数 {old_queries:.1f} -> {new_queries:.1f}')
+            if new_stats['errors'] > old_stats['errors']:
+                row['reasons'].append(f'エラー {old_stats["errors"]} -> {new_stats["errors"]}')
+        if row['reasons']:
+            regressions.append(route)
+        rows.append(row)
+    return rows, regressions
+
+
+# Context を作り, 計測して結果の dict を返す
+def run(routes=None, count=50, warmup=5, seed=0, skip_writes=False, base_url=None, concurrency=1):
+    routes = list(routes or SCENARIOS)
+    if skip_writes:
+        routes = [route for route in routes if route not in WRITE_ROUTES]
+    ctx = Context(random.Random(seed))
+    if warmup:
+        execute(ctx, plan(ctx, routes, warmup), base_url=base_url, concurrency=concurrency)
+    results, wall = execute(ctx, plan(ctx, routes, count), base_url=base_url, concurrency=concurrency)
+    meta = describe('live' if base_url else 'in-process', base_url=base_url, concurrency=concurrency,
+                    requests_per_route=count, warmup=warmup, seed=seed, routes=routes)
+    return summarize(results, wall, meta)
+
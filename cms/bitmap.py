@@ -0,0 +1,202 @@
+import bisect
+import re
+from array import array
+
+# 圧縮したビットマップ (非負整数の集合. Roaring bitmap と同じ考え方)
+# 値を上位ビット (65536 ごとの区間) で分け, 区間ごとに下位 16 ビットの集合を持つ
+#   要素が少ない区間: 整列した array('H') (1 要素 2 バイト)
+#   要素が多い区間: 65536 ビットの int (8 KB. 集合演算は int のビット演算で行う)
+# 要素のない区間は持たないので, 疎な集合も密な集合も小さく収まる
+# 区間の集合は演算の結果どうしで共有するので, 変更するときは複製する
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+# 区間の要素数がこれより多ければ int にする (array と int の大きさが同じになる境目)
+ARRAY_MAX = 4096
+
+_ONE = re.compile('1')
+
+
+# 立っているビットの数 (int.bit_count は Python 3.10 以降)
+_popcount = getattr(int, 'bit_count', None) or (lambda bits: bin(bits).count('1'))
+
+
+# 区間の集合を int にする
+def _to_bits(container):
+    if isinstance(container, int):
+        return container
+    data = bytearray(CHUNK_SIZE // 8)
+    for low in container:
+        data[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bytes(data), 'little')
+
+
+# int の区間の, 立っているビットの位置 (昇順). 2 進表記を逆順にした文字列から '1' を探す
+def _bit_positions(bits):
+    return array('H', (match.start() for match in _ONE.finditer(bin(bits)[:1:-1])))
+
+
+# 区間の集合を要素数に合った表現にする (空なら None)
+def _normalize(container):
+    if isinstance(container, int):
+        if not container:
+            return None
+        return _bit_positions(container) if _popcount(container) <= ARRAY_MAX else container
+    if not container:
+        return None
+    return container if len(container) <= ARRAY_MAX else _to_bits(container)
+
+
+# int の区間に含まれるかを調べる関数
+def _bit_test(bits):
+    data = bits.to_bytes(CHUNK_SIZE // 8, 'little')
+    return lambda low: data[low >> 3] >> (low & 7) & 1
+
+
+def _and(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return a & b
+    if isinstance(a, int):
+        a, b = b, a
+    if isinstance(b, int):
+        test = _bit_test(b)
+        return array('H', (low for low in a if test(low)))
+    return array('H', sorted(set(a).intersection(b)))
+
+
+def _or(a, b):
+    if isinstance(a, int) or isinstance(b, int) or len(a) + len(b) > ARRAY_MAX:
+        return _to_bits(a) | _to_bits(b)
+    return array('H', sorted(set(a).union(b)))
+
+
+def _and_not(a, b):
+    if isinstance(a, int):
+        return a & ~_to_bits(b)
+    if isinstance(b, int):
+        test = _bit_test(b)
+        return array('H', (low for low in a if not test(low)))
+    return array('H', sorted(set(a).difference(b)))
+
+
+class Bitmap:
+
+    def __init__(self, values=()):
+        self._chunks = {}
+        chunk, lows = None, []
+        for value in sorted(set(values)):
+            if value >> CHUNK_BITS != chunk:
+                self._set_chunk(chunk, array('H', lows))
+                chunk, lows = value >> CHUNK_BITS, []
+            lows.append(value & LOW_MASK)
+        self._set_chunk(chunk, array('H', lows))
+
+    def _set_chunk(self, chunk, container):
+        container = _normalize(container)
+        if container is None:
+            self._chunks.pop(chunk, None)
+        else:
+            self._chunks[chunk] = container
+
+    @staticmethod
+    def _from_chunks(chunks):
+        bitmap = Bitmap()
+        for chunk, container in chunks:
+            bitmap._set_chunk(chunk, container)
+        return bitmap
+
+    def copy(self):
+        return Bitmap._from_chunks(self._chunks.items())
+
+    def add(self, value):
+        chunk, low = value >> CHUNK_BITS, value & LOW_MASK
+        container = self._chunks.get(chunk, array('H'))
+        if isinstance(container, int):
+            self._chunks[chunk] = container | (1 << low)
+        else:
+            i = bisect.bisect_left(container, low)
+            if i == len(container) or container[i] != low:
+                self._set_chunk(chunk, container[:i] + array('H', [low]) + container[i:])
+
+    def discard(self, value):
+        chunk, low = value >> CHUNK_BITS, value & LOW_MASK
+        container = self._chunks.get(chunk)
+        if container is None:
+            return
+        if isinstance(container, int):
+            self._set_chunk(chunk, container & ~(1 << low))
+        else:
+            i = bisect.bisect_left(container, low)
+            if i < len(container) and container[i] == low:
+                self._set_chunk(chunk, container[:i] + container[i + 1:])
+
+    def __contains__(self, value):
+        container = self._chunks.get(value >> CHUNK_BITS)
+        if container is None:
+            return False
+        low = value & LOW_MASK
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        i = bisect.bisect_left(container, low)
+        return i < len(container) and container[i] == low
+
+    def __len__(self):
+        return sum(_popcount(container) if isinstance(container, int) else len(container)
+                   for container in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    # 昇順
+    def __iter__(self):
+        for chunk in sorted(self._chunks):
+            container = self._chunks[chunk]
+            base = chunk << CHUNK_BITS
+            for low in _bit_positions(container) if isinstance(container, int) else container:
+                yield base | low
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and list(self) == list(other)
+
+    def __and__(self, other):
+        return Bitmap._from_chunks(
+            (chunk, _and(container, other._chunks[chunk]))
+            for chunk, container in self._chunks.items() if chunk in other._chunks)
+
+    def __or__(self, other):
+        chunks = dict(self._chunks)
+        for chunk, container in other._chunks.items():
+            chunks[chunk] = _or(chunks[chunk], container) if chunk in chunks else container
+        return Bitmap._from_chunks(chunks.items())
+
+    def __sub__(self, other):
+        return Bitmap._from_chunks(
+            (chunk, _and_not(container, other._chunks[chunk]) if chunk in other._chunks else container)
+            for chunk, container in self._chunks.items())
+
+    # 保持に使っているおおよそのバイト数
+    def nbytes(self):
+        return sum(CHUNK_SIZE // 8 if isinstance(container, int) else container.itemsize * len(container)
+                   for container in self._chunks.values())
+
+
+# 複数のビットマップの積 (共通部分). 小さいものから順に取る
+def intersection(bitmaps):
+    bitmaps = sorted(bitmaps, key=len)
+    if not bitmaps:
+        return Bitmap()
+    result = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        if not result:
+            break
+        result = result & bitmap
+    return result
+
+
+# 複数のビットマップの和
+def union(bitmaps):
+    result = Bitmap()
+    for bitmap in bitmaps:
+        result = result | bitmap
+    return result
@@ -0,0 +1,258 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+# 書き込みをメモリ上にためておき, まとめて DB に反映するバッファ (write-behind)
+# 同じキーへの書き込みは merge で 1 つにまとめられる
+# 反映はリクエストの終了時 (レスポンスを返した後) に, 前回から FLUSH_INTERVAL 秒経っているか
+# MAX_PENDING 件たまっていれば行う. FLUSH_IN_BACKGROUND なら, リクエストが来なくても裏のスレッドが
+# FLUSH_INTERVAL 秒ごとに反映する. プロセスの終了時には atexit で残りを全て反映する
+# プロセスが異常終了した場合に失われるのは, 前回の反映以降にたまった分 (通常は MAX_PENDING 件未満) だけ
+class WriteBehindBuffer:
+    # settings に置く設定の名前
+    setting_name = None
+    default_flush_interval = 1.0
+    default_max_pending = 1000
+    default_max_retries = 3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        # キーごとの反映に失敗した回数
+        self._failures = {}
+        self._last_flush = time.monotonic()
+        # 書き込みを受け付けた DB (テスト用 DB など, 別の DB には反映しない)
+        self._database = None
+        atexit.register(self.flush)
+
+    def _setting(self, key, default):
+        return getattr(settings, self.setting_name, {}).get(key, default)
+
+    @property
+    def enabled(self):
+        return self._setting('ENABLED', False)
+
+    @property
+    def flush_interval(self):
+        return self._setting('FLUSH_INTERVAL', self.default_flush_interval)
+
+    @property
+    def max_pending(self):
+        return self._setting('MAX_PENDING', self.default_max_pending)
+
+    @property
+    def max_retries(self):
+        return self._setting('MAX_RETRIES', self.default_max_retries)
+
+    @property
+    def flush_in_background(self):
+        return self._setting('FLUSH_IN_BACKGROUND', False)
+
+    # キーごとの値をまとめる (サブクラスで定義)
+    def merge(self, old, new):
+        raise NotImplementedError
+
+    # まとめた書き込みを DB に反映する (サブクラスで定義)
+    def write(self, items):
+        raise NotImplementedError
+
+    # バッファに追加し, まとめた後の値を返す
+    def add(self, key, value):
+        with self._lock:
+            self._database = connection.settings_dict['NAME']
+            if key in self._pending:
+                value = self.merge(self._pending[key], value)
+            self._pending[key] = value
+        if self.flush_in_background:
+            _start_flusher()
+        return value
+
+    # まだ DB に反映されていない値 (なければ None)
+    def pending(self, key):
+        with self._lock:
+            return self._pending.get(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    # たまっている書き込みを DB に反映し, 反映した件数を返す
+    # まとめての反映に失敗したら 1 件ずつ反映し直し, 失敗したキーだけを次回の反映で再試行する
+    # (削除されたユーザーや記事への書き込みのように何度やっても失敗するものは, MAX_RETRIES 回失敗したら捨てる)
+    def flush(self):
+        with self._lock:
+            items, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not items:
+            return 0
+        if connection.settings_dict['NAME'] != self._database:
+            logger.warning('%s: discarded %d items for another database', type(self).__name__, len(items))
+            return 0
+        try:
+            with transaction.atomic():
+                self.write(items)
+        except Exception:
+            logger.warning('%s: failed to flush %d items, retrying one by one',
+                           type(self).__name__, len(items), exc_info=True)
+        else:
+            self._forget_failures(items)
+            return len(items)
+        written, failed = 0, {}
+        for key, value in items.items():
+            try:
+                with transaction.atomic():
+                    self.write({key: value})
+            except Exception:
+                logger.exception('%s: failed to flush %r', type(self).__name__, key)
+                failed[key] = value
+            else:
+                written += 1
+        self._forget_failures(items.keys() - failed.keys())
+        self._retry(failed)
+        return written
+
+    # 失敗した書き込みを戻す. MAX_RETRIES 回失敗したものは捨てる
+    def _retry(self, items):
+        with self._lock:
+            for key, value in items.items():
+                failures = self._failures.get(key, 0) + 1
+                if failures >= self.max_retries:
+                    logger.error('%s: dropped %r after %d failed flushes', type(self).__name__, key, failures)
+                    self._failures.pop(key, None)
+                    continue
+                self._failures[key] = failures
+                if key in self._pending:
+                    value = self.merge(value, self._pending[key])
+                self._pending[key] = value
+
+    def _forget_failures(self, keys):
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
+
+    # たまっている書き込みを反映せずに捨て, 捨てた件数を返す
+    def discard(self):
+        with self._lock:
+            items, self._pending = self._pending, {}
+            self._failures = {}
+        return len(items)
+
+    # predicate(キー) が真になる書き込みだけを反映せずに捨て, 捨てた件数を返す
+    def discard_if(self, predicate):
+        with self._lock:
+            keys = [key for key in self._pending if predicate(key)]
+            for key in keys:
+                del self._pending[key]
+                self._failures.pop(key, None)
+        return len(keys)
+
+    # 反映する時期になっていれば反映する
+    def flush_if_due(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            due = len(self._pending) >= self.max_pending \
+                or time.monotonic() - self._last_flush >= self.flush_interval
+        return self.flush() if due else 0
+
+
+# 記事ごとのお気に入り数の増減
+class FavNumBuffer(WriteBehindBuffer):
+    setting_name = 'FAV_NUM_BUFFER'
+
+    def merge(self, old, new):
+        return old + new
+
+    def write(self, items):
+        from cms.counters import add_fav_nums
+
+        add_fav_nums(items)
+
+
+# (ユーザー, 記事) ごとの最終閲覧日時
+class ReadingHistoryBuffer(WriteBehindBuffer):
+    setting_name = 'READING_HISTORY_BUFFER'
+
+    def merge(self, old, new):
+        return max(old, new)
+
+    # まとめて 1 回の upsert (INSERT ... ON CONFLICT DO UPDATE) で反映する
+    def write(self, items):
+        from cms.models import ReadingHistory
+
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            for (user_id, article_id), updated_at in items.items():
+                ReadingHistory.objects.update_or_create(
+                    user_id=user_id, article_id=article_id, defaults=dict(updated_at=updated_at))
+            return
+        opts = ReadingHistory._meta
+        qn = connection.ops.quote_name
+        field = opts.get_field('updated_at')
+        rows = [
+            (article_id, user_id, field.get_db_prep_value(updated_at, connection))
+            for (user_id, article_id), updated_at in items.items()
+        ]
+        article, user, updated = (qn(opts.get_field(name).column) for name in ('article', 'user', 'updated_at'))
+        # SQLite の変数の数の上限 (999) を超えないように分割する
+        for i in range(0, len(rows), 300):
+            chunk = rows[i:i + 300]
+            values = ', '.join(['(%s, %s, %s)'] * len(chunk))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {qn(opts.db_table)} ({article}, {user}, {updated}) VALUES {values} '
+                    f'ON CONFLICT ({article}, {user}) DO UPDATE SET {updated} = excluded.{updated}',
+                    [value for row in chunk for value in row])
+
+
+fav_num_buffer = FavNumBuffer()
+reading_history_buffer = ReadingHistoryBuffer()
+
+buffers = (fav_num_buffer, reading_history_buffer)
+
+
+# リクエストの終了時 (request_finished) に各バッファを反映する
+# (cms.apps で, 接続を閉じる close_old_connections より先に呼ばれるように接続する)
+def flush_buffers_if_due(**kwargs):
+    for buffer in buffers:
+        buffer.flush_if_due()
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+# 裏で反映するスレッドを (まだなければ) 始める. 最初に書き込みをためたときに呼ぶ
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_periodically, daemon=True)
+            _flusher.start()
+
+
+def _flush_periodically():
+    while True:
+        # 間隔が 0 でも空回りしないようにする
+        time.sleep(max(min(buffer.flush_interval for buffer in buffers), 0.1))
+        try:
+            flush_in_background()
+        except Exception:
+            logger.exception('failed to flush buffers in background')
+        finally:
+            connection.close()
+
+
+# FLUSH_IN_BACKGROUND のバッファを, 反映する時期になっていれば反映する
+def flush_in_background():
+    for buffer in buffers:
+        if buffer.flush_in_background:
+            buffer.flush_if_due()
@@ -0,0 +1,255 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Sum
+
+from cms import autocomplete, counters, fulltext, pagecache, tagindex
+from cms.buffers import fav_num_buffer, reading_history_buffer
+from cms.models import Article, ArticleCategory, ArticleTags, Author, Category, ContentVersion, Favorite, ReadingHistory, \
+    Tag, UserStats
+
+# 記事やタグ付けをまとめて作成・変更・削除する (インポート, 記事の編集, 管理画面での一括削除など)
+# 1 件ずつ save() する場合と違い, 分野・タグの記事数や執筆者の統計はまとめて 1 回ずつ増減させる
+
+
+# インポートする 1 行を検証して整形する (不正な場合は ValueError)
+# data は dict(title, content, category, tags, author). tags はリストか空白区切りの文字列
+def clean_row(data):
+    title = (data.get('title') or '').strip()
+    content = (data.get('content') or '').strip()
+    category = (data.get('category') or '').strip()
+    tags = data.get('tags') or []
+    if isinstance(tags, str):
+        tags = tags.split()
+    author = (data.get('author') or '').strip()
+    if not title:
+        raise ValueError('タイトルは必須です')
+    if len(title) > 50:
+        raise ValueError('タイトルは 50 文字以下にしてください')
+    if not content:
+        raise ValueError('内容は必須です')
+    if not category or len(category) > 15:
+        raise ValueError('分野は 1 文字以上 15 文字以下にしてください')
+    tag_names = []
+    for tag in tags:
+        tag = str(tag).strip()
+        if not tag or len(tag) > 15:
+            raise ValueError('タグ名は 1 文字以上 15 文字以下にしてください')
+        if tag not in tag_names:
+            tag_names.append(tag)
+    if not author:
+        raise ValueError('執筆者は必須です')
+    return dict(title=title, content=content, category=category, tags=tag_names, author=author)
+
+
+# 次に割り当てる記事 ID. bulk_create で主キーが返らない DB (SQLite など) で使う
+# SQLite では削除された記事の ID を再利用しないように sqlite_sequence も見る
+def _next_article_id():
+    next_id = Article.objects.aggregate(n=Max('article_id'))['n'] or 0
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [Article._meta.db_table])
+            row = cursor.fetchone()
+        if row is not None:
+            next_id = max(next_id, row[0])
+    return next_id + 1
+
+
+# 記事数の増減 {名前: 増減} を, 増減が同じものごとに 1 回の UPDATE で反映する
+def _add_article_num(model, deltas):
+    by_delta = {}
+    for name, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(name)
+    for delta, names in by_delta.items():
+        model.objects.filter(pk__in=names).update(article_num=F('article_num') + delta)
+    autocomplete.add_scores('tag' if model is Tag else 'category', deltas)
+
+
+def _count(counts, name, delta=1):
+    counts[name] = counts.get(name, 0) + delta
+
+
+# clean_row で整形した行 (author は User の ID) から記事をまとめて作成し, 作成した記事を返す
+# 存在しない分野・タグは作成する. 全体を 1 つのトランザクションで行う
+def create_articles(rows, batch_size=500):
+    if not rows:
+        return []
+    with transaction.atomic():
+        category_counts = {}
+        tag_counts = {}
+        for row in rows:
+            _count(category_counts, row['category'])
+            for tag in row['tags']:
+                _count(tag_counts, tag)
+        Category.objects.bulk_create(
+            [Category(category=name) for name in category_counts], batch_size=batch_size, ignore_conflicts=True)
+        Tag.objects.bulk_create([Tag(tag=name) for name in tag_counts], batch_size=batch_size, ignore_conflicts=True)
+
+        articles = [Article(title=row['title'], content=row['content']) for row in rows]
+        if not connection.features.can_return_rows_from_bulk_insert:
+            next_id = _next_article_id()
+            for i, article in enumerate(articles):
+                article.article_id = next_id + i
+        Article.objects.bulk_create(articles, batch_size=batch_size)
+
+        ArticleCategory.objects.bulk_create([
+            ArticleCategory(article_id=article.article_id, category_id=row['category'])
+            for article, row in zip(articles, rows)
+        ], batch_size=batch_size)
+        ArticleTags.objects.bulk_create([
+            ArticleTags(article_id=article.article_id, tag_id=tag)
+            for article, row in zip(articles, rows) for tag in row['tags']
+        ], batch_size=batch_size)
+        Author.objects.bulk_create([
+            Author(article_id=article.article_id, user_id=row['author'])
+            for article, row in zip(articles, rows)
+        ], batch_size=batch_size)
+
+        _add_article_num(Category, category_counts)
+        _add_article_num(Tag, tag_counts)
+        # 執筆者ごとにまとめて統計に反映する
+        stats = {}
+        for row in rows:
+            user_stats = stats.setdefault(row['author'], dict(article_num=0, categories={}, tags={}))
+            user_stats['article_num'] += 1
+            _count(user_stats['categories'], row['category'])
+            for tag in row['tags']:
+                _count(user_stats['tags'], tag)
+        # 統計の行がまだないユーザー (一度もユーザーページが表示されていないなど) は, 表示の際に集計される
+        for user_id in UserStats.objects.filter(pk__in=stats).values_list('pk', flat=True):
+            UserStats.add(user_id, **stats[user_id])
+        fulltext.index_articles(articles)
+        _index_articles(articles, rows)
+        # bulk_create ではシグナルが送られないので, 入力補完の索引に直接反映する
+        autocomplete.put_many('title', [(article.title, 0, dict(article_id=article.article_id)) for article in articles])
+        autocomplete.add_scores('user', {user_id: user_stats['article_num'] for user_id, user_stats in stats.items()})
+        ContentVersion.bump()
+    return articles
+
+
+# 作成した記事の分野・タグをメモリ上の索引 (cms.tagindex) に反映する
+def _index_articles(articles, rows):
+    categories, tags = {}, {}
+    for article, row in zip(articles, rows):
+        categories.setdefault(row['category'], []).append(article.article_id)
+        for tag in row['tags']:
+            tags.setdefault(tag, []).append(article.article_id)
+    for category, article_ids in categories.items():
+        tagindex.add_category(category, article_ids)
+    for tag, article_ids in tags.items():
+        tagindex.add_tags(tag, article_ids)
+
+
+# 記事のタグを tag_names にし, (追加したタグ, 外したタグ) を返す. 存在しないタグは作成する
+# タグの作成・付け外し・記事数の増減をそれぞれ 1 回の文で行う
+def set_article_tags(article_id, tag_names):
+    tag_names = set(tag_names)
+    with transaction.atomic():
+        current = set(ArticleTags.objects.filter(article_id=article_id).values_list('tag_id', flat=True))
+        added, removed = sorted(tag_names - current), sorted(current - tag_names)
+        if not added and not removed:
+            return added, removed
+        if added:
+            Tag.objects.bulk_create([Tag(tag=name) for name in added], ignore_conflicts=True)
+            ArticleTags.objects.bulk_create([ArticleTags(article_id=article_id, tag_id=name) for name in added])
+        if removed:
+            ArticleTags.objects.filter(article_id=article_id, tag_id__in=removed).delete()
+        for name in added:
+            tagindex.add_tags(name, [article_id])
+        for name in removed:
+            tagindex.remove_tags(name, [article_id])
+        deltas = {name: 1 for name in added}
+        deltas.update({name: -1 for name in removed})
+        _add_article_num(Tag, deltas)
+        UserStats.add_for_article(article_id, tags=deltas)
+        pagecache.invalidate_article(article_id)
+        ContentVersion.bump()
+    return added, removed
+
+
+# (記事 ID, ユーザー ID) の組のうち, まだないものだけを返す
+def _new_pairs(model, pairs):
+    pairs = set(pairs)
+    existing = model.objects.filter(article_id__in={article_id for article_id, _ in pairs})\
+        .values_list('article_id', 'user_id')
+    return sorted(pairs - set(existing))
+
+
+# (記事 ID, ユーザー ID) の組からお気に入りをまとめて登録し, 登録した件数を返す (既にあるものは除く)
+# お気に入り数と執筆者の統計は, 増減が同じ記事・執筆者ごとに 1 回ずつ増やす
+def create_favorites(pairs, batch_size=500):
+    with transaction.atomic():
+        pairs = _new_pairs(Favorite, pairs)
+        Favorite.objects.bulk_create(
+            [Favorite(article_id=article_id, user_id=user_id) for article_id, user_id in pairs], batch_size=batch_size)
+        deltas = {}
+        for article_id, _ in pairs:
+            _count(deltas, article_id)
+        if deltas:
+            counters.add_fav_nums(deltas)
+    return len(pairs)
+
+
+# (記事 ID, ユーザー ID) の組から閲覧履歴をまとめて登録し, 登録した件数を返す (既にあるものは除く)
+def create_reading_history(pairs, batch_size=500):
+    with transaction.atomic():
+        pairs = _new_pairs(ReadingHistory, pairs)
+        ReadingHistory.objects.bulk_create(
+            [ReadingHistory(article_id=article_id, user_id=user_id) for article_id, user_id in pairs],
+            batch_size=batch_size)
+    return len(pairs)
+
+
+# 記事をまとめて削除し, 削除した記事の件数を返す
+# タグ付け・分野・執筆者・お気に入り・閲覧履歴も削除する (CASCADE)
+# 分野・タグの記事数と執筆者の統計は, chunk_size 件ごとに集計した増減で 1 回ずつ減らす
+def delete_articles(article_ids, chunk_size=500):
+    article_ids = list(article_ids)
+    deleted = 0
+    with transaction.atomic():
+        for i in range(0, len(article_ids), chunk_size):
+            deleted += _delete_articles(article_ids[i:i + chunk_size])
+    return deleted
+
+
+def _delete_articles(article_ids):
+    article_ids = list(Article.objects.filter(pk__in=article_ids).values_list('pk', flat=True))
+    if not article_ids:
+        return 0
+    article_tags = ArticleTags.objects.filter(article_id__in=article_ids).order_by()
+    authors = Author.objects.filter(article_id__in=article_ids).order_by()
+
+    tag_counts = article_tags.values('tag_id').annotate(n=Count('id')).values_list('tag_id', 'n')
+    _add_article_num(Tag, {tag: -n for tag, n in tag_counts})
+    category_counts = ArticleCategory.objects.filter(article_id__in=article_ids).order_by()\
+        .values('category_id').annotate(n=Count('article')).values_list('category_id', 'n')
+    _add_article_num(Category, {category: -n for category, n in category_counts})
+
+    # 執筆者ごとにまとめて統計から減らす
+    stats = {}
+    rows = authors.values('user_id').annotate(n=Count('article'), fav=Sum('article__fav_num'))\
+        .values_list('user_id', 'n', 'fav')
+    for user_id, n, fav in rows:
+        stats[user_id] = dict(article_num=-n, liked_num=-(fav or 0), categories={}, tags={})
+    rows = authors.exclude(article__articlecategory=None).values('user_id', 'article__articlecategory__category')\
+        .annotate(n=Count('article')).values_list('user_id', 'article__articlecategory__category', 'n')
+    for user_id, category, n in rows:
+        stats[user_id]['categories'][category] = -n
+    rows = article_tags.exclude(article__author=None).values('article__author__user_id', 'tag_id')\
+        .annotate(n=Count('id')).values_list('article__author__user_id', 'tag_id', 'n')
+    for user_id, tag, n in rows:
+        stats[user_id]['tags'][tag] = -n
+    for user_id, user_stats in stats.items():
+        UserStats.add(user_id, **user_stats)
+
+    fulltext.remove_articles(article_ids)
+    tagindex.remove_articles(article_ids)
+    # まだ反映されていないお気に入り数・閲覧履歴が削除した記事を参照しないようにする
+    removed = set(article_ids)
+    fav_num_buffer.discard_if(lambda key: key in removed)
+    reading_history_buffer.discard_if(lambda key: key[1] in removed)
+    # 記事には post_delete の受け手 (入力補完の索引から除く) があるので, 削除の前に SELECT される
+    # 受け手は主キーしか使わないので, 本文などは読まない
+    _, counts = Article.objects.filter(pk__in=article_ids).only('pk').delete()
+    pagecache.invalidate_articles(article_ids)
+    ContentVersion.bump()
+    return counts.get(Article._meta.label, 0)
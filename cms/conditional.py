@@ -0,0 +1,51 @@
+import hashlib
+from calendar import timegm
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from cms.models import ContentVersion
+
+# 条件付き GET (ETag / Last-Modified) で使う, 描画せずに求められる「版」
+def make_etag(*values):
+    return hashlib.md5(repr(values).encode()).hexdigest()
+
+
+def _timestamp(dt):
+    return timegm(dt.utctimetuple())
+
+
+# サイト全体の内容のバージョン (リクエストごとに 1 回だけ取得する)
+def content_version(request):
+    if not hasattr(request, '_content_version'):
+        request._content_version = ContentVersion.get()
+    return request._content_version
+
+
+# ETag / Last-Modified がリクエストのものと一致すれば 304 のレスポンスを返す (そうでなければ None)
+def not_modified(request, etag, last_modified):
+    response = get_conditional_response(request, etag=quote_etag(etag), last_modified=_timestamp(last_modified))
+    if response is not None and response.status_code == 304:
+        set_headers(response, etag, last_modified)
+    return response
+
+
+def set_headers(response, etag, last_modified):
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(_timestamp(last_modified))
+    return response
+
+
+# 一覧 (検索結果) の版: サイト全体の内容のバージョン, 検索条件 (URL) と閲覧者で決まる
+# 閲覧履歴での絞り込みは内容のバージョンに含まれないので対象外
+# django.views.decorators.http.condition に渡す
+def list_etag(request, *args, **kwargs):
+    if 'read' in request.GET.getlist('check'):
+        return None
+    return make_etag(content_version(request).version, request.get_full_path(), request.user.pk)
+
+
+def list_last_modified(request, *args, **kwargs):
+    if 'read' in request.GET.getlist('check'):
+        return None
+    return content_version(request).updated_at
@@ -7,6 +7,7 @@ def common_constants(request=None):
                     "input": "id_tag_input",
                     "selected_tags": "id_selected_tags",
                     "datalist": "id_tag_datalist",
+                    "template": "id_tag_template",
                 },
                 "name": {
                     "deselect_button": "name_deselect_tag_button",
@@ -29,6 +30,16 @@ def common_constants(request=None):
                     "form": "id_search_form",
                     "search_or_order": "id_search_or_order",
                     "result": "id_search_result",
+                    # 記事一覧の最初のページ (cms.api の JSON)
+                    "data": "id_search_data",
+                    # 分野・タグごとの記事数
+                    "facets": "id_search_facets",
+                },
+            },
+            "facet": {
+                "name": {
+                    "category": "name_facet_category_button",
+                    "tag": "name_facet_tag_button",
                 },
             },
             "paging": {
@@ -36,6 +47,11 @@ def common_constants(request=None):
                     "button": "name_paging_button",
                 }
             },
+            "order": {
+                "name": {
+                    "button": "name_order_button",
+                }
+            },
             "fav": {
                 "id": {
                     "info": "id_fav_info",
@@ -0,0 +1,136 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+
+from cms import bulk
+from cms.models import UserStats
+from users.models import User
+
+# 規模の大きいデータ (ユーザー・記事・分野・タグ・お気に入り・閲覧履歴) を生成する (generate_corpus コマンド)
+# 同じ seed と件数なら同じ内容になる (記事 ID などは既にある行に続けて採番される)
+# 執筆者・分野・タグ・お気に入りや閲覧履歴の対象は Zipf 分布 (k 番目の重みが 1 / k^s) で選ぶので,
+# 一部の人気の記事・タグや活発なユーザーに集中する. 人気の順位は ID の順とは無関係にする
+# 書き込みは cms.bulk の一括処理を通すので, お気に入り数・記事数・執筆者の統計は食い違わない
+
+# タイトルと本文に使う単語
+WORDS = (
+    'DFS', 'BFS', 'ダイクストラ法', 'ベルマンフォード法', 'ワーシャルフロイド法', 'クラスカル法', 'プリム法',
+    'Union-Find', 'セグメント木', 'BIT', '平衡二分探索木', 'ヒープ', 'スタック', 'キュー', '二分探索',
+    '尺取り法', '累積和', 'いもす法', '動的計画法', 'ナップサック問題', 'LIS', 'LCS', '編集距離', '区間DP',
+    'bitDP', '桁DP', '最大流', '最小費用流', '二部マッチング', '強連結成分分解', 'トポロジカルソート', 'LCA',
+    'オイラーツアー', '重軽分解', 'Z-algorithm', 'KMP法', 'ローリングハッシュ', 'Suffix Array', 'Trie',
+    'エラトステネスの篩', '拡張ユークリッドの互除法', '中国剰余定理', 'FFT', 'NTT', '行列累乗', '凸包',
+    '半分全列挙', '座標圧縮', '平方分割', 'Mo のアルゴリズム',
+)
+
+
+# items を先頭から人気の順として, k 番目を重み 1 / k^s で選ぶ
+class Zipf:
+    def __init__(self, items, s):
+        self.items = list(items)
+        self.cum_weights = []
+        total = 0.0
+        for k in range(1, len(self.items) + 1):
+            total += k ** -s
+            self.cum_weights.append(total)
+
+    def sample(self, rng, k):
+        return rng.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+
+# 順位を ID の順と無関係にしてから Zipf 分布にする
+def _zipf(rng, items, s):
+    items = list(items)
+    rng.shuffle(items)
+    return Zipf(items, s)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# 重複しない (記事 ID, ユーザー ID) の組を最大 count 個, batch_size 個以下ずつ返す
+# 人気の組ばかり選ばれて増えなくなった場合は count 個に達しなくても終える
+def _pairs(rng, articles, users, count, batch_size):
+    count = min(count, len(articles.items) * len(users.items))
+    seen = set()
+    attempts = 0
+    while len(seen) < count and attempts < count * 20:
+        n = min(batch_size, count - len(seen))
+        attempts += n
+        batch = []
+        for pair in zip(articles.sample(rng, n), users.sample(rng, n)):
+            if pair not in seen:
+                seen.add(pair)
+                batch.append(pair)
+        yield batch
+
+
+# ユーザーを作成し (既にいれば使い回し), ユーザー ID のリストを返す
+# パスワードは全員同じ (None ならログインできない)
+def create_users(usernames, password=None, batch_size=5000):
+    hashed = make_password(password)
+    user_ids = {}
+    for chunk in _chunks(usernames, batch_size):
+        User.objects.bulk_create(
+            [User(username=username, password=hashed) for username in chunk], ignore_conflicts=True)
+        user_ids.update(User.objects.filter(username__in=chunk).values_list('username', 'id'))
+    return [user_ids[username] for username in usernames]
+
+
+# データを生成し, 作成した件数の dict を返す. log には進み具合のメッセージを渡す
+def generate(users=10000, articles=500000, categories=50, tags=2000, favorites=1000000, reads=2000000,
+             max_tags=5, s=1.1, seed=0, prefix='corpus', password=None, batch_size=5000, log=None):
+    def progress(message):
+        if log is not None:
+            log(message)
+
+    rng = random.Random(seed)
+    created = dict(users=0, articles=0, favorites=0, reads=0)
+
+    user_ids = create_users([f'{prefix}{i}' for i in range(users)], password=password, batch_size=batch_size)
+    created['users'] = len(user_ids)
+    progress(f'ユーザー: {len(user_ids)} 人')
+    if not user_ids or articles <= 0:
+        return created
+
+    authors = _zipf(rng, user_ids, s)
+    category_names = _zipf(rng, [f'category{i}' for i in range(max(1, categories))], s)
+    tag_names = _zipf(rng, [f'tag{i}' for i in range(tags)], s) if tags > 0 else None
+    article_ids = []
+    for start in range(0, articles, batch_size):
+        rows = []
+        for i in range(start, min(start + batch_size, articles)):
+            words = rng.sample(WORDS, 3)
+            row_tags = []
+            if tag_names is not None:
+                for tag in tag_names.sample(rng, rng.randint(0, max_tags)):
+                    if tag not in row_tags:
+                        row_tags.append(tag)
+            sentence = f'{words[0]} を使って {words[1]} を高速化する. {words[2]} でも解ける.'
+            rows.append(dict(
+                title=f'{words[0]} と {words[1]} #{i}',
+                content=' '.join([sentence] * rng.randint(1, 5)),
+                category=category_names.sample(rng, 1)[0],
+                tags=row_tags,
+                author=authors.sample(rng, 1)[0],
+            ))
+        article_ids.extend(article.article_id for article in bulk.create_articles(rows, batch_size=batch_size))
+        progress(f'記事: {len(article_ids)} / {articles} 件')
+    created['articles'] = len(article_ids)
+
+    popular = _zipf(rng, article_ids, s)
+    active = _zipf(rng, user_ids, s)
+    for batch in _pairs(rng, popular, active, favorites, batch_size):
+        created['favorites'] += bulk.create_favorites(batch, batch_size=batch_size)
+    progress(f'お気に入り: {created["favorites"]} 件')
+    for batch in _pairs(rng, popular, active, reads, batch_size):
+        created['reads'] += bulk.create_reading_history(batch, batch_size=batch_size)
+    progress(f'閲覧履歴: {created["reads"]} 件')
+
+    # 一括で作成したユーザーには統計の行がまだないので作る
+    for chunk in _chunks(user_ids, batch_size):
+        UserStats.rebuild(chunk)
+    progress('ユーザーの統計を集計しました')
+    return created
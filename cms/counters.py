@@ -0,0 +1,128 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from cms import autocomplete
+from cms.buffers import fav_num_buffer
+
+
+# UPDATE ... RETURNING が使えるか (SQLite は 3.35 以降)
+def _can_return_from_update():
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35, 0)
+
+
+# 記事のお気に入り数を DB 上で delta だけ増減させ, 増減後の値を返す
+# 読み込んでから書き戻すことはしないので, 同時に更新されても増減が失われない
+def _update_fav_num(article_id, delta):
+    from cms.models import Article, ContentVersion, UserStats
+
+    # 執筆者の統計 (お気に入りされた数), 内容のバージョンと入力補完のタイトルの順位も更新する
+    UserStats.objects.filter(user__author__article=article_id).update(liked_num=F('liked_num') + delta)
+    ContentVersion.bump()
+    autocomplete.add_scores('title', {article_id: delta})
+    if not _can_return_from_update():
+        Article.objects.filter(pk=article_id).update(fav_num=F('fav_num') + delta)
+        return Article.objects.filter(pk=article_id).values_list('fav_num', flat=True).first()
+    opts = Article._meta
+    table = connection.ops.quote_name(opts.db_table)
+    column = connection.ops.quote_name(opts.get_field('fav_num').column)
+    pk = connection.ops.quote_name(opts.pk.column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {table} SET {column} = {column} + %s WHERE {pk} = %s RETURNING {column}',
+            [delta, article_id])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# お気に入り数を delta だけ増減させ, article.fav_num を増減後の値にする
+# FAV_NUM_BUFFER が有効な場合はメモリ上にためてまとめて反映する (article.fav_num は読み込んだ値に delta を足した値)
+def add_fav_num(article, delta):
+    if fav_num_buffer.enabled:
+        fav_num_buffer.add(article.pk, delta)
+        article.fav_num += delta
+    else:
+        article.fav_num = _update_fav_num(article.pk, delta)
+    return article.fav_num
+
+
+# 記事ごとのお気に入り数の増減 {記事 ID: 増減} を, 増減が同じ記事ごとに 1 回の UPDATE で反映する
+# 執筆者の統計 (お気に入りされた数), 内容のバージョンと入力補完のタイトルの順位も更新する
+def add_fav_nums(deltas):
+    from cms.models import Article, ContentVersion, UserStats
+
+    UserStats.add_liked_num(deltas)
+    ContentVersion.bump()
+    autocomplete.add_scores('title', deltas)
+    by_delta = {}
+    for article_id, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(article_id)
+    for delta, article_ids in by_delta.items():
+        for i in range(0, len(article_ids), 500):
+            Article.objects.filter(pk__in=article_ids[i:i + 500]).update(fav_num=F('fav_num') + delta)
+
+
+# 非正規化した数 (保存しておいた集計値) の定義
+# (名前, モデル, 列, 数える対象のモデル, 対象のモデルから見た外部キー)
+COUNTERS = (
+    ('Article.fav_num', 'Article', 'fav_num', 'Favorite', 'article'),
+    ('Category.article_num', 'Category', 'article_num', 'ArticleCategory', 'category'),
+    ('Tag.article_num', 'Tag', 'article_num', 'ArticleTags', 'tag'),
+)
+
+
+# 主キー順に chunk_size 件ずつの主キーのリストを返す
+def _chunks(model, chunk_size):
+    queryset = model.objects.order_by('pk').values_list('pk', flat=True)
+    last = None
+    while True:
+        chunk = list((queryset if last is None else queryset.filter(pk__gt=last))[:chunk_size])
+        if not chunk:
+            return
+        last = chunk[-1]
+        yield chunk
+
+
+# 1 種類の数を集計し直し, ずれている行を {主キー: (保存されていた値, 集計した値)} で返す
+# fix が真ならずれている行を直す. 直す UPDATE も集計をサブクエリで行うので, 途中の書き込みで再びずれることはない
+def reconcile(name, chunk_size=1000, fix=True):
+    from django.apps import apps
+
+    _, model_name, field, related_name, fk = next(counter for counter in COUNTERS if counter[0] == name)
+    model = apps.get_model('cms', model_name)
+    related = apps.get_model('cms', related_name)
+    drift = {}
+    for chunk in _chunks(model, chunk_size):
+        with transaction.atomic():
+            stored = dict(model.objects.filter(pk__in=chunk).values_list('pk', field))
+            actual = dict(related.objects.filter(**{f'{fk}__in': chunk}).order_by()
+                          .values(fk).annotate(n=Count('pk')).values_list(fk, 'n'))
+            drifted = {pk: (value, actual.get(pk, 0)) for pk, value in stored.items() if value != actual.get(pk, 0)}
+            if fix and drifted:
+                count = related.objects.filter(**{fk: OuterRef('pk')}).order_by()\
+                    .values(fk).annotate(n=Count('pk')).values('n')
+                model.objects.filter(pk__in=drifted).update(**{field: Coalesce(Subquery(count), 0)})
+        drift.update(drifted)
+    return drift
+
+
+# 執筆者の統計 (UserStats) を集計し直し, ずれている行を {ユーザー ID: (保存されていた値, 集計した値)} で返す
+# 値は UserStats.collect と同じ形. fix が真ならずれているユーザーの統計を作り直す
+def reconcile_user_stats(chunk_size=1000, fix=True):
+    from cms.models import UserStats
+
+    drift = {}
+    for chunk in _chunks(UserStats, chunk_size):
+        actual = UserStats.collect(chunk)
+        drifted = {
+            user_id: (stats, actual[user_id])
+            for user_id, stats in UserStats.load(chunk).items()
+            if stats != actual[user_id]
+        }
+        if fix and drifted:
+            UserStats.rebuild(list(drifted))
+        drift.update(drifted)
+    return drift
@@ -0,0 +1,92 @@
+import csv
+import io
+import json
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from cms.models import Article, ArticleTags
+
+# 記事を分野・タグ・執筆者・お気に入り数とともに JSONL / CSV で書き出す
+# 記事 ID 順に chunk_size 件ずつ取得するので, 記事数によらず使うメモリは一定
+# 項目は import_articles で読み込めるもの (title, content, category, tags, author) を含む
+
+FIELDS = ('article_id', 'title', 'content', 'category', 'tags', 'author', 'fav_num', 'created_at', 'updated_at')
+
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+# "2020-11-01" や "2020-11-01T12:00:00" を aware な日時にする (不正な場合は ValueError)
+def parse_since(value):
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'日時として読めません: {value}')
+        since = datetime.combine(date, time.min)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+# 書き出す記事を 1 件ずつ dict で返す. since を指定した場合はそれ以降に更新された記事のみ
+def iter_rows(since=None, chunk_size=1000):
+    queryset = Article.objects.order_by('article_id')
+    if since is not None:
+        queryset = queryset.filter(updated_at__gte=since)
+    queryset = queryset.values(
+        'article_id', 'title', 'content', 'fav_num', 'created_at', 'updated_at',
+        'articlecategory__category', 'author__user__username')
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(article_id__gt=last_id)[:chunk_size])
+        if not chunk:
+            return
+        last_id = chunk[-1]['article_id']
+        tags = {}
+        article_tags = ArticleTags.objects.filter(article_id__in=[row['article_id'] for row in chunk])\
+            .order_by('tag_id').values_list('article_id', 'tag_id')
+        for article_id, tag in article_tags:
+            tags.setdefault(article_id, []).append(tag)
+        for row in chunk:
+            row['category'] = row.pop('articlecategory__category')
+            row['author'] = row.pop('author__user__username')
+            row['tags'] = tags.get(row['article_id'], [])
+            row['created_at'] = row['created_at'].isoformat()
+            row['updated_at'] = row['updated_at'].isoformat()
+            yield {field: row[field] for field in FIELDS}
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+# タグは import_articles と同じく空白区切りにする
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    writer.writeheader()
+    yield flush()
+    for row in rows:
+        writer.writerow(dict(row, tags=' '.join(row['tags'])))
+        yield flush()
+
+
+# 形式 ("jsonl" / "csv") に応じて 1 行ずつの文字列を返す
+def lines(file_format, since=None, chunk_size=1000):
+    rows = iter_rows(since=since, chunk_size=chunk_size)
+    if file_format == 'csv':
+        return csv_lines(rows)
+    return jsonl_lines(rows)
@@ -69,14 +69,29 @@ class ArticleForm(forms.Form):
         Article(title=title, content=content).save()
 
 
+# タグ名の検証 (既に存在するかは確かめない)
+def validate_tag_name(tag):
+    if len(tag) == 0:
+        raise forms.ValidationError('タグ名は必須です')
+    if len(tag) > 15:
+        raise forms.ValidationError('タグ名は 15 文字以下にして下さい')
+
+
+# 分野名の検証 (既に存在するかは確かめない)
+def validate_category_name(category):
+    if len(category) == 0:
+        raise forms.ValidationError('カテゴリ名は必須です')
+    if len(category) > 15:
+        raise forms.ValidationError('カテゴリ名は 15 文字以下にして下さい')
+
+
 class TagForm(forms.Form):
     tag = forms.CharField(widget=forms.TextInput)
     model = Tag
 
     def clean_tag(self):
         tag = self.cleaned_data.get('tag').strip()
-        if len(tag) > 15:
-            raise forms.ValidationError('タグ名は 15 文字以下にして下さい')
+        validate_tag_name(tag)
         if Tag.exists(tag=tag):
             raise forms.ValidationError('このタグは既に存在します．')
         return tag
@@ -91,8 +106,7 @@ class CategoryForm(forms.Form):
 
     def clean_category(self):
         category = self.cleaned_data.get('category').strip()
-        if len(category) > 15:
-            raise forms.ValidationError('タグ名は 15 文字以下にして下さい')
+        validate_category_name(category)
         if Category.exists(category=category):
             raise forms.ValidationError('このカテゴリは既に存在します')
         return category
@@ -0,0 +1,131 @@
+import unicodedata
+
+from django.db import connection
+from django.db.models import FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+# 記事のタイトルと本文の全文検索 (SQLite FTS5)
+# 日本語は空白で単語が区切られないため, 文字 bigram に分割した文字列を索引に登録する
+FTS_TABLE = 'cms_article_fts'
+
+# 関連度 (bm25) を計算する際のタイトルと本文の重み
+TITLE_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+
+# FTS5 のテーブルが存在するか (DB ごとに 1 度だけ調べる)
+_available = {}
+
+
+# 全文検索の索引が使えるかどうか
+def available():
+    if connection.vendor != 'sqlite':
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _available[name] = cursor.fetchone() is not None
+    return _available[name]
+
+
+# 文字列を正規化し, 英数字 (漢字・かなを含む) が連続する区間ごとに区切る
+def _segments(text):
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    segment = []
+    for c in text:
+        if c.isalnum():
+            segment.append(c)
+        elif segment:
+            yield ''.join(segment)
+            segment = []
+    if segment:
+        yield ''.join(segment)
+
+
+def _bigrams(segment):
+    return [segment[i:i + 2] for i in range(len(segment) - 1)]
+
+
+# 索引に登録する文字列. 1 文字での検索に備えて各区間の末尾の文字も単独で入れる
+def tokenize(text):
+    tokens = []
+    for segment in _segments(text):
+        tokens.extend(_bigrams(segment))
+        tokens.append(segment[-1])
+    return ' '.join(tokens)
+
+
+# 検索文字列を MATCH 式に変換する. 各区間を bigram のフレーズにして AND で繋ぐ
+# 1 文字の区間はその文字で始まるトークンの前方一致にする
+def match_expression(query):
+    phrases = []
+    for segment in _segments(query):
+        if len(segment) == 1:
+            phrases.append(f'"{segment}"*')
+        else:
+            phrases.append('"' + ' '.join(_bigrams(segment)) + '"')
+    return ' AND '.join(phrases)
+
+
+# 記事を索引に登録 (既に登録済みなら置き換え)
+def index_articles(articles):
+    if not available():
+        return
+    rows = [(article.article_id, tokenize(article.title), tokenize(article.content)) for article in articles]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {FTS_TABLE} (rowid, title, content) VALUES (%s, %s, %s)', rows)
+
+
+# 記事を索引から削除
+def remove_articles(article_ids):
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in article_ids])
+
+
+# 索引を全て作り直す
+def rebuild(queryset, chunk_size=1000):
+    if not available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    count = 0
+    chunk = []
+    for article in queryset.only('article_id', 'title', 'content').iterator(chunk_size=chunk_size):
+        chunk.append(article)
+        if len(chunk) == chunk_size:
+            index_articles(chunk)
+            count += len(chunk)
+            chunk = []
+    index_articles(chunk)
+    return count + len(chunk)
+
+
+def _pk_column(queryset):
+    opts = queryset.model._meta
+    return f'{connection.ops.quote_name(opts.db_table)}.{connection.ops.quote_name(opts.pk.column)}'
+
+
+# タイトルか本文に検索文字列を含む記事に絞り込む
+def search(queryset, query):
+    expression = match_expression(query)
+    if not expression:
+        return queryset
+    if not available():
+        return queryset.filter(Q(title__icontains=query) | Q(content__icontains=query))
+    return queryset.filter(pk__in=RawSQL(
+        f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', (expression,)))
+
+
+# 関連度を search_rank として付与する (小さいほど関連度が高い)
+def rank(queryset, query):
+    expression = match_expression(query)
+    if not expression or not available():
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField()))
+    return queryset.annotate(search_rank=RawSQL(
+        f'SELECT bm25({FTS_TABLE}, %s, %s) FROM {FTS_TABLE} '
+        f'WHERE {FTS_TABLE} MATCH %s AND rowid = {_pk_column(queryset)}',
+        (TITLE_WEIGHT, CONTENT_WEIGHT, expression),
+        output_field=FloatField()))
@@ -0,0 +1,82 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cms import benchmark
+
+
+# cms.urls の全てのルートの応答時間を計測し, JSON で書き出す. --compare で 2 回の結果を比べる
+# DB に書き込むルート (記事の作成・編集・削除, お気に入り) も実行するので, 本番の DB では --skip-writes を付ける
+class Command(BaseCommand):
+    help = '全てのルートの応答時間 (p50/p95/p99), スループット, クエリ数を計測する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='ルートごとのリクエスト数')
+        parser.add_argument('--warmup', type=int, default=5, help='計測前にルートごとに送るリクエスト数')
+        parser.add_argument('--routes', nargs='+', choices=sorted(benchmark.SCENARIOS), help='計測するルート (省略すると全て)')
+        parser.add_argument('--skip-writes', action='store_true', help='DB に書き込むルートを除く')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--live', metavar='URL', help='起動中のサーバー (例: http://127.0.0.1:8000) に HTTP で送る')
+        parser.add_argument('--concurrency', type=int, default=1, help='--live で同時に送るリクエスト数')
+        parser.add_argument('--output', '-o', help='結果の JSON を書き出すファイル (省略すると標準出力)')
+        parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='2 回の結果の JSON を比べる')
+        parser.add_argument('--threshold', type=float, default=0.1, help='悪化とみなす p95 の増加の割合')
+        parser.add_argument('--min-ms', type=float, default=1.0, help='悪化とみなす p95 の増加の最小値 (ミリ秒)')
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            return self.compare(*options['compare'], options['threshold'], options['min_ms'])
+        if options['requests'] < 1:
+            raise CommandError('--requests は 1 以上にしてください')
+        if options['concurrency'] < 1 or (options['concurrency'] > 1 and not options['live']):
+            raise CommandError('--concurrency は 1 以上にし, 2 以上は --live と一緒に指定してください')
+        try:
+            result = benchmark.run(
+                routes=options['routes'], count=options['requests'], warmup=options['warmup'], seed=options['seed'],
+                skip_writes=options['skip_writes'], base_url=options['live'], concurrency=options['concurrency'])
+        except ValueError as e:
+            raise CommandError(e)
+        text = json.dumps(result, ensure_ascii=False, indent=2)
+        if options['output'] is None:
+            self.stdout.write(text)
+            return
+        with open(options['output'], 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+        for route, stats in result['routes'].items():
+            self.stdout.write(f'{route:20} {self.format(stats)}')
+        self.stdout.write(f'{"total":20} {self.format(result["total"])}')
+        self.stdout.write(self.style.SUCCESS(f'{options["output"]} に書き出しました'))
+
+    @staticmethod
+    def format(stats):
+        if stats is None:
+            return '-'
+        def number(value, spec):
+            return '-' if value is None else format(value, spec)
+
+        return (f'p50 {stats["p50_ms"]:8.2f} ms  p95 {stats["p95_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms  '
+                f'{number(stats["throughput_rps"], "8.1f")} req/s  '
+                f'{number(stats["queries_per_request"], ".1f")} queries  errors {stats["errors"]}')
+
+    def compare(self, base_path, new_path, threshold, min_ms):
+        results = []
+        for path in (base_path, new_path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    results.append(json.load(file))
+            except (OSError, ValueError) as e:
+                raise CommandError(f'{path} を読めません: {e}')
+        base, new = (result['meta'] for result in results)
+        if (base['mode'], base.get('concurrency')) != (new['mode'], new.get('concurrency')):
+            self.stdout.write(self.style.WARNING(
+                f'計測方法が異なります ({base["mode"]} x{base.get("concurrency")} と {new["mode"]} x{new.get("concurrency")})'))
+        rows, regressions = benchmark.compare(*results, threshold=threshold, min_ms=min_ms)
+        for row in rows:
+            self.stdout.write(row['route'])
+            self.stdout.write(f'  base: {self.format(row["base"])}')
+            self.stdout.write(f'  new:  {self.format(row["new"])}')
+            for reason in row['reasons']:
+                self.stdout.write(self.style.ERROR(f'  悪化: {reason}'))
+        if regressions:
+            raise CommandError(f'{len(regressions)} 件のルートが悪化しました: {", ".join(regressions)}')
+        self.stdout.write(self.style.SUCCESS('悪化したルートはありません'))
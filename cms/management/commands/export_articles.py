@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cms import export
+
+
+# 記事を分野・タグ・執筆者・お気に入り数とともに JSONL / CSV で書き出す
+class Command(BaseCommand):
+    help = '記事を JSONL / CSV で書き出す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(export.FORMATS), default='jsonl')
+        parser.add_argument('--since', help='この日時以降に更新された記事のみ書き出す (例: 2020-11-01T00:00:00)')
+        parser.add_argument('--output', '-o', help='書き出すファイル (省略すると標準出力)')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = export.parse_since(options['since'])
+            except ValueError as e:
+                raise CommandError(e)
+        lines = export.lines(options['format'], since=since, chunk_size=options['chunk_size'])
+        if options['output'] is None:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        count = 0
+        with open(options['output'], 'w', encoding='utf-8', newline='') as file:
+            for line in lines:
+                file.write(line)
+                count += 1
+        if options['format'] == 'csv':
+            count -= 1
+        self.stdout.write(self.style.SUCCESS(f'{count} 件の記事を書き出しました'))
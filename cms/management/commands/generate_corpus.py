@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cms import corpus
+
+
+# 規模の大きいデータを生成する (負荷の確認用). 同じ --seed と件数なら同じ内容になる
+class Command(BaseCommand):
+    help = 'ユーザー・記事・タグ・お気に入り・閲覧履歴を大量に生成する (負荷の確認用)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--articles', type=int, default=500000)
+        parser.add_argument('--categories', type=int, default=50)
+        parser.add_argument('--tags', type=int, default=2000)
+        parser.add_argument('--favorites', type=int, default=1000000)
+        parser.add_argument('--reads', type=int, default=2000000, help='閲覧履歴の件数')
+        parser.add_argument('--max-tags', type=int, default=5, help='1 記事あたりのタグの数の上限')
+        parser.add_argument('--zipf', type=float, default=1.1, help='Zipf 分布の指数 (大きいほど人気が偏る)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='corpus', help='ユーザー名の接頭辞 (<prefix><番号>)')
+        parser.add_argument('--password', help='全ユーザーのパスワード (省略するとログインできない)')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        for name in ('users', 'articles', 'categories', 'tags', 'favorites', 'reads', 'max_tags'):
+            if options[name] < 0:
+                raise CommandError(f'--{name.replace("_", "-")} は 0 以上にしてください')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size は 1 以上にしてください')
+        if options['zipf'] <= 0:
+            raise CommandError('--zipf は正の数にしてください')
+        created = corpus.generate(
+            users=options['users'], articles=options['articles'], categories=options['categories'],
+            tags=options['tags'], favorites=options['favorites'], reads=options['reads'],
+            max_tags=options['max_tags'], s=options['zipf'], seed=options['seed'], prefix=options['prefix'],
+            password=options['password'], batch_size=options['batch_size'],
+            log=self.stdout.write if options['verbosity'] >= 1 else None)
+        self.stdout.write(self.style.SUCCESS(
+            f'ユーザー {created["users"]} 人, 記事 {created["articles"]} 件, お気に入り {created["favorites"]} 件, '
+            f'閲覧履歴 {created["reads"]} 件を生成しました'))
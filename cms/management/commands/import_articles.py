@@ -0,0 +1,91 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cms import bulk
+from users.models import User
+
+
+# JSONL / CSV のファイルから記事をまとめて登録する
+# 1 行 1 記事で, 項目は title, content, category, tags, author (執筆者のユーザー名)
+# JSONL の tags はリスト, CSV の tags は空白区切り. ファイルは先頭から順に読み, batch_size 件ごとに登録する
+class Command(BaseCommand):
+    help = 'JSONL / CSV のファイルから記事をまとめて登録する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル ("-" で標準入力)')
+        parser.add_argument('--format', choices=['jsonl', 'csv'], help='ファイル形式 (省略すると拡張子で判定)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size は 1 以上にしてください')
+        self.user_ids = {}
+        self.skipped = 0
+        created = 0
+        batch = []
+        if path == '-':
+            file = sys.stdin
+        else:
+            try:
+                file = open(path, encoding='utf-8', newline='')
+            except OSError as e:
+                raise CommandError(f'{path} を開けません: {e}')
+        with file:
+            for line_number, data in self.read(file, file_format):
+                try:
+                    batch.append((line_number, bulk.clean_row(data)))
+                except ValueError as e:
+                    self.skip(line_number, e)
+                if len(batch) == batch_size:
+                    created += self.create(batch)
+                    batch = []
+            created += self.create(batch)
+        self.stdout.write(self.style.SUCCESS(f'{created} 件の記事を登録しました (スキップ: {self.skipped} 件)'))
+
+    # (行番号, 1 行分の dict) を順に返す
+    def read(self, file, file_format):
+        if file_format == 'csv':
+            reader = csv.DictReader(file)
+            for data in reader:
+                yield reader.line_num, data
+            return
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                self.skip(line_number, f'JSON として読めません ({e})')
+                continue
+            if not isinstance(data, dict):
+                self.skip(line_number, 'JSON オブジェクトではありません')
+                continue
+            yield line_number, data
+
+    def skip(self, line_number, reason):
+        self.skipped += 1
+        self.stderr.write(f'{line_number} 行目をスキップしました: {reason}')
+
+    # 執筆者をまとめて取得し, 1 バッチ分の記事を登録して登録した件数を返す
+    def create(self, batch):
+        usernames = {row['author'] for _, row in batch if row['author'] not in self.user_ids}
+        if usernames:
+            self.user_ids.update(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+            for username in usernames:
+                self.user_ids.setdefault(username, None)
+        rows = []
+        for line_number, row in batch:
+            user_id = self.user_ids.get(row['author'])
+            if user_id is None:
+                self.skip(line_number, f'ユーザー {row["author"]} は存在しません')
+                continue
+            row['author'] = user_id
+            rows.append(row)
+        bulk.create_articles(rows)
+        return len(rows)
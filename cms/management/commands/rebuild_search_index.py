@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cms import fulltext
+from cms.models import Article
+
+
+# 全文検索の索引を作り直す
+class Command(BaseCommand):
+    help = '記事の全文検索の索引を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not fulltext.available():
+            raise CommandError('全文検索の索引 (FTS5) が利用できません')
+        with transaction.atomic():
+            count = fulltext.rebuild(Article.objects.all(), chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{count} 件の記事を索引に登録しました'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from cms.models import UserStats
+
+
+# ユーザーページの統計 (UserStats) を集計し直す
+class Command(BaseCommand):
+    help = 'ユーザーページの統計を集計し直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int, help='集計し直すユーザーの ID (省略すると全ユーザー)')
+
+    def handle(self, *args, **options):
+        count = UserStats.rebuild(options['user_ids'] or None)
+        self.stdout.write(self.style.SUCCESS(f'{count} 人のユーザーの統計を集計しました'))
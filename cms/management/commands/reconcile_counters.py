@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from cms import counters
+
+
+# お気に入り数・分野やタグの記事数・執筆者の統計を集計し直し, ずれを報告して直す
+class Command(BaseCommand):
+    help = '保存しておいた数 (お気に入り数・記事数・ユーザーの統計) のずれを検出して直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='ずれを報告するだけで直さない')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        fix = not options['dry_run']
+        chunk_size = options['chunk_size']
+        total = 0
+        for name, *_ in counters.COUNTERS:
+            total += self.report(name, counters.reconcile(name, chunk_size=chunk_size, fix=fix), options)
+        total += self.report('UserStats', counters.reconcile_user_stats(chunk_size=chunk_size, fix=fix), options)
+        if total == 0:
+            self.stdout.write(self.style.SUCCESS('ずれはありませんでした'))
+        elif fix:
+            self.stdout.write(self.style.SUCCESS(f'{total} 件のずれを直しました'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{total} 件のずれがあります (--dry-run のため直していません)'))
+
+    def report(self, name, drift, options):
+        if drift:
+            self.stdout.write(f'{name}: {len(drift)} 件のずれ')
+            # 詳細は -v 2 以上で表示する
+            if options['verbosity'] >= 2:
+                for pk, (stored, actual) in sorted(drift.items()):
+                    self.stdout.write(f'  {pk}: {stored} -> {actual}')
+        return len(drift)
@@ -0,0 +1,235 @@
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# リクエストごとのクエリ数・DB の時間・テンプレートの描画時間・処理時間をビューごとのヒストグラムに集計する
+# (cms.middleware.MetricsMiddleware が記録し, metrics のビューが Prometheus のテキスト形式で返す)
+# ヒストグラムは区間の数が固定なので, リクエスト数によらず使うメモリは一定 (プロセスごとの集計)
+# ビューごとに最も遅いクエリを SLOW_QUERIES 件覚えておき, 新しく入ったものをログに出す
+# (SLOW_QUERY_MIN_DURATION 秒未満のクエリは数えない)
+# ほかにキャッシュのヒット数などのカウンター (COUNTERS) も返す
+
+# (名前, 説明, 区間の上限)
+HISTOGRAMS = (
+    ('algopedia_request_duration_seconds', 'リクエストの処理時間 (秒)',
+     (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)),
+    ('algopedia_db_queries', '1 リクエストあたりのクエリ数',
+     (0, 1, 2, 3, 5, 10, 20, 50, 100)),
+    ('algopedia_db_duration_seconds', '1 リクエストあたりのクエリの合計時間 (秒)',
+     (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)),
+    ('algopedia_template_duration_seconds', '1 リクエストあたりのテンプレートの描画時間 (秒)',
+     (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)),
+)
+
+# (名前, 説明) のカウンター (プロセスごとの累計. increment で増やす)
+COUNTERS = (
+    ('algopedia_search_cache_hits_total', '検索結果のキャッシュにあった検索の数'),
+    ('algopedia_search_cache_misses_total', '検索結果のキャッシュになかった検索の数'),
+)
+
+# URL に対応するビューがなかったリクエスト (404 など)
+UNRESOLVED = '<unresolved>'
+
+
+def _setting(key, default):
+    return getattr(settings, 'METRICS', {}).get(key, default)
+
+
+def enabled():
+    return _setting('ENABLED', False)
+
+
+# 区間ごとの件数 (累積ではない), 合計, 件数を持つヒストグラム
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # 最後の要素は上限を超えたもの (+Inf)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # (上限, 累積件数) を返す. 上限の最後は '+Inf'
+    def buckets(self):
+        total = 0
+        for bound, count in zip(list(self.bounds) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+# 1 リクエストの間に記録する値
+class RequestMetrics:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        # (時間, SQL) のリスト
+        self.queries = []
+        self.template_time = 0.0
+
+    # クエリの時間を測る (record_query から呼ぶ)
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - start, sql))
+
+
+_lock = threading.Lock()
+# ビュー名 -> {ヒストグラムの名前: Histogram}
+_histograms = {}
+# ビュー名 -> 遅いクエリ (時間, SQL) のヒープ
+_slow_queries = {}
+# カウンターの名前 -> 値
+_counters = {}
+# 処理中のリクエストの RequestMetrics (スレッドごと. 非同期の処理ではコルーチンごと)
+_local = Local()
+
+
+def current():
+    return getattr(_local, 'metrics', None)
+
+
+def start_request():
+    _local.metrics = RequestMetrics()
+    return _local.metrics
+
+
+# 全てのスレッドの接続に入れる execute_wrapper. 処理中のリクエストがあれば, そのクエリとして記録する
+# (ASGI で同期のビューを実行するスレッドや cms.asyncdb のスレッドでも数えるため, 接続ごとに入れておく)
+def record_query(execute, sql, params, many, context):
+    request_metrics = current()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    return request_metrics.record_query(execute, sql, params, many, context)
+
+
+# connection_created のシグナルを受け取って, 新しい接続に record_query を入れる
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, record_query)
+
+
+# このスレッドでの処理中のリクエストを request_metrics にする
+# (cms.asyncdb が, 非同期のビューから別のスレッドで実行する処理に使う)
+@contextmanager
+def recording(request_metrics):
+    if request_metrics is None:
+        yield
+        return
+    previous = current()
+    _local.metrics = request_metrics
+    try:
+        yield
+    finally:
+        _local.metrics = previous
+
+
+# テンプレートの描画時間を処理中のリクエストに加える
+def add_template_time(seconds):
+    metrics = current()
+    if metrics is not None:
+        metrics.template_time += seconds
+
+
+# 処理中のリクエストの値をビュー view の集計に加える
+def finish_request(view):
+    metrics, _local.metrics = current(), None
+    if metrics is None:
+        return
+    values = (
+        time.perf_counter() - metrics.started_at,
+        len(metrics.queries),
+        sum(seconds for seconds, _ in metrics.queries),
+        metrics.template_time,
+    )
+    limit = _setting('SLOW_QUERIES', 5)
+    min_duration = _setting('SLOW_QUERY_MIN_DURATION', 0.01)
+    slow = []
+    with _lock:
+        histograms = _histograms.get(view)
+        if histograms is None:
+            histograms = _histograms[view] = {name: Histogram(bounds) for name, _, bounds in HISTOGRAMS}
+        for (name, _, _), value in zip(HISTOGRAMS, values):
+            histograms[name].observe(value)
+        heap = _slow_queries.setdefault(view, [])
+        for query in metrics.queries:
+            if query[0] < min_duration:
+                continue
+            if len(heap) < limit:
+                heapq.heappush(heap, query)
+            elif limit and query > heap[0]:
+                heapq.heapreplace(heap, query)
+            else:
+                continue
+            slow.append(query)
+    for seconds, sql in slow:
+        logger.info('slow query in %s (%.1f ms): %s', view, seconds * 1000, sql)
+
+
+# ビュー view の遅いクエリ (時間, SQL) を遅い順に返す
+def slow_queries(view):
+    with _lock:
+        return sorted(_slow_queries.get(view, []), reverse=True)
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _slow_queries.clear()
+        _counters.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus のテキスト形式 (0.0.4) で返す
+def render():
+    with _lock:
+        views = sorted(_histograms.items())
+        lines = []
+        for name, help_text, _ in HISTOGRAMS:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for view, histograms in views:
+                histogram = histograms[name]
+                label = f'view="{_escape(view)}"'
+                for bound, count in histogram.buckets():
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{{label}}} {_format(histogram.sum)}')
+                lines.append(f'{name}_count{{{label}}} {histogram.count}')
+        for name, help_text in COUNTERS:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {_counters.get(name, 0)}')
+    return '\n'.join(lines) + '\n'
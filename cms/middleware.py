@@ -0,0 +1,42 @@
+import asyncio
+
+from cms import metrics
+
+
+# リクエストごとのクエリ数・DB の時間・テンプレートの描画時間・処理時間を記録する (cms.metrics)
+# 処理時間に他のミドルウェアも含めるように, MIDDLEWARE の先頭に置く
+# ASGI では非同期で動く (同期のミドルウェアだと, 全てのリクエストが 1 つのスレッドを順番に待つことになる)
+# クエリはどのスレッドで実行されても, 接続ごとに入れた metrics.record_query が処理中のリクエストに記録する
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # 非同期のミドルウェアとして扱わせる (django.utils.deprecation.MiddlewareMixin と同じ方法)
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not metrics.enabled():
+            return self.get_response(request)
+        metrics.start_request()
+        try:
+            return self.get_response(request)
+        finally:
+            self.finish(request)
+
+    async def __acall__(self, request):
+        if not metrics.enabled():
+            return await self.get_response(request)
+        metrics.start_request()
+        try:
+            return await self.get_response(request)
+        finally:
+            self.finish(request)
+
+    def finish(self, request):
+        resolver_match = getattr(request, 'resolver_match', None)
+        metrics.finish_request(resolver_match.view_name if resolver_match else metrics.UNRESOLVED)
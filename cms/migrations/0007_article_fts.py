@@ -0,0 +1,82 @@
+import unicodedata
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# このマイグレーションを書いた時点の cms.fulltext のテーブル名と分割方法
+# (後で cms.fulltext を変えても, このマイグレーションの結果が変わらないように複製しておく)
+FTS_TABLE = 'cms_article_fts'
+
+# 1 回の executemany で登録する記事の数
+BATCH_SIZE = 1000
+
+
+def _segments(text):
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    segment = []
+    for c in text:
+        if c.isalnum():
+            segment.append(c)
+        elif segment:
+            yield ''.join(segment)
+            segment = []
+    if segment:
+        yield ''.join(segment)
+
+
+def _tokenize(text):
+    tokens = []
+    for segment in _segments(text):
+        tokens.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+        tokens.append(segment[-1])
+    return ' '.join(tokens)
+
+
+# 実行中のプロセスが覚えている, 索引が使えるかどうかの判定を捨てる
+def _clear_available():
+    from cms import fulltext
+
+    fulltext._available.clear()
+
+
+# 全文検索用の FTS5 仮想テーブルを作成し, 既存の記事を登録する
+# SQLite 以外, もしくは FTS5 が使えない SQLite では何もしない (LIKE 検索にフォールバック)
+# 記事は全件をメモリに載せず, BATCH_SIZE 件ずつ読んで登録する
+def create_fts_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(title, content, tokenize = 'ascii')")
+    except OperationalError:
+        return
+    Article = apps.get_model('cms', 'Article')
+    articles = Article.objects.values_list('article_id', 'title', 'content').iterator(chunk_size=BATCH_SIZE)
+    rows = []
+    with connection.cursor() as cursor:
+        for article_id, title, content in articles:
+            rows.append((article_id, _tokenize(title), _tokenize(content)))
+            if len(rows) >= BATCH_SIZE:
+                cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, title, content) VALUES (%s, %s, %s)', rows)
+                rows = []
+        if rows:
+            cursor.executemany(f'INSERT INTO {FTS_TABLE} (rowid, title, content) VALUES (%s, %s, %s)', rows)
+    _clear_available()
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    _clear_available()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cms', '0006_auto_20201106_2351'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+        ('cms', '0007_article_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='users.user')),
+                ('liked_num', models.IntegerField(default=0)),
+                ('article_num', models.IntegerField(default=0)),
+                ('category_counts', models.TextField(default='{}')),
+                ('tag_counts', models.TextField(default='{}')),
+            ],
+            options={
+                'verbose_name_plural': 'ユーザー統計',
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cms', '0009_contentversion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='favorite',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='readinghistory',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['fav_num', 'article_id'], name='article_fav_num_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['updated_at', 'article_id'], name='article_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['title', 'article_id'], name='article_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='articlecategory',
+            index=models.Index(fields=['category', 'article'], name='articlecategory_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='articletags',
+            index=models.Index(fields=['tag', 'article'], name='articletags_tag_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['user', 'article'], name='favorite_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='readinghistory',
+            index=models.Index(fields=['user', 'article'], name='readinghistory_user_idx'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 3.1.14 on 2026-10-18 19:18
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# JSON で持っていた分野別・タグ別の記事数を 1 行 1 (ユーザー, 名前) の行に移す
+def copy_counts_to_rows(apps, schema_editor):
+    UserStats = apps.get_model('cms', 'UserStats')
+    UserCategoryCount = apps.get_model('cms', 'UserCategoryCount')
+    UserTagCount = apps.get_model('cms', 'UserTagCount')
+    categories = []
+    tags = []
+    for user_id, category_counts, tag_counts in UserStats.objects.values_list('pk', 'category_counts', 'tag_counts').iterator():
+        categories += [UserCategoryCount(user_id=user_id, category=name, article_num=n)
+                       for name, n in json.loads(category_counts).items()]
+        tags += [UserTagCount(user_id=user_id, tag=name, article_num=n) for name, n in json.loads(tag_counts).items()]
+    UserCategoryCount.objects.bulk_create(categories, batch_size=500)
+    UserTagCount.objects.bulk_create(tags, batch_size=500)
+
+
+def copy_rows_to_counts(apps, schema_editor):
+    UserStats = apps.get_model('cms', 'UserStats')
+    for model, field, column in (('UserCategoryCount', 'category', 'category_counts'), ('UserTagCount', 'tag', 'tag_counts')):
+        counts = {}
+        for user_id, name, n in apps.get_model('cms', model).objects.filter(article_num__gt=0)\
+                .values_list('user_id', field, 'article_num').iterator():
+            counts.setdefault(user_id, {})[name] = n
+        for user_id, user_counts in counts.items():
+            UserStats.objects.filter(pk=user_id).update(**{column: json.dumps(user_counts, ensure_ascii=False, sort_keys=True)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cms', '0010_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserTagCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tag', models.CharField(max_length=15)),
+                ('article_num', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'ユーザーのタグ別の記事数',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserCategoryCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=15)),
+                ('article_num', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'ユーザーの分野別の記事数',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='usertagcount',
+            constraint=models.UniqueConstraint(fields=('user', 'tag'), name='unique_user_tag'),
+        ),
+        migrations.AddConstraint(
+            model_name='usercategorycount',
+            constraint=models.UniqueConstraint(fields=('user', 'category'), name='unique_user_category'),
+        ),
+        migrations.RunPython(copy_counts_to_rows, copy_rows_to_counts),
+        migrations.RemoveField(
+            model_name='userstats',
+            name='category_counts',
+        ),
+        migrations.RemoveField(
+            model_name='userstats',
+            name='tag_counts',
+        ),
+    ]
@@ -1,10 +1,31 @@
+import threading
+
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count, F, Sum, Value
+from django.utils import timezone
+
+from cms import autocomplete, counters, fulltext, pagecache, tagindex
+from cms.buffers import reading_history_buffer
 
 
 # Create your models here.
 
 
+class ArticleQuerySet(models.QuerySet):
+    # 一覧表示に使う執筆者・分野・タグをまとめて取得する (クエリ数は記事数によらず一定)
+    def for_list(self):
+        return self.select_related('author__user', 'articlecategory__category')\
+            .prefetch_related(models.Prefetch('articletags_set', queryset=ArticleTags.objects.order_by('tag_id')))
+
+    # 一覧の JSON (cms.api) に使う列だけを取得する (本文や執筆者のパスワードなどは読まない)
+    def for_rows(self):
+        return self.select_related('author__user', 'articlecategory')\
+            .only('article_id', 'title', 'fav_num', 'updated_at', 'author__user__username', 'articlecategory__category')\
+            .prefetch_related(models.Prefetch(
+                'articletags_set', queryset=ArticleTags.objects.only('article', 'tag').order_by('tag_id')))
+
+
 class Article(models.Model):
     # 記事 ID
     article_id = models.AutoField(primary_key=True)
@@ -19,23 +40,43 @@ class Article(models.Model):
     # 更新日時
     updated_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ArticleQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "記事"
+        # 一覧の並び替え (keyset ページングなので主キーとの組) に使う
+        indexes = [
+            models.Index(fields=['fav_num', 'article_id'], name='article_fav_num_idx'),
+            models.Index(fields=['updated_at', 'article_id'], name='article_updated_at_idx'),
+            models.Index(fields=['title', 'article_id'], name='article_title_idx'),
+        ]
 
     def __str__(self):
         return f"{self.article_id} {self.title}"
 
+    def save(self, **kwargs):
+        super(Article, self).save(**kwargs)
+        # タイトルか本文が更新された場合は全文検索の索引も更新する
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'title', 'content'} & set(update_fields):
+            fulltext.index_articles([self])
+        pagecache.invalidate_article(self.article_id)
+        ContentVersion.bump()
+
+    # タグ付け・分野・執筆者などとともに削除し, 記事数や統計を減らす (cms.bulk.delete_articles)
     def delete(self, **kwargs):
-        for article_tag in self.articletags_set.all():
-            article_tag.delete()
-        self.articlecategory.delete()
-        super(Article, self).delete(**kwargs)
+        from cms import bulk
+
+        deleted = bulk.delete_articles([self.article_id])
+        self.article_id = None
+        return deleted, {Article._meta.label: deleted}
 
     def get_tags(self):
         return Tag.objects.filter(articletags__article=self).distinct()
 
+    # for_list() で取得した記事ならばクエリを発行しない
     def get_tag_names(self):
-        return self.get_tags().values_list('tag', flat=True)
+        return sorted(article_tag.tag_id for article_tag in self.articletags_set.all())
 
     @staticmethod
     def get_or_none(article_id):
@@ -50,29 +91,31 @@ class Favorite(models.Model):
     # 記事 ID (外部キー)
     article = models.ForeignKey(Article, on_delete=models.CASCADE, db_index=False)
     # ユーザー ID (外部キー)
-    user = models.ForeignKey(to='users.User', on_delete=models.CASCADE, db_index=True)
+    user = models.ForeignKey(to='users.User', on_delete=models.CASCADE, db_index=False)
 
     # お気に入りは重複しない
+    # 記事からの検索は一意制約の索引, ユーザーからの検索 (お気に入りした記事) は (user, article) の索引を使う
     class Meta:
         verbose_name_plural = "お気に入り"
         constraints = [
             models.UniqueConstraint(fields=['article', 'user'], name='unique_fav')
         ]
+        indexes = [
+            models.Index(fields=['user', 'article'], name='favorite_user_idx'),
+        ]
 
     def __str__(self):
         return f"{self.article} {self.user}"
 
     def save(self, **kwargs):
-        article = Article.objects.get(article_id=self.article.article_id)
-        article.fav_num += 1
-        article.save()
+        adding = self._state.adding
         super(Favorite, self).save(**kwargs)
+        if adding:
+            counters.add_fav_num(self.article, 1)
 
     def delete(self, **kwargs):
-        article = Article.objects.get(article_id=self.article.article_id)
-        article.fav_num -= 1
-        article.save()
         super(Favorite, self).delete(**kwargs)
+        counters.add_fav_num(self.article, -1)
 
     @staticmethod
     def get_or_none(article, user):
@@ -82,15 +125,21 @@ class Favorite(models.Model):
     def exists(article, user):
         return Favorite.get_or_none(article=article, user=user) is not None
 
+    # お気に入りを登録 / 解除し, 登録したかどうかを返す. article.fav_num は更新後の値になる
     @staticmethod
     def create_or_delete(article, user):
-        fav = Favorite.get_or_none(article=article, user=user)
-        if fav is None:
-            Favorite(article=article, user=user).save()
-            return True
-        else:
-            fav.delete()
+        # 解除できなければ (お気に入りしていなければ) 登録する
+        deleted, _ = Favorite.objects.filter(article=article, user=user).delete()
+        if deleted:
+            counters.add_fav_num(article, -deleted)
             return False
+        try:
+            with transaction.atomic():
+                Favorite(article=article, user=user).save()
+        except IntegrityError:
+            # 同時に登録された
+            pass
+        return True
 
 
 class Author(models.Model):
@@ -105,24 +154,48 @@ class Author(models.Model):
     def __str__(self):
         return f"{self.article} {self.user}"
 
+    def save(self, **kwargs):
+        adding = self._state.adding
+        super(Author, self).save(**kwargs)
+        if adding:
+            # 既に付いている分野・タグ・お気に入りを執筆者の統計に加える
+            article = Article.objects.filter(pk=self.article_id)\
+                .values('fav_num', 'articlecategory__category').first()
+            categories = {article['articlecategory__category']: 1} if article['articlecategory__category'] else {}
+            tags = {tag: 1 for tag in ArticleTags.objects.filter(article_id=self.article_id).values_list('tag_id', flat=True)}
+            UserStats.add(self.user_id, liked_num=article['fav_num'], article_num=1, categories=categories, tags=tags)
+
 
 class ReadingHistory(models.Model):
     # 記事 ID (外部キー)
     article = models.ForeignKey(Article, on_delete=models.CASCADE, db_index=False)
     # ユーザー ID (外部キー)
-    user = models.ForeignKey(to='users.User', on_delete=models.DO_NOTHING, db_index=True)
+    user = models.ForeignKey(to='users.User', on_delete=models.DO_NOTHING, db_index=False)
     # 更新日時
     updated_at = models.DateTimeField(auto_now=True)
 
+    # 記事からの検索は一意制約の索引, ユーザーからの検索 (閲覧した記事) は (user, article) の索引を使う
     class Meta:
         verbose_name_plural = "閲覧履歴"
         constraints = [
             models.UniqueConstraint(fields=['article', 'user'], name='unique_readinghistory')
         ]
+        indexes = [
+            models.Index(fields=['user', 'article'], name='readinghistory_user_idx'),
+        ]
 
     def __str__(self):
         return f"{self.article} {self.user} {self.updated_at}"
 
+    # 閲覧履歴を記録する (なければ挿入)
+    # READING_HISTORY_BUFFER が有効な場合はメモリ上にためて, まとめて反映する
+    @staticmethod
+    def record(article, user):
+        if reading_history_buffer.enabled:
+            reading_history_buffer.add((user.pk, article.pk), timezone.now())
+        else:
+            ReadingHistory.objects.update_or_create(article=article, user=user)
+
 
 class Category(models.Model):
     # 大分類
@@ -172,22 +245,43 @@ class ArticleCategory(models.Model):
     # 大分類 (外部キー)
     category = models.ForeignKey(Category, on_delete=models.DO_NOTHING, db_index=False)
 
+    # 分野での絞り込みに使う
     class Meta:
         verbose_name_plural = "記事分類"
+        indexes = [
+            models.Index(fields=['category', 'article'], name='articlecategory_category_idx'),
+        ]
 
     def __str__(self):
         return f"{self.article} {self.category}"
 
     def save(self, **kwargs):
-        category = self.category
-        category.article_num += 1
-        category.save()
+        # 分野が変更された場合は変更前の分野の記事数を減らす
+        old_category_id = None
+        if not self._state.adding:
+            old_category_id = ArticleCategory.objects.filter(pk=self.pk).values_list('category_id', flat=True).first()
+        if old_category_id != self.category_id:
+            categories = {self.category_id: 1}
+            if old_category_id is not None:
+                Category.objects.filter(pk=old_category_id).update(article_num=F('article_num') - 1)
+                categories[old_category_id] = -1
+            Category.objects.filter(pk=self.category_id).update(article_num=F('article_num') + 1)
+            autocomplete.add_scores('category', categories)
+            UserStats.add_for_article(self.article_id, categories=categories)
+            pagecache.invalidate_article(self.article_id)
+            if old_category_id is not None:
+                tagindex.remove_category(old_category_id, [self.article_id])
+            tagindex.add_category(self.category_id, [self.article_id])
+        ContentVersion.bump()
         super(ArticleCategory, self).save(**kwargs)
 
     def delete(self, **kwargs):
-        category = self.category
-        category.article_num -= 1
-        category.save()
+        Category.objects.filter(pk=self.category_id).update(article_num=F('article_num') - 1)
+        autocomplete.add_scores('category', {self.category_id: -1})
+        UserStats.add_for_article(self.article_id, categories={self.category_id: -1})
+        pagecache.invalidate_article(self.article_id)
+        tagindex.remove_category(self.category_id, [self.article_id])
+        ContentVersion.bump()
         super(ArticleCategory, self).delete(**kwargs)
 
 
@@ -198,25 +292,35 @@ class ArticleTags(models.Model):
     tag = models.ForeignKey(Tag, on_delete=models.DO_NOTHING, db_index=False)
 
     # タグは重複しない
+    # 記事からの検索は一意制約の索引, タグでの絞り込みは (tag, article) の索引を使う
     class Meta:
         verbose_name_plural = "記事タグ"
         constraints = [
             models.UniqueConstraint(fields=['article', 'tag'], name='unique_tag')
         ]
+        indexes = [
+            models.Index(fields=['tag', 'article'], name='articletags_tag_idx'),
+        ]
 
     def __str__(self):
         return f"{self.article} {self.tag}"
 
     def save(self, **kwargs):
-        tag = self.tag
-        tag.article_num += 1
-        tag.save()
+        Tag.objects.filter(pk=self.tag_id).update(article_num=F('article_num') + 1)
+        autocomplete.add_scores('tag', {self.tag_id: 1})
+        UserStats.add_for_article(self.article_id, tags={self.tag_id: 1})
+        pagecache.invalidate_article(self.article_id)
+        tagindex.add_tags(self.tag_id, [self.article_id])
+        ContentVersion.bump()
         super(ArticleTags, self).save(**kwargs)
 
     def delete(self, **kwargs):
-        tag = self.tag
-        tag.article_num -= 1
-        tag.save()
+        Tag.objects.filter(pk=self.tag_id).update(article_num=F('article_num') - 1)
+        autocomplete.add_scores('tag', {self.tag_id: -1})
+        UserStats.add_for_article(self.article_id, tags={self.tag_id: -1})
+        pagecache.invalidate_article(self.article_id)
+        tagindex.remove_tags(self.tag_id, [self.article_id])
+        ContentVersion.bump()
         super(ArticleTags, self).delete(**kwargs)
 
     @staticmethod
@@ -226,3 +330,271 @@ class ArticleTags(models.Model):
     @staticmethod
     def exists(article, tag):
         return ArticleTags.get_or_none(article, tag) is not None
+
+
+# ユーザーページに表示する執筆者ごとの統計 (集計結果を保存しておく)
+# お気に入り・分野・タグ・執筆者の書き込みのたびに増減を反映する
+# まだ集計していないユーザーの行は作らず, 初めて参照されたときに集計する
+class UserStats(models.Model):
+    # ユーザー ID (外部キー)
+    user = models.OneToOneField(to='users.User', on_delete=models.CASCADE, primary_key=True)
+    # 記事についたお気に入りの合計
+    liked_num = models.IntegerField(default=0)
+    # 書いた記事の数
+    article_num = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "ユーザー統計"
+
+    def __str__(self):
+        return f"{self.user_id} {self.article_num} {self.liked_num}"
+
+    # ([(分野, 記事数)], [(タグ, 記事数)]) (名前順, 記事数が 0 以下のものは除く)
+    # ユーザーページで両方を表示するので, 1 回のクエリ (UNION ALL) でまとめて読んでおく
+    def _get_counts(self):
+        if not hasattr(self, '_counts'):
+            categories = UserCategoryCount.objects.filter(user_id=self.user_id, article_num__gt=0)\
+                .annotate(kind=Value(0, output_field=models.IntegerField())).values_list('kind', 'category', 'article_num')
+            tags = UserTagCount.objects.filter(user_id=self.user_id, article_num__gt=0)\
+                .annotate(kind=Value(1, output_field=models.IntegerField())).values_list('kind', 'tag', 'article_num')
+            self._counts = ([], [])
+            for kind, name, article_num in sorted(categories.union(tags, all=True)):
+                self._counts[kind].append((name, article_num))
+        return self._counts
+
+    # [(分野, 記事数)] (分野名順)
+    def get_category_counts(self):
+        return self._get_counts()[0]
+
+    # [(タグ, 記事数)] (タグ名順)
+    def get_tag_counts(self):
+        return self._get_counts()[1]
+
+    # 分野別・タグ別の記事数に増減 {名前: 増減} を反映する. 行がなければ作る
+    # 1 行 1 (ユーザー, 名前) にして 1 回の upsert (INSERT ... ON CONFLICT DO UPDATE) で加算するので,
+    # 同じユーザーの記事への同時の書き込みでも増減は失われない
+    # user_id を指定すればそのユーザー, article_id を指定すればその記事の執筆者の記事数を増減する
+    # 統計の行がまだないユーザーは何もしない (表示の際に集計される)
+    @staticmethod
+    def _add_counts(model, field, deltas, user_id=None, article_id=None):
+        deltas = {name: delta for name, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            stats = UserStats.objects.filter(pk=user_id) if article_id is None \
+                else UserStats.objects.filter(user__author__article=article_id)
+            user_id = stats.values_list('pk', flat=True).first()
+            if user_id is None:
+                return
+            model.objects.bulk_create([model(user_id=user_id, **{field: name}) for name in deltas], ignore_conflicts=True)
+            by_delta = {}
+            for name, delta in deltas.items():
+                by_delta.setdefault(delta, []).append(name)
+            for delta, names in by_delta.items():
+                model.objects.filter(user_id=user_id, **{f'{field}__in': names}).update(article_num=F('article_num') + delta)
+            return
+        qn = connection.ops.quote_name
+        opts, stats, author = model._meta, UserStats._meta, Author._meta
+        table = qn(opts.db_table)
+        user, name, article_num = (qn(opts.get_field(f).column) for f in ('user', field, 'article_num'))
+        stats_user = f'{qn(stats.db_table)}.{qn(stats.pk.column)}'
+        if article_id is None:
+            source = f'FROM {qn(stats.db_table)} WHERE {stats_user} = %s'
+            key = user_id
+        else:
+            source = (f'FROM {qn(stats.db_table)} INNER JOIN {qn(author.db_table)} '
+                      f'ON {qn(author.db_table)}.{qn(author.get_field("user").column)} = {stats_user} '
+                      f'WHERE {qn(author.db_table)}.{qn(author.pk.column)} = %s')
+            key = article_id
+        with connection.cursor() as cursor:
+            # INSERT ... SELECT に ON CONFLICT を付ける場合, SQLite では SELECT に WHERE が必要
+            cursor.executemany(
+                f'INSERT INTO {table} ({user}, {name}, {article_num}) SELECT {stats_user}, %s, %s {source} '
+                f'ON CONFLICT ({user}, {name}) DO UPDATE SET {article_num} = {table}.{article_num} + excluded.{article_num}',
+                [(name_, delta, key) for name_, delta in deltas.items()])
+
+    # 統計に増減を反映する. categories, tags は {名前: 増減}
+    @staticmethod
+    def add(user_id, liked_num=0, article_num=0, categories=None, tags=None):
+        if liked_num or article_num:
+            UserStats.objects.filter(pk=user_id).update(
+                liked_num=F('liked_num') + liked_num,
+                article_num=F('article_num') + article_num)
+        UserStats._add_counts(UserCategoryCount, 'category', categories or {}, user_id=user_id)
+        UserStats._add_counts(UserTagCount, 'tag', tags or {}, user_id=user_id)
+
+    # 記事の執筆者の統計に増減を反映する (執筆者がまだいなければ何もしない)
+    @staticmethod
+    def add_for_article(article_id, liked_num=0, article_num=0, categories=None, tags=None):
+        if liked_num or article_num:
+            UserStats.objects.filter(user__author__article=article_id).update(
+                liked_num=F('liked_num') + liked_num,
+                article_num=F('article_num') + article_num)
+        UserStats._add_counts(UserCategoryCount, 'category', categories or {}, article_id=article_id)
+        UserStats._add_counts(UserTagCount, 'tag', tags or {}, article_id=article_id)
+
+    # 記事ごとのお気に入り数の増減 {記事 ID: 増減} を執筆者ごとにまとめて反映する
+    @staticmethod
+    def add_liked_num(deltas):
+        by_user = {}
+        for user_id, article_id in Author.objects.filter(article_id__in=deltas).values_list('user_id', 'article_id'):
+            by_user[user_id] = by_user.get(user_id, 0) + deltas[article_id]
+        by_delta = {}
+        for user_id, delta in by_user.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(user_id)
+        for delta, user_ids in by_delta.items():
+            UserStats.objects.filter(pk__in=user_ids).update(liked_num=F('liked_num') + delta)
+
+    # 統計を集計する (保存はしない). user_ids が None なら全ユーザー
+    # {ユーザー ID: {'liked_num', 'article_num', 'categories': {分野: 記事数}, 'tags': {タグ: 記事数}}} を返す
+    # user_ids に含まれる記事のないユーザーも 0 件として含める
+    @staticmethod
+    def collect(user_ids=None):
+        authors = Author.objects.all()
+        article_tags = ArticleTags.objects.all()
+        if user_ids is not None:
+            authors = authors.filter(user_id__in=user_ids)
+            article_tags = article_tags.filter(article__author__user_id__in=user_ids)
+        stats = {}
+
+        def get(user_id):
+            if user_id not in stats:
+                stats[user_id] = dict(liked_num=0, article_num=0, categories={}, tags={})
+            return stats[user_id]
+
+        for row in authors.values('user_id').order_by().annotate(n=Count('article'), fav=Sum('article__fav_num')):
+            get(row['user_id']).update(article_num=row['n'], liked_num=row['fav'] or 0)
+        rows = authors.exclude(article__articlecategory=None)\
+            .values('user_id', 'article__articlecategory__category').order_by().annotate(n=Count('article'))
+        for row in rows:
+            get(row['user_id'])['categories'][row['article__articlecategory__category']] = row['n']
+        rows = article_tags.values('article__author__user_id', 'tag_id').order_by().annotate(n=Count('id'))
+        for row in rows:
+            get(row['article__author__user_id'])['tags'][row['tag_id']] = row['n']
+        for user_id in user_ids or ():
+            get(user_id)
+        return stats
+
+    # 保存されている統計を collect と同じ形で読む (統計の行があるユーザーのみ)
+    @staticmethod
+    def load(user_ids):
+        stats = {
+            user_id: dict(liked_num=liked_num, article_num=article_num, categories={}, tags={})
+            for user_id, liked_num, article_num
+            in UserStats.objects.filter(pk__in=user_ids).values_list('pk', 'liked_num', 'article_num')
+        }
+        for key, model, field in (('categories', UserCategoryCount, 'category'), ('tags', UserTagCount, 'tag')):
+            rows = model.objects.filter(user_id__in=stats).exclude(article_num=0).values_list('user_id', field, 'article_num')
+            for user_id, name, article_num in rows:
+                stats[user_id][key][name] = article_num
+        return stats
+
+    # 統計を集計し直して保存する. user_ids が None なら全ユーザー
+    @staticmethod
+    def rebuild(user_ids=None):
+        stats = UserStats.collect(user_ids)
+        with transaction.atomic():
+            for model in (UserStats, UserCategoryCount, UserTagCount):
+                deleted = model.objects.all()
+                if user_ids is not None:
+                    deleted = deleted.filter(user_id__in=user_ids)
+                deleted.delete()
+            UserStats.objects.bulk_create([
+                UserStats(user_id=user_id, liked_num=s['liked_num'], article_num=s['article_num'])
+                for user_id, s in stats.items()
+            ], batch_size=500)
+            for key, model, field in (('categories', UserCategoryCount, 'category'), ('tags', UserTagCount, 'tag')):
+                model.objects.bulk_create([
+                    model(user_id=user_id, article_num=n, **{field: name})
+                    for user_id, s in stats.items() for name, n in s[key].items()
+                ], batch_size=500)
+        return sum(1 for s in stats.values() if s['article_num'])
+
+    # ユーザーの統計 (まだ集計していなければ集計する)
+    @staticmethod
+    def get_or_build(user):
+        stats = UserStats.objects.filter(pk=user.pk).first()
+        if stats is None:
+            UserStats.rebuild([user.pk])
+            stats = UserStats.objects.get(pk=user.pk)
+        return stats
+
+
+# ユーザーの分野別の記事数
+class UserCategoryCount(models.Model):
+    # ユーザー ID (外部キー)
+    user = models.ForeignKey(to='users.User', on_delete=models.CASCADE, db_index=False)
+    # 分野名
+    category = models.CharField(max_length=15)
+    # 書いた記事の数
+    article_num = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "ユーザーの分野別の記事数"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'category'], name='unique_user_category'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.category} {self.article_num}"
+
+
+# ユーザーのタグ別の記事数
+class UserTagCount(models.Model):
+    # ユーザー ID (外部キー)
+    user = models.ForeignKey(to='users.User', on_delete=models.CASCADE, db_index=False)
+    # タグ名
+    tag = models.CharField(max_length=15)
+    # 書いた記事の数
+    article_num = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "ユーザーのタグ別の記事数"
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'tag'], name='unique_user_tag'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} {self.tag} {self.article_num}"
+
+
+# サイト全体の内容のバージョン
+# 記事の作成・編集・削除, 分野・タグの付け替え, お気に入り数の変化のたびに増える
+# 一覧の ETag などの「前回から何か変わったか」の判定に使う (1 行だけのテーブル)
+class ContentVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+    # 最後に version が増えた日時
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name_plural = "内容のバージョン"
+
+    def __str__(self):
+        return f"{self.version} {self.updated_at}"
+
+    @staticmethod
+    def get():
+        version, _ = ContentVersion.objects.get_or_create(pk=1)
+        return version
+
+    @staticmethod
+    def bump():
+        updated = ContentVersion.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now())
+        if not updated:
+            ContentVersion.objects.get_or_create(pk=1, defaults=dict(version=1))
+        transaction.on_commit(ContentVersion._count_local_bump)
+
+    # このプロセスでコミットされた bump の回数
+    # バージョンの増分と比べると, 他のプロセスでの書き込みがあったかが分かる (cms.tagindex)
+    _local_bumps = 0
+    _local_bumps_lock = threading.Lock()
+
+    @staticmethod
+    def _count_local_bump():
+        with ContentVersion._local_bumps_lock:
+            ContentVersion._local_bumps += 1
+
+    @staticmethod
+    def local_bumps():
+        return ContentVersion._local_bumps
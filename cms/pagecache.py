@@ -0,0 +1,50 @@
+from django.core.cache import caches
+from django.db import transaction
+from django.template import loader
+
+# 記事ページのうち, 閲覧者によらない部分 (執筆者・日時, 分野・タグ・本文) を描画したもののキャッシュ
+# お気に入りボタンや編集ボタンなど閲覧者ごとに変わる部分は毎回描画してこの周りに組み立てる
+# 大きさの上限と LRU での追い出しは settings.CACHES の 'article_pages' で設定する
+CACHE_NAME = 'article_pages'
+
+
+def _cache():
+    return caches[CACHE_NAME]
+
+
+def _key(article_id):
+    return f'article:{article_id}'
+
+
+# 記事ページの閲覧者によらない部分 (header, body) を返す
+# キャッシュは記事 ID と更新日時の組で引き, 更新日時が異なれば描画し直す
+def get_article_parts(article_id, updated_at):
+    from cms.models import Article
+
+    cache = _cache()
+    cached = cache.get(_key(article_id))
+    if cached is not None and cached[0] == updated_at:
+        return cached[1]
+    article = Article.objects.for_list().get(pk=article_id)
+    parts = {
+        'header': loader.render_to_string('cms/components/article_header.html', dict(article=article)),
+        'body': loader.render_to_string('cms/components/article_body.html', dict(article=article)),
+    }
+    cache.set(_key(article_id), (article.updated_at, parts))
+    return parts
+
+
+# 記事の編集・削除時などにキャッシュを破棄する
+# コミットまでの間に別のリクエストが古い内容をキャッシュし直すことがあるので, コミット後にもう一度破棄する
+def invalidate_article(article_id):
+    invalidate_articles([article_id])
+
+
+def invalidate_articles(article_ids):
+    keys = [_key(article_id) for article_id in article_ids]
+    _cache().delete_many(keys)
+    transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def clear():
+    _cache().clear()
@@ -0,0 +1,122 @@
+from datetime import datetime
+
+from django.core import signing
+from django.db.models import F, Q
+
+# カーソル (次/前のページの位置) の署名に使う salt
+CURSOR_SALT = 'cms.paging.cursor'
+
+
+# 署名を確かめてカーソルの内容を返す. 不正なカーソルや並び替えの異なるカーソルは None
+def load_cursor(cursor, ordering):
+    if not cursor:
+        return None
+    try:
+        state = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+    if state.get('o') != ordering:
+        return None
+    return state
+
+
+# keyset ページングの 1 ページ分
+class KeysetPage:
+    def __init__(self, object_list, number, has_next, has_previous,
+                 next_cursor=None, previous_cursor=None, count=None, count_capped=False):
+        self.object_list = object_list
+        self.number = number
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        # 総件数 (数えなかった場合は None). count_capped なら count 件以上
+        self.count = count
+        self.count_capped = count_capped
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+# OFFSET を使わないページング
+# 並び替えのキー列と主キーの組 (key, pk) で前のページの末尾の位置を覚えておき,
+# WHERE 句でその続きから取得するので, 何ページ目でも 1 ページ目と同じコストで済む
+class KeysetPaginator:
+    # ordering は並び替えのキー ("-fav_num", "title" など). 同じ値の行は主キーで順序を決める
+    # count_cap を指定した場合は最大 count_cap 件まで総件数を数える
+    def __init__(self, queryset, per_page, ordering, count_cap=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+        self.count_cap = count_cap
+        self.descending = ordering.startswith('-')
+        self.key = ordering.lstrip('-')
+
+    # キー列 (関連先の列や annotate した値でもよい) を paging_key として付与した QuerySet
+    def _keyed_queryset(self):
+        return self.queryset.annotate(paging_key=F(self.key))
+
+    # (key, pk) より後ろにある行の条件. SQLite では NULL は昇順で先頭, 降順で末尾に並ぶ
+    @staticmethod
+    def _after(key, pk, descending):
+        op = 'lt' if descending else 'gt'
+        if key is None:
+            if descending:
+                return Q(paging_key__isnull=True, **{f'pk__{op}': pk})
+            return Q(paging_key__isnull=False) | Q(paging_key__isnull=True, **{f'pk__{op}': pk})
+        condition = Q(**{f'paging_key__{op}': key}) | Q(paging_key=key, **{f'pk__{op}': pk})
+        if descending:
+            condition |= Q(paging_key__isnull=True)
+        return condition
+
+    def _encode(self, row, number, direction):
+        key = row.paging_key
+        if isinstance(key, datetime):
+            key = key.isoformat()
+        return signing.dumps(dict(o=self.ordering, k=key, pk=row.pk, n=number, d=direction), salt=CURSOR_SALT)
+
+    # 不正なカーソルや並び替えの異なるカーソルは None (1 ページ目) として扱う
+    def _decode(self, cursor, queryset):
+        state = load_cursor(cursor, self.ordering)
+        if state is None:
+            return None
+        key = state['k']
+        if key is not None:
+            key = queryset.query.annotations['paging_key'].output_field.to_python(key)
+        state['k'] = key
+        return state
+
+    def count(self):
+        n = self.queryset.order_by()[:self.count_cap + 1].count()
+        return min(n, self.count_cap), n > self.count_cap
+
+    def page(self, cursor=None):
+        queryset = self._keyed_queryset()
+        state = self._decode(cursor, queryset)
+        backward = state is not None and state['d'] == 'p'
+        descending = self.descending != backward
+        sign = '-' if descending else ''
+        queryset = queryset.order_by(f'{sign}paging_key', f'{sign}pk')
+        if state is not None:
+            queryset = queryset.filter(self._after(state['k'], state['pk'], descending))
+        # 1 件多く取得して次 (前) のページがあるかを判定する
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        number = state['n'] if state is not None else 1
+        if backward:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, state is not None
+        page = KeysetPage(rows, number, has_next, has_previous)
+        if rows and has_next:
+            page.next_cursor = self._encode(rows[-1], number + 1, 'n')
+        if rows and has_previous:
+            page.previous_cursor = self._encode(rows[0], number - 1, 'p')
+        if self.count_cap is not None:
+            page.count, page.count_capped = self.count()
+        return page
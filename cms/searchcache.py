@@ -0,0 +1,53 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+from cms import conditional, metrics
+
+# 記事検索の結果 (1 ページ分) のキャッシュ
+# キーは正規化した検索条件 (ArticleSearch.cache_params と, ページのカーソル) と, サイト全体の内容のバージョン (ContentVersion) から作る
+# 記事の作成・編集・削除やお気に入りの登録 / 解除でバージョンが増えると古いキーは使われなくなり, LRU で追い出される
+# 大きさの上限と LRU での追い出しは settings.CACHES の 'search_results' で設定する
+CACHE_NAME = 'search_results'
+
+HITS = 'algopedia_search_cache_hits_total'
+MISSES = 'algopedia_search_cache_misses_total'
+
+
+def _cache():
+    return caches[CACHE_NAME]
+
+
+def enabled():
+    return getattr(settings, 'SEARCH_CACHE', {}).get('ENABLED', False)
+
+
+def _key(version, params):
+    return f'search:{version}:' + hashlib.md5(repr(params).encode()).hexdigest()
+
+
+# 検索条件 params (None ならキャッシュしない) の結果を返す. キャッシュになければ compute() で求めて保存する
+def get_or_compute(request, params, compute):
+    if params is None or not enabled():
+        return compute()
+    key = _key(conditional.content_version(request).version, params)
+    cache = _cache()
+    result = cache.get(key)
+    if result is not None:
+        metrics.increment(HITS)
+        return result
+    metrics.increment(MISSES)
+    result = compute()
+    cache.set(key, result)
+    return result
+
+
+# ヒット数, ミス数, ヒット率 (検索がなければ None)
+def stats():
+    hits, misses = metrics.counter(HITS), metrics.counter(MISSES)
+    return dict(hits=hits, misses=misses, hit_ratio=hits / (hits + misses) if hits + misses else None)
+
+
+def clear():
+    _cache().clear()
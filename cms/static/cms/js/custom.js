@@ -0,0 +1,4 @@
+// このページ (タブ) の識別子を Ajax のリクエストに付ける
+// サーバーは同じタブからの新しい検索・入力補完でだけ古い方を中断する (別のタブどうしでは中断しない)
+const tab_id = Date.now().toString(36) + Math.random().toString(36).slice(2)
+$.ajaxSetup({headers: {'X-Tab-Id': tab_id}})
@@ -0,0 +1,219 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from cms.bitmap import Bitmap, intersection, union
+
+# 分野・タグごとの記事 ID の集合 (cms.bitmap.Bitmap) をメモリ上に持つ索引
+# 記事検索の分野・タグの条件 (AND / OR / NOT) をビットマップの演算で求め, DB には当てはまった記事 ID だけを渡す
+# 起動時 (warm) か最初の検索で DB から作り, このプロセスでのタグ付け・分野の書き込みはコミット時に差分を反映する
+# 他のプロセスでの書き込みは MAX_AGE 秒ごとの作り直し (裏のスレッドで行い, その間は古い索引を使う) で反映される
+# ただし, 作ったときから内容のバージョン (ContentVersion) が他のプロセスでの書き込みで増えていれば, 索引は使わずに
+# (lookup は None を返し, 検索は SQL で行う) 裏で作り直す. 古い索引で求めた結果が新しいバージョンの結果としてキャッシュされないようにするため
+
+
+def _setting(key, default):
+    return getattr(settings, 'TAG_INDEX', {}).get(key, default)
+
+
+def enabled():
+    return _setting('ENABLED', False)
+
+
+class TagIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._tags = None
+        self._categories = None
+        self._built_at = None
+        # 作り始めたときの (内容のバージョン, このプロセスでの bump の回数)
+        self._built_version = None
+        self._rebuilding = False
+        # 作り直しの間に反映した差分 (作り直した索引にも反映する)
+        self._pending = None
+
+    def invalidate(self):
+        with self._lock:
+            self._tags = self._categories = self._built_at = self._built_version = None
+
+    @staticmethod
+    def _version():
+        from cms.models import ContentVersion
+
+        # bump の回数を先に読む (回数に含まれる書き込みは必ずバージョンにも含まれる)
+        local_bumps = ContentVersion.local_bumps()
+        return ContentVersion.get().version, local_bumps
+
+    @staticmethod
+    def _load():
+        from cms.models import ArticleCategory, ArticleTags
+
+        tags, categories = {}, {}
+        for tag, article_id in ArticleTags.objects.order_by().values_list('tag_id', 'article_id').iterator():
+            tags.setdefault(tag, []).append(article_id)
+        for category, article_id in ArticleCategory.objects.order_by()\
+                .values_list('category_id', 'article_id').iterator():
+            categories.setdefault(category, []).append(article_id)
+        return ({tag: Bitmap(ids) for tag, ids in tags.items()},
+                {category: Bitmap(ids) for category, ids in categories.items()})
+
+    # DB から作り直す. 作り直しの間の差分は作り直した索引にも反映する
+    def build(self):
+        with self._build_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                version = self._version()
+                tags, categories = self._load()
+            finally:
+                with self._lock:
+                    pending, self._pending = self._pending, None
+            with self._lock:
+                for change in pending:
+                    self._apply(tags, categories, *change)
+                self._tags, self._categories = tags, categories
+                self._built_at = time.monotonic()
+                self._built_version = version
+
+    def _rebuild_in_background(self):
+        def rebuild():
+            from django.db import connection
+
+            try:
+                self.build()
+            finally:
+                self._rebuilding = False
+                connection.close()
+
+        self._rebuilding = True
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def _ensure_built(self):
+        if self._tags is None:
+            self.build()
+        elif not self._rebuilding and time.monotonic() - self._built_at >= _setting('MAX_AGE', 300.0):
+            self._rebuild_in_background()
+
+    # 起動時に裏のスレッドで作っておく
+    def warm(self):
+        if self._tags is None and not self._rebuilding:
+            self._rebuild_in_background()
+
+    @staticmethod
+    def _apply(tags, categories, kind, name, article_ids, add):
+        bitmaps = tags if kind == 'tag' else categories
+        if name is None:
+            # 記事の削除: 全ての集合から除く
+            removed = Bitmap(article_ids)
+            for key in list(bitmaps):
+                bitmaps[key] = bitmaps[key] - removed
+            return
+        bitmap = bitmaps.get(name, Bitmap()).copy()
+        for article_id in article_ids:
+            if add:
+                bitmap.add(article_id)
+            else:
+                bitmap.discard(article_id)
+        bitmaps[name] = bitmap
+
+    # 差分 (kind は 'tag' か 'category', name が None なら全ての集合から除く) を反映する
+    def apply(self, kind, name, article_ids, add):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((kind, name, article_ids, add))
+            if self._tags is not None:
+                self._apply(self._tags, self._categories, kind, name, article_ids, add)
+
+    # 作ってからのバージョンの増分と, このプロセスでの bump の回数の差
+    # 0 なら version までの書き込みが全て反映されている. 正なら他のプロセスでの書き込みがある
+    # (負なら version を読んだ後にこのプロセスで書き込みがあった)
+    def _lag(self, version):
+        from cms.models import ContentVersion
+
+        built_version, built_bumps = self._built_version
+        return (version - built_version) - (ContentVersion.local_bumps() - built_bumps)
+
+    # 分野・タグの条件に当てはまる記事 ID の集合
+    # category: 分野, tags: タグ, match_all: タグを全て持つ (False ならいずれか), exclude_tags: 持たないタグ
+    # version: 検索の時点の内容のバージョン. 他のプロセスでの書き込みが反映されていなければ None を返す
+    def lookup(self, category=None, tags=(), match_all=False, exclude_tags=(), version=None):
+        self._ensure_built()
+        if version is None:
+            version = self._version()[0]
+        lag = self._lag(version)
+        if lag:
+            if lag > 0 and not self._rebuilding:
+                self._rebuild_in_background()
+            return None
+        with self._lock:
+            tag_bitmaps, category_bitmaps = self._tags, self._categories
+        empty = Bitmap()
+        sets = []
+        if category:
+            sets.append(category_bitmaps.get(category, empty))
+        if tags and match_all:
+            sets.extend(tag_bitmaps.get(tag, empty) for tag in tags)
+        elif tags:
+            sets.append(union(tag_bitmaps.get(tag, empty) for tag in tags))
+        result = intersection(sets)
+        if exclude_tags:
+            result = result - union(tag_bitmaps.get(tag, empty) for tag in exclude_tags)
+        return result
+
+    # 分野・タグごとの記事数と, 保持に使っているおおよそのバイト数
+    def stats(self):
+        self._ensure_built()
+        with self._lock:
+            bitmaps = list(self._tags.values()) + list(self._categories.values())
+            return dict(tags=len(self._tags), categories=len(self._categories),
+                        bytes=sum(bitmap.nbytes() for bitmap in bitmaps))
+
+
+index = TagIndex()
+
+
+def _on_commit(kind, name, article_ids, add):
+    if not enabled() or not article_ids:
+        return
+    article_ids = list(article_ids)
+    transaction.on_commit(lambda: index.apply(kind, name, article_ids, add))
+
+
+# 以下は書き込みの際に呼ぶ (コミットされたら索引に反映する)
+
+def add_tags(tag, article_ids):
+    _on_commit('tag', tag, article_ids, True)
+
+
+def remove_tags(tag, article_ids):
+    _on_commit('tag', tag, article_ids, False)
+
+
+def add_category(category, article_ids):
+    _on_commit('category', category, article_ids, True)
+
+
+def remove_category(category, article_ids):
+    _on_commit('category', category, article_ids, False)
+
+
+def remove_articles(article_ids):
+    _on_commit('tag', None, article_ids, False)
+    _on_commit('category', None, article_ids, False)
+
+
+def lookup(category=None, tags=(), match_all=False, exclude_tags=(), version=None):
+    return index.lookup(category, tags, match_all, exclude_tags, version)
+
+
+def warm():
+    if enabled():
+        index.warm()
+
+
+def invalidate():
+    index.invalidate()
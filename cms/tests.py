@@ -1,3 +1,2115 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.signals import request_finished
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connection, connections
+from django.db.models import Count, F
+from django.db.utils import load_backend
+from django.test import AsyncClient, Client, LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
 
 # Create your tests here.
+from cms import articlesearch, asyncdb, autocomplete, bitmap, buffers, bulk, counters, export, fulltext, metrics, pagecache, \
+    paging, searchcache, tagindex, views
+from cms.articlesearch import ORDER_FIELDS, STREAMING_FIELDS, ArticleSearch
+from cms.buffers import fav_num_buffer, reading_history_buffer
+from cms.context_processors.htmls import common_constants
+from cms.models import Article, ArticleCategory, ArticleTags, Author, Category, ContentVersion, Favorite, ReadingHistory, Tag, \
+    UserCategoryCount, UserStats
+from cms.views import COUNT_CAP
+from users.models import User
+
+PASSWORD = 'Passw0rd1234'
+
+
+# テスト用の記事を作成する
+def create_article(user, title, category, tags, content='本文'):
+    article = Article(title=title, content=content)
+    article.save()
+    ArticleCategory(article=article, category=Category.objects.get(pk=category.pk)).save()
+    for tag in tags:
+        ArticleTags(article=article, tag=Tag.objects.get(pk=tag.pk)).save()
+    Author(article=article, user=user).save()
+    return article
+
+
+# TestCase のトランザクションの中のデータが見えるように, 非同期のビューの DB の処理もテストのスレッドで実行する
+# 同じ理由で, バッファを裏のスレッドでは反映しない
+@override_settings(ASYNC_VIEWS={'MAX_WORKERS': 0},
+                   READING_HISTORY_BUFFER=dict(settings.READING_HISTORY_BUFFER, FLUSH_IN_BACKGROUND=False))
+class CmsTestCase(TestCase):
+
+    def tearDown(self):
+        # 反映されなかった書き込みを次のテストに持ち越さない
+        for buffer in buffers.buffers:
+            buffer.discard()
+        pagecache.clear()
+        searchcache.clear()
+        tagindex.invalidate()
+        autocomplete.invalidate()
+        metrics.reset()
+
+
+# 閲覧履歴の反映 (リクエストの終了時) がテストの実行時間によって数えられたりされなかったりしないようにする
+@override_settings(READING_HISTORY_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600})
+class QueryCountTestCase(CmsTestCase):
+    # 1 リクエストあたりのクエリ数の上限を確かめる (記事の数によらず一定であること)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.other = User.objects.create_user('bob', PASSWORD)
+        categories = [Category.objects.create(category=f'category{i}') for i in range(3)]
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(5)]
+        cls.articles = [
+            create_article(
+                cls.user if i % 2 else cls.other,
+                f'title{i}',
+                categories[i % 3],
+                tags[i % 3:i % 3 + 3],
+            )
+            for i in range(25)
+        ]
+        UserStats.rebuild()
+
+    def assertMaxQueries(self, max_num, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        queries = [query['sql'] for query in context.captured_queries
+                   if not query['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+        self.assertLessEqual(len(queries), max_num, '\n'.join(queries))
+        return response
+
+    def login(self):
+        self.client.login(username='alice', password=PASSWORD)
+
+    def test_index(self):
+        self.assertMaxQueries(5, reverse('cms:index'))
+
+    def test_search_ajax(self):
+        url = reverse('cms:search_ajax')
+        self.assertMaxQueries(4, url)
+        self.assertMaxQueries(4, url, dict(title='title', category='category0', selected_tags=['tag1', 'tag2']))
+        for order in ('title', '-fav_num', 'updated_at', 'author__user__username', '-articlecategory__category'):
+            response = self.assertMaxQueries(4, url, dict(search_or_order=order))
+            self.assertMaxQueries(4, url, dict(search_or_order=order, cursor=response.context['page_obj'].next_cursor))
+
+    def test_search_ajax_login(self):
+        self.login()
+        url = reverse('cms:search_ajax')
+        self.assertMaxQueries(5, url, dict(check=['author', 'fav', 'read']))
+
+    def test_search_api(self):
+        url = reverse('cms:search_api')
+        self.assertMaxQueries(4, url, dict(title='title', category='category0', selected_tags=['tag1', 'tag2']))
+        # 分野・タグごとの記事数はまとめて 1 回のクエリで数える
+        self.assertMaxQueries(5, url, dict(title='title', category='category0', selected_tags=['tag1'], facets=1))
+        self.assertMaxQueries(6, url, dict(category='category0', selected_tags=['tag1', 'tag2'], facets=1))
+        for order in ('title', '-fav_num', 'author__user__username'):
+            response = self.assertMaxQueries(4, url, dict(search_or_order=order))
+            self.assertMaxQueries(4, url, dict(search_or_order=order, cursor=response.json()['page']['next_cursor']))
+
+    def test_user_page(self):
+        self.assertMaxQueries(6, reverse('cms:user_page', args=[self.user.pk]))
+
+    def test_user_page_api(self):
+        self.assertMaxQueries(5, reverse('cms:user_page_api', args=[self.user.pk]), dict(search_or_order='-updated_at'))
+
+    def test_user_page_ajax(self):
+        url = reverse('cms:user_page_ajax', args=[self.user.pk])
+        response = self.assertMaxQueries(5, url, dict(search_or_order='-updated_at'))
+        self.assertMaxQueries(5, url, dict(search_or_order='-updated_at', cursor=response.context['page_obj'].next_cursor))
+
+    def test_fav_ajax(self):
+        self.login()
+        self.assertMaxQueries(8, reverse('cms:fav_ajax', args=[self.articles[0].pk]))
+
+    def test_article_view(self):
+        url = reverse('cms:article_view', args=[self.articles[0].pk])
+        self.assertMaxQueries(4, url)
+        # 閲覧者によらない部分はキャッシュされる
+        self.assertMaxQueries(2, url)
+        self.login()
+        self.assertMaxQueries(5, url)
+
+
+class FavoriteTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(3)]
+        category = Category.objects.create(category='category')
+        cls.article = create_article(cls.users[0], 'title', category, [])
+
+    def fav_num(self):
+        return Article.objects.get(pk=self.article.pk).fav_num
+
+    def test_fav_ajax(self):
+        self.client.login(username='user1', password=PASSWORD)
+        url = reverse('cms:fav_ajax', args=[self.article.pk])
+        response = self.client.get(url)
+        self.assertTrue(response.context['fav'])
+        self.assertEqual(response.context['article'].fav_num, 1)
+        response = self.client.get(url)
+        self.assertFalse(response.context['fav'])
+        self.assertEqual(response.context['article'].fav_num, 0)
+        self.assertEqual(self.fav_num(), 0)
+
+    def test_create_or_delete(self):
+        for user in self.users:
+            self.assertTrue(Favorite.create_or_delete(self.article, user))
+        self.assertEqual(self.article.fav_num, 3)
+        self.assertEqual(self.fav_num(), 3)
+        self.assertFalse(Favorite.create_or_delete(self.article, self.users[0]))
+        self.assertEqual(self.article.fav_num, 2)
+        self.assertEqual(self.fav_num(), 2)
+
+    def test_stale_instance(self):
+        # 古い fav_num を持つインスタンスからの更新でも増減が失われない
+        stale = Article.objects.get(pk=self.article.pk)
+        Favorite.create_or_delete(self.article, self.users[0])
+        Favorite.create_or_delete(stale, self.users[1])
+        self.assertEqual(stale.fav_num, 2)
+        self.assertEqual(self.fav_num(), 2)
+
+    @override_settings(FAV_NUM_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600})
+    def test_buffered(self):
+        for user in self.users:
+            Favorite.create_or_delete(self.article, user)
+        Favorite.create_or_delete(self.article, self.users[0])
+        self.assertEqual(fav_num_buffer.pending(self.article.pk), 2)
+        self.assertEqual(self.fav_num(), 0)
+        with self.assertNumQueries(6):
+            # SAVEPOINT, 執筆者の取得, 執筆者の統計・内容のバージョン・記事の UPDATE, RELEASE SAVEPOINT
+            self.assertEqual(fav_num_buffer.flush(), 1)
+        self.assertEqual(self.fav_num(), 2)
+        self.assertEqual(fav_num_buffer.flush(), 0)
+
+
+class ReadingHistoryTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        category = Category.objects.create(category='category')
+        cls.articles = [create_article(cls.users[0], f'title{i}', category, []) for i in range(3)]
+
+    def view(self, user, article):
+        self.client.login(username=user.username, password=PASSWORD)
+        self.client.get(reverse('cms:article_view', args=[article.pk]))
+
+    @override_settings(READING_HISTORY_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600})
+    def test_buffered(self):
+        for _ in range(3):
+            for article in self.articles:
+                self.view(self.users[1], article)
+        self.view(self.users[0], self.articles[0])
+        self.assertFalse(ReadingHistory.objects.exists())
+        self.assertEqual(len(reading_history_buffer), 4)
+        self.assertEqual(reading_history_buffer.flush(), 4)
+        self.assertEqual(ReadingHistory.objects.count(), 4)
+        # 既存の履歴は更新される
+        self.view(self.users[1], self.articles[0])
+        updated_at = reading_history_buffer.pending((self.users[1].pk, self.articles[0].pk))
+        reading_history_buffer.flush()
+        self.assertEqual(ReadingHistory.objects.count(), 4)
+        self.assertEqual(
+            ReadingHistory.objects.get(user=self.users[1], article=self.articles[0]).updated_at, updated_at)
+
+    @override_settings(READING_HISTORY_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600, 'MAX_PENDING': 2})
+    def test_flush_on_max_pending(self):
+        self.view(self.users[1], self.articles[0])
+        self.assertEqual(len(reading_history_buffer), 1)
+        self.view(self.users[1], self.articles[1])
+        self.assertEqual(len(reading_history_buffer), 0)
+        self.assertEqual(ReadingHistory.objects.count(), 2)
+
+    # 反映できない書き込み (削除されたユーザーの履歴など) は, 他の書き込みを妨げずに何度か再試行してから捨てる
+    @override_settings(READING_HISTORY_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600, 'MAX_RETRIES': 2})
+    def test_flush_failure(self):
+        bad = (self.users[0].pk, self.articles[1].pk)
+        write = type(reading_history_buffer).write
+
+        def failing_write(buffer, items):
+            if bad in items:
+                raise ValueError('bad row')
+            write(buffer, items)
+
+        self.view(self.users[0], self.articles[0])
+        self.view(self.users[0], self.articles[1])
+        self.view(self.users[1], self.articles[0])
+        with mock.patch.object(type(reading_history_buffer), 'write', failing_write), \
+                self.assertLogs('cms.buffers', 'WARNING'):
+            self.assertEqual(reading_history_buffer.flush(), 2)
+            self.assertEqual(ReadingHistory.objects.count(), 2)
+            self.assertEqual(len(reading_history_buffer), 1)
+            self.view(self.users[1], self.articles[2])
+            self.assertEqual(reading_history_buffer.flush(), 1)
+        self.assertEqual(len(reading_history_buffer), 0)
+        self.assertEqual(ReadingHistory.objects.count(), 3)
+        self.assertFalse(reading_history_buffer._failures)
+
+    # 裏のスレッドは, リクエストが来なくても反映する時期になった分を反映する
+    @override_settings(READING_HISTORY_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600, 'FLUSH_IN_BACKGROUND': True})
+    def test_flush_in_background(self):
+        with mock.patch.object(buffers, '_start_flusher') as start:
+            self.view(self.users[1], self.articles[0])
+        start.assert_called_once_with()
+        buffers.flush_in_background()
+        self.assertEqual(len(reading_history_buffer), 1)
+        reading_history_buffer._last_flush -= 3600
+        buffers.flush_in_background()
+        self.assertEqual(len(reading_history_buffer), 0)
+        self.assertEqual(ReadingHistory.objects.count(), 1)
+
+    # リクエストの終了時には, 接続を閉じる前に反映する
+    def test_flush_before_closing_connections(self):
+        # 起動時と同じく close_old_connections だけが接続された状態から, cms の ready() で接続し直す
+        request_finished.disconnect(dispatch_uid='cms.buffers.flush_buffers_if_due')
+        request_finished.disconnect(close_old_connections)
+        request_finished.connect(close_old_connections)
+        apps.get_app_config('cms').ready()
+        receivers = request_finished._live_receivers(None)
+        self.assertLess(receivers.index(buffers.flush_buffers_if_due), receivers.index(close_old_connections))
+
+    @override_settings(READING_HISTORY_BUFFER={'ENABLED': False})
+    def test_unbuffered(self):
+        self.view(self.users[1], self.articles[0])
+        self.view(self.users[1], self.articles[0])
+        self.assertEqual(ReadingHistory.objects.count(), 1)
+
+
+class UserStatsTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+
+    def edit(self, title, category, tags, article_id=None):
+        url = reverse('cms:article_edit', args=[article_id]) if article_id else reverse('cms:article_add')
+        response = self.client.post(url, dict(title=title, content='本文', category=category, selected_tags=tags))
+        self.assertEqual(json.loads(response.content)['status'], 0)
+
+    def assertStats(self, user):
+        # 差分で更新した統計と集計し直した統計が一致する
+        stats = UserStats.objects.get(pk=user.pk)
+        expected = (user.liked_num(), user.author_articles().count(),
+                    [(c['category'], c['count']) for c in user.category_counts()],
+                    [(t['tag'], t['count']) for t in user.tag_counts() if t['tag']])
+        self.assertEqual(
+            (stats.liked_num, stats.article_num, stats.get_category_counts(), stats.get_tag_counts()), expected)
+        UserStats.rebuild([user.pk])
+        rebuilt = UserStats.objects.get(pk=user.pk)
+        self.assertEqual(
+            (rebuilt.liked_num, rebuilt.article_num, rebuilt.get_category_counts(), rebuilt.get_tag_counts()),
+            expected)
+
+    def test_incremental(self):
+        user = self.users[0]
+        self.client.login(username=user.username, password=PASSWORD)
+        # 初めて参照されたときに集計される
+        response = self.client.get(reverse('cms:user_page', args=[user.pk]))
+        self.assertEqual(response.context['stats'].article_num, 0)
+
+        self.edit('title0', 'graph', ['dp', 'tree'])
+        self.edit('title1', 'graph', ['tree'])
+        self.edit('title2', 'string', [])
+        self.assertStats(user)
+        articles = list(user.author_articles().order_by('pk'))
+
+        Favorite.create_or_delete(articles[0], self.users[1])
+        Favorite.create_or_delete(articles[1], self.users[1])
+        Favorite.create_or_delete(articles[1], user)
+        Favorite.create_or_delete(articles[1], user)
+        self.assertStats(user)
+
+        self.edit('title0', 'string', ['tree', 'flow'], article_id=articles[0].pk)
+        self.assertStats(user)
+
+        self.client.get(reverse('cms:article_del', args=[articles[1].pk]))
+        self.assertStats(user)
+
+        response = self.client.get(reverse('cms:user_page', args=[user.pk]))
+        self.assertEqual(response.context['stats'].liked_num, 1)
+        self.assertEqual(response.context['stats'].get_category_counts(), [('string', 2)])
+
+    def test_add_counts(self):
+        user = self.users[0]
+        UserStats.rebuild([user.pk])
+        # 分野・タグごとに 1 行で, 増減は行への加算で反映される
+        UserStats.add(user.pk, categories={'graph': 1}, tags={'dp': 2, 'tree': 1})
+        UserStats.add(user.pk, categories={'graph': 1, 'string': 1}, tags={'dp': -2})
+        stats = UserStats.objects.get(pk=user.pk)
+        self.assertEqual(stats.get_category_counts(), [('graph', 2), ('string', 1)])
+        self.assertEqual(stats.get_tag_counts(), [('tree', 1)])
+        self.assertEqual(UserCategoryCount.objects.filter(user=user, category='graph').count(), 1)
+        # 統計の行がないユーザーには行を作らない
+        UserStats.add(self.users[1].pk, categories={'graph': 1})
+        self.assertFalse(UserCategoryCount.objects.filter(user=self.users[1]).exists())
+
+        self.client.login(username=user.username, password=PASSWORD)
+        self.edit('title0', 'graph', ['dp'])
+        article = user.author_articles().get()
+        UserStats.add_for_article(article.pk, liked_num=3, tags={'dp': 1})
+        stats = UserStats.objects.get(pk=user.pk)
+        self.assertEqual(stats.liked_num, 3)
+        self.assertEqual(stats.get_tag_counts(), [('dp', 2), ('tree', 1)])
+
+
+class PageCacheTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        cls.category = Category.objects.create(category='category')
+        cls.tag = Tag.objects.create(tag='tag')
+        cls.article = create_article(cls.users[0], 'title', cls.category, [cls.tag], content='old content')
+
+    def view(self):
+        return self.client.get(reverse('cms:article_view', args=[self.article.pk]))
+
+    def test_cached(self):
+        self.assertContains(self.view(), 'old content')
+        # 2 回目は記事の本体・分野・タグを取得しない (記事の版と内容のバージョンのみ)
+        with CaptureQueriesContext(connection) as context:
+            response = self.view()
+        self.assertContains(response, 'old content')
+        self.assertContains(response, 'category')
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(queries), 2)
+
+    def test_per_user_parts(self):
+        self.view()
+        self.client.login(username='user0', password=PASSWORD)
+        self.assertContains(self.view(), '記事を編集する')
+        self.client.login(username='user1', password=PASSWORD)
+        response = self.view()
+        self.assertNotContains(response, '記事を編集する')
+        self.assertContains(response, 'お気に入り登録')
+        self.client.get(reverse('cms:fav_ajax', args=[self.article.pk]))
+        response = self.view()
+        self.assertContains(response, 'お気に入り解除')
+        self.assertContains(response, '★: 1')
+
+    def test_invalidate(self):
+        self.view()
+        self.client.login(username='user0', password=PASSWORD)
+        self.client.post(reverse('cms:article_edit', args=[self.article.pk]),
+                         dict(title='title', content='new content', category='other', selected_tags=['new_tag']))
+        response = self.view()
+        self.assertContains(response, 'new content')
+        self.assertContains(response, 'other')
+        self.assertContains(response, 'new_tag')
+        # 管理画面などから記事タグだけが変更された場合
+        ArticleTags(article=self.article, tag=self.tag).save()
+        self.assertContains(self.view(), 'tag,')
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'article_pages': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test_article_pages',
+            'OPTIONS': {'MAX_ENTRIES': 2, 'CULL_FREQUENCY': 2},
+        },
+    })
+    def test_lru(self):
+        from django.core.cache import caches
+
+        articles = [self.article] + [create_article(self.users[0], f'title{i}', self.category, []) for i in range(2)]
+        for article in articles[:2]:
+            pagecache.get_article_parts(article.pk, article.updated_at)
+        # 最初の記事を参照してから 3 件目を入れると 2 件目が追い出される
+        pagecache.get_article_parts(articles[0].pk, articles[0].updated_at)
+        pagecache.get_article_parts(articles[2].pk, articles[2].updated_at)
+        cache = caches['article_pages']
+        self.assertIsNotNone(cache.get(f'article:{articles[0].pk}'))
+        self.assertIsNone(cache.get(f'article:{articles[1].pk}'))
+        self.assertIsNotNone(cache.get(f'article:{articles[2].pk}'))
+
+
+class KeysetPaginatorTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('alice', PASSWORD)
+        categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        # お気に入り数と分野は同じ値の記事が多く, 分野のない (並び替えのキーが NULL の) 記事もある
+        for i in range(23):
+            if i % 5 == 4:
+                article = Article.objects.create(title=f'title{i % 7}', content='本文')
+                Author.objects.create(article=article, user=user)
+            else:
+                article = create_article(user, f'title{i % 7}', categories[i % 2], [])
+            Article.objects.filter(pk=article.pk).update(fav_num=i % 3)
+
+    def pages(self, paginator, cursor=None, backward=False):
+        pages = []
+        while True:
+            page = paginator.page(cursor)
+            pages.append([article.pk for article in page])
+            cursor = page.previous_cursor if backward else page.next_cursor
+            if cursor is None:
+                return pages
+
+    # 前に進んでから戻っても, 行が飛ばされたり重複したりしない
+    def test_walk(self):
+        for ordering in ('fav_num', '-fav_num', 'title', 'articlecategory__category', '-articlecategory__category'):
+            queryset = Article.objects.all()
+            key = ordering.lstrip('-')
+            expected = list(queryset.order_by(ordering, f'{ordering[:-len(key)]}pk').values_list('pk', flat=True))
+            paginator = paging.KeysetPaginator(queryset, per_page=4, ordering=ordering, count_cap=10)
+            forward = self.pages(paginator)
+            self.assertEqual(sum(forward, []), expected, ordering)
+            self.assertTrue(all(len(page) == 4 for page in forward[:-1]), ordering)
+            # 最後のページから前のページへ戻る
+            last = paginator.page(paginator.page(None).next_cursor)
+            for _ in range(len(forward) - 2):
+                last = paginator.page(last.next_cursor)
+            self.assertFalse(last.has_next)
+            self.assertEqual(self.pages(paginator, last.previous_cursor, backward=True), forward[-2::-1], ordering)
+            page = paginator.page(last.previous_cursor)
+            self.assertEqual((page.number, page.has_next, page.has_previous), (len(forward) - 1, True, True))
+            self.assertEqual((page.count, page.count_capped), (10, True))
+
+    # 改ざんされたカーソルや別の並び替えのカーソルは 1 ページ目として扱う
+    def test_invalid_cursor(self):
+        paginator = paging.KeysetPaginator(Article.objects.all(), per_page=4, ordering='fav_num')
+        first = paginator.page()
+        cursor = first.next_cursor
+        self.assertIsNotNone(paging.load_cursor(cursor, 'fav_num'))
+        tampered = cursor[:-1] + ('A' if cursor[-1] != 'A' else 'B')
+        other = paging.KeysetPaginator(Article.objects.all(), per_page=4, ordering='title').page().next_cursor
+        for invalid in (tampered, other, 'garbage', ''):
+            self.assertIsNone(paging.load_cursor(invalid, 'fav_num'))
+            page = paginator.page(invalid)
+            self.assertEqual([article.pk for article in page], [article.pk for article in first])
+            self.assertEqual((page.number, page.has_previous), (1, False))
+        # 署名し直さずに内容を書き換えたカーソルも受け付けない
+        state = signing.loads(cursor, salt=paging.CURSOR_SALT)
+        forged = signing.dumps(dict(state, pk=state['pk'] + 1), salt='another salt')
+        self.assertIsNone(paging.load_cursor(forged, 'fav_num'))
+
+
+class FullTextTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user('alice', PASSWORD)
+        category = Category.objects.create(category='graph')
+        cls.articles = {
+            title: create_article(user, title, category, [], content=content)
+            for title, content in (
+                ('ダイクストラ法', '最短経路を求める'),
+                ('最短経路問題', 'ダイクストラ法とベルマンフォード法. ダイクストラ法は負の辺を扱えない'),
+                ('木の直径', '二分木でない木でも DFS を 2 回行う'),
+                ('Union-Find', 'ＵＮＩＯＮ ＦＩＮＤ で連結成分を管理する'),
+            )
+        }
+
+    def search(self, query):
+        return sorted(article.title for article in fulltext.search(Article.objects.all(), query))
+
+    def test_tokenize(self):
+        # 日本語は文字 bigram. 区間の末尾の文字も 1 文字の検索のために入れる
+        self.assertEqual(fulltext.tokenize('グラフ理論'), 'グラ ラフ フ理 理論 論')
+        self.assertEqual(fulltext.tokenize('DFS, 木!'), 'df fs s 木')
+        # NFKC で正規化し, 小文字にする
+        self.assertEqual(fulltext.tokenize('ＤＦＳ　ｶﾅ'), fulltext.tokenize('dfs カナ'))
+        self.assertEqual(fulltext.tokenize(''), '')
+
+    def test_match_expression(self):
+        self.assertEqual(fulltext.match_expression('グラフ 理論'), '"グラ ラフ" AND "理論"')
+        self.assertEqual(fulltext.match_expression('木'), '"木"*')
+        self.assertEqual(fulltext.match_expression('ＵＮＩＯＮ'), fulltext.match_expression('union'))
+        # 記号だけの検索文字列は何にも一致しない式ではなく空にする
+        self.assertEqual(fulltext.match_expression('!?「」 --'), '')
+
+    def test_search(self):
+        self.assertTrue(fulltext.available())
+        self.assertEqual(self.search('ダイクストラ'), ['ダイクストラ法', '最短経路問題'])
+        self.assertEqual(self.search('最短 ダイクストラ'), ['ダイクストラ法', '最短経路問題'])
+        self.assertEqual(self.search('ベルマン'), ['最短経路問題'])
+        self.assertEqual(self.search('木'), ['木の直径'])
+        self.assertEqual(self.search('union find'), ['Union-Find'])
+        self.assertEqual(self.search('ＤＦＳ'), ['木の直径'])
+        self.assertEqual(self.search('プリム'), [])
+        # 記号だけなら絞り込まない
+        self.assertEqual(self.search('!?'), sorted(self.articles))
+
+    # タイトルに一致した記事は, 本文に何度も一致した記事より関連度が高い (search_rank が小さい)
+    def test_rank_title_weight(self):
+        ranked = fulltext.rank(fulltext.search(Article.objects.all(), 'ダイクストラ'), 'ダイクストラ')
+        self.assertEqual([article.title for article in ranked.order_by('search_rank')], ['ダイクストラ法', '最短経路問題'])
+
+    # FTS5 の表がない DB では部分一致 (icontains) で絞り込む
+    def test_fallback(self):
+        with mock.patch.object(fulltext, 'available', return_value=False):
+            self.assertEqual(self.search('ダイクストラ法'), ['ダイクストラ法', '最短経路問題'])
+            self.assertEqual(self.search('union'), ['Union-Find'])
+            self.assertEqual(self.search('!?'), sorted(self.articles))
+            ranked = fulltext.rank(Article.objects.all(), 'ダイクストラ法')
+            self.assertEqual({article.search_rank for article in ranked}, {0.0})
+            queryset = fulltext.search(Article.objects.all(), 'ダイクストラ法')
+            self.assertIn('LIKE', str(queryset.query))
+            self.assertNotIn(fulltext.FTS_TABLE, str(queryset.query))
+
+
+class SearchCacheTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        cls.category = Category.objects.create(category='graph')
+        cls.tags = [Tag.objects.create(tag=f'tag{i}') for i in range(2)]
+        cls.articles = [create_article(cls.users[i % 2], f'dfs {i}', cls.category, cls.tags) for i in range(12)]
+
+    def search(self, name='cms:search_ajax', **data):
+        return self.client.get(reverse(name), dict(dict(search_or_order='search'), **data))
+
+    def titles(self, response):
+        return [article.title for article in response.context['page_obj'].object_list]
+
+    def test_hit(self):
+        with CaptureQueriesContext(connection) as first:
+            titles = self.titles(self.search(title='dfs'))
+        with CaptureQueriesContext(connection) as second:
+            self.assertEqual(self.titles(self.search(title='dfs')), titles)
+        self.assertLess(len(second.captured_queries), len(first.captured_queries))
+        self.assertEqual(searchcache.stats(), dict(hits=1, misses=1, hit_ratio=0.5))
+        # HTML と JSON は別々にキャッシュする
+        self.search('cms:search_api', title='dfs')
+        self.assertEqual(searchcache.stats()['misses'], 2)
+
+    # 同じ結果になる検索条件は同じキャッシュを使う
+    def test_normalized(self):
+        self.search(selected_tags=['tag0', 'tag1'])
+        self.search(selected_tags=['tag1', 'tag0', 'tag1'])
+        self.search(selected_tags=['tag0', 'tag1'], search_or_order='-fav_num')
+        self.search(title='DFS  ')
+        self.search(title='dfs')
+        self.assertEqual(searchcache.stats()['hits'], 3)
+        # 内容が同じなら署名し直したカーソルでも同じ
+        cursor = self.search(title='dfs').context['page_obj'].next_cursor
+        state = signing.loads(cursor, salt=paging.CURSOR_SALT)
+        resigned = signing.dumps(dict(reversed(list(state.items()))), salt=paging.CURSOR_SALT)
+        self.assertNotEqual(resigned, cursor)
+        titles = self.titles(self.search(title='dfs', cursor=cursor))
+        hits = searchcache.stats()['hits']
+        self.assertEqual(self.titles(self.search(title='dfs', cursor=resigned)), titles)
+        self.assertEqual(searchcache.stats()['hits'], hits + 1)
+
+    def test_invalidate(self):
+        self.assertNotEqual(self.titles(self.search())[0], 'dfs 5')
+        self.client.login(username='user0', password=PASSWORD)
+        self.client.get(reverse('cms:fav_ajax', args=[self.articles[5].pk]))
+        self.assertEqual(self.titles(self.search())[0], 'dfs 5')
+        self.client.login(username='user1', password=PASSWORD)
+        self.client.post(reverse('cms:article_edit', args=[self.articles[5].pk]),
+                         dict(title='bfs', content='本文', category='graph', selected_tags=['tag0']))
+        self.assertEqual(self.titles(self.search())[0], 'bfs')
+        self.assertEqual(searchcache.stats()['hits'], 0)
+
+    # ログイン中のユーザーによって結果が変わる検索はキャッシュしない
+    def test_personal(self):
+        self.client.login(username='user0', password=PASSWORD)
+        self.assertEqual(len(self.titles(self.search(check=['author']))), 6)
+        self.client.login(username='user1', password=PASSWORD)
+        self.assertEqual(len(self.titles(self.search(check=['author']))), 6)
+        self.assertEqual(searchcache.stats(), dict(hits=0, misses=0, hit_ratio=None))
+
+    # 分野・タグごとの記事数もページと一緒にキャッシュする
+    def test_facets(self):
+        self.search('cms:search_api', selected_tags=['tag0'], facets=1)
+        with CaptureQueriesContext(connection) as context:
+            data = self.search('cms:search_api', selected_tags=['tag0'], facets=1).json()
+        self.assertEqual(data['facets']['tags'], [['tag0', 12], ['tag1', 12]])
+        self.assertNotIn('GROUP BY', '\n'.join(query['sql'] for query in context.captured_queries))
+        self.assertEqual(searchcache.stats()['hits'], 1)
+        # 記事数を求めない検索とは別にキャッシュする
+        self.assertIsNone(self.search('cms:search_api', selected_tags=['tag0']).json()['facets'])
+        self.assertEqual(searchcache.stats()['misses'], 2)
+
+    @override_settings(SEARCH_CACHE={'ENABLED': False})
+    def test_disabled(self):
+        self.search()
+        self.search()
+        self.assertEqual(searchcache.stats()['misses'], 0)
+
+    def test_metrics(self):
+        self.search()
+        self.search()
+        self.client.login(username='user0', password=PASSWORD)
+        User.objects.filter(username='user0').update(is_staff=True)
+        text = self.client.get(reverse('cms:metrics')).content.decode()
+        self.assertIn('# TYPE algopedia_search_cache_hits_total counter', text)
+        self.assertIn('algopedia_search_cache_hits_total 1', text)
+        self.assertIn('algopedia_search_cache_misses_total 1', text)
+
+
+class ConditionalGetTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        cls.category = Category.objects.create(category='category')
+        cls.article = create_article(cls.users[0], 'title', cls.category, [], content='old content')
+
+    def assertNotModified(self, url, data=None):
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        response = self.client.get(url, data, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        return response['ETag']
+
+    def assertModified(self, url, etag, data=None):
+        response = self.client.get(url, data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_article_view(self):
+        url = reverse('cms:article_view', args=[self.article.pk])
+        etag = self.assertNotModified(url)
+        self.client.login(username='user1', password=PASSWORD)
+        # 閲覧者が変わると版も変わる
+        self.assertModified(url, etag)
+        etag = self.assertNotModified(url)
+        self.client.get(reverse('cms:fav_ajax', args=[self.article.pk]))
+        self.assertModified(url, etag)
+
+    # 記事の更新日時が変わらない変更 (タグの付け替え, 執筆者の名前の変更) でも版が変わる
+    def test_article_view_without_update(self):
+        url = reverse('cms:article_view', args=[self.article.pk])
+        etag = self.assertNotModified(url)
+        bulk.set_article_tags(self.article.pk, ['newtag'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'newtag')
+        etag = response['ETag']
+        user = User.objects.get(pk=self.users[0].pk)
+        user.username = 'renamed'
+        user.save()
+        run_on_commit()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'renamed')
+
+    def test_article_edit(self):
+        url = reverse('cms:article_view', args=[self.article.pk])
+        etag = self.assertNotModified(url)
+        self.client.login(username='user0', password=PASSWORD)
+        self.client.post(reverse('cms:article_edit', args=[self.article.pk]),
+                         dict(title='title', content='new content', category='other', selected_tags=[]))
+        self.client.logout()
+        self.assertModified(url, etag)
+
+    def test_search_ajax(self):
+        url = reverse('cms:search_ajax')
+        etag = self.assertNotModified(url, dict(title='title'))
+        # 検索条件が変われば版も変わる
+        self.assertModified(url, etag, dict(title='other'))
+        create_article(self.users[1], 'title2', self.category, [])
+        self.assertModified(url, etag, dict(title='title'))
+
+    def test_search_api(self):
+        url = reverse('cms:search_api')
+        etag = self.assertNotModified(url, dict(title='title'))
+        create_article(self.users[1], 'title2', self.category, [])
+        self.assertModified(url, etag, dict(title='title'))
+
+    def test_user_page_ajax(self):
+        url = reverse('cms:user_page_ajax', args=[self.users[0].pk])
+        etag = self.assertNotModified(url)
+        Favorite.create_or_delete(self.article, self.users[1])
+        self.assertModified(url, etag)
+
+    def test_read_filter(self):
+        # 閲覧履歴での絞り込みには ETag を付けない
+        self.client.login(username='user1', password=PASSWORD)
+        response = self.client.get(reverse('cms:search_ajax'), dict(check=['read']))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ApiTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.other = User.objects.create_user('bob', PASSWORD)
+        categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        cls.articles = [
+            create_article(cls.user if i % 2 else cls.other, f'title{i} <b>', categories[i % 2], tags[i % 3:])
+            for i in range(25)
+        ]
+        Favorite.create_or_delete(cls.articles[3], cls.other)
+
+    def test_row(self):
+        article = Article.objects.get(pk=self.articles[3].pk)
+        data = self.client.get(reverse('cms:search_api'), dict(search_or_order='-fav_num')).json()
+        self.assertEqual(data['version'], 1)
+        self.assertEqual(data['columns'], ['id', 'title', 'author', 'category', 'tags', 'fav_num', 'updated_at'])
+        self.assertEqual(data['rows'][0], [
+            article.pk, 'title3 <b>', [self.user.pk, 'alice'], 'category1', ['tag0', 'tag1', 'tag2'], 1,
+            timezone.localtime(article.updated_at).isoformat(timespec='seconds'),
+        ])
+        self.assertEqual(data['search_or_order'], '-fav_num')
+        self.assertEqual(data['page'], dict(number=1, has_next=True, has_previous=False, count=25, count_capped=False,
+                                            next_cursor=data['page']['next_cursor'], previous_cursor=None))
+
+    # 執筆者・分野がまだない記事も (空欄で) 表示できる
+    def test_row_without_author_or_category(self):
+        orphan = Article.objects.create(title='orphan')
+        uncategorized = Article.objects.create(title='uncategorized')
+        Author.objects.create(article=uncategorized, user=self.user)
+        response = self.client.get(reverse('cms:index'), dict(search_or_order='-updated_at'))
+        self.assertEqual(response.status_code, 200)
+        rows = {row[0]: row for row in self.client.get(
+            reverse('cms:search_api'), dict(search_or_order='-updated_at')).json()['rows']}
+        self.assertEqual(rows[orphan.pk][2:4], [None, None])
+        self.assertEqual(rows[uncategorized.pk][2:4], [[self.user.pk, 'alice'], None])
+
+    # HTML の応答と同じ記事を同じ順に, 同じページ分けで返すこと
+    def assertSameAsHtml(self, html_url, api_url, data):
+        html_cursor = api_cursor = None
+        while True:
+            page_obj = self.client.get(html_url, dict(data, cursor=html_cursor or '')).context['page_obj']
+            page = self.client.get(api_url, dict(data, cursor=api_cursor or '')).json()
+            self.assertEqual([row[0] for row in page['rows']], [article.pk for article in page_obj.object_list], data)
+            self.assertEqual(
+                (page['page']['number'], page['page']['has_next'], page['page']['has_previous'], page['page']['count']),
+                (page_obj.number, page_obj.has_next, page_obj.has_previous, page_obj.count))
+            if not page_obj.has_next:
+                break
+            html_cursor, api_cursor = page_obj.next_cursor, page['page']['next_cursor']
+
+    def test_same_as_html(self):
+        self.client.login(username='alice', password=PASSWORD)
+        html_url, api_url = reverse('cms:search_ajax'), reverse('cms:search_api')
+        for data in ({}, dict(title='title1'), dict(category='category0', selected_tags=['tag2']), dict(check=['author'])):
+            for order in ('', 'title', '-fav_num', 'updated_at', '-author__user__username', 'articlecategory__category'):
+                self.assertSameAsHtml(html_url, api_url, dict(data, search_or_order=order))
+        html_url = reverse('cms:user_page_ajax', args=[self.user.pk])
+        api_url = reverse('cms:user_page_api', args=[self.user.pk])
+        for order in ('', '-title', 'updated_at'):
+            self.assertSameAsHtml(html_url, api_url, dict(search_or_order=order))
+
+    def test_user_page_api(self):
+        data = self.client.get(reverse('cms:user_page_api', args=[self.user.pk])).json()
+        self.assertEqual(data['search_or_order'], 'search')
+        self.assertEqual({tuple(row[2]) for row in data['rows']}, {(self.user.pk, 'alice')})
+        response = self.client.get(reverse('cms:user_page_api', args=[0]))
+        self.assertEqual(response.status_code, 404)
+
+    # ページは最初の一覧を API と同じ JSON で埋め込む
+    def test_pages(self):
+        def without_cursors(data):
+            data = json.loads(json.dumps(data))
+            data['page'].pop('next_cursor')
+            return data
+
+        response = self.client.get(reverse('cms:index'))
+        self.assertContains(response, f'id="{common_constants()["htmls"]["search"]["id"]["data"]}"')
+        expected = self.client.get(reverse('cms:search_api'), dict(search_or_order='-updated_at')).json()
+        self.assertEqual(without_cursors(response.context['articles']), without_cursors(expected))
+        self.assertNotContains(response, 'title1 <b>')
+
+        self.client.login(username='alice', password=PASSWORD)
+        response = self.client.get(reverse('cms:user_page', args=[self.user.pk]))
+        expected = self.client.get(reverse('cms:user_page_api', args=[self.user.pk])).json()
+        expected['search_or_order'] = None
+        self.assertEqual(without_cursors(response.context['articles']), without_cursors(expected))
+        self.assertContains(response, 'has_authority: true')
+
+
+class ImportArticlesTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.category = Category.objects.create(category='graph')
+        cls.article = create_article(cls.user, 'dijkstra', cls.category, [])
+        UserStats.rebuild()
+
+    def import_articles(self, text, suffix, **options):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, encoding='utf-8', delete=False) as file:
+            file.write(text)
+        self.addCleanup(os.remove, file.name)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_articles', file.name, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_jsonl(self):
+        rows = [
+            dict(title='bfs', content='幅優先探索', category='graph', tags=['queue'], author='alice'),
+            dict(title='segtree', content='セグメント木', category='data', tags=['tree', 'tree', 'range'], author='alice'),
+            dict(title='', content='empty', category='graph', tags=[], author='alice'),
+            dict(title='unknown', content='author', category='graph', tags=[], author='nobody'),
+        ]
+        text = '\n'.join(json.dumps(row, ensure_ascii=False) for row in rows) + '\nnot json\n'
+        out, err = self.import_articles(text, '.jsonl', batch_size=1)
+        self.assertIn('2 件の記事を登録しました (スキップ: 3 件)', out)
+        self.assertEqual(err.count('スキップしました'), 3)
+
+        article = Article.objects.get(title='segtree')
+        self.assertEqual(article.author.user, self.user)
+        self.assertEqual(article.articlecategory.category_id, 'data')
+        self.assertEqual(article.get_tag_names(), ['range', 'tree'])
+        self.assertEqual(Category.objects.get(pk='graph').article_num, 2)
+        self.assertEqual(Category.objects.get(pk='data').article_num, 1)
+        self.assertEqual(Tag.objects.get(pk='tree').article_num, 1)
+        stats = UserStats.objects.get(pk=self.user.pk)
+        self.assertEqual(stats.article_num, 3)
+        self.assertEqual(stats.get_category_counts(), [('data', 1), ('graph', 2)])
+        response = self.client.get(reverse('cms:search_ajax'), dict(title='セグメント'))
+        self.assertEqual([a.title for a in response.context['page_obj']], ['segtree'])
+
+    def test_csv(self):
+        text = 'title,content,category,tags,author\nflow,最大流,graph,flow graph,alice\n'
+        out, err = self.import_articles(text, '.csv')
+        self.assertIn('1 件の記事を登録しました', out)
+        article = Article.objects.get(title='flow')
+        self.assertGreater(article.pk, self.article.pk)
+        self.assertEqual(article.get_tag_names(), ['flow', 'graph'])
+        self.assertEqual(Tag.objects.get(pk='graph').article_num, 1)
+
+
+class ExportArticlesTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.staff = User.objects.create_user('staff', PASSWORD, is_staff=True)
+        category = Category.objects.create(category='graph')
+        tags = [Tag.objects.create(tag=tag) for tag in ('queue', 'tree')]
+        cls.articles = [create_article(cls.user, f'title{i}', category, tags[:i]) for i in range(3)]
+        Favorite.create_or_delete(cls.articles[1], cls.staff)
+
+    def export(self, **options):
+        out = io.StringIO()
+        call_command('export_articles', stdout=out, **options)
+        return out.getvalue()
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self.export(chunk_size=2).splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['title0', 'title1', 'title2'])
+        self.assertEqual(rows[2]['tags'], ['queue', 'tree'])
+        self.assertEqual(rows[1]['category'], 'graph')
+        self.assertEqual(rows[1]['author'], 'alice')
+        self.assertEqual(rows[1]['fav_num'], 1)
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export(format='csv'))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[2]['tags'], 'queue tree')
+
+    def test_since(self):
+        Article.objects.filter(pk=self.articles[0].pk).update(updated_at=timezone.now() - timedelta(days=10))
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+        rows = [json.loads(line) for line in self.export(since=since).splitlines()]
+        self.assertEqual([row['title'] for row in rows], ['title1', 'title2'])
+
+    def test_view(self):
+        url = reverse('cms:export_articles')
+        self.client.login(username='alice', password=PASSWORD)
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.login(username='staff', password=PASSWORD)
+        response = self.client.get(url, dict(format='csv'))
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(len(list(csv.DictReader(io.StringIO(content)))), 3)
+        self.assertEqual(self.client.get(url, dict(since='yesterday')).status_code, 400)
+
+
+class AutocompleteTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(name, PASSWORD) for name in ('Graph', 'grid', 'tree')]
+        category = Category.objects.create(category='graph')
+        Category.objects.create(category='Greedy')
+        tags = [Tag.objects.create(tag=tag) for tag in ('grundy', 'graph', 'gcd')]
+        create_article(cls.users[0], 'graph theory', category, tags[:2])
+        create_article(cls.users[1], 'Graph coloring', category, tags[1:])
+        create_article(cls.users[1], 'greedy', category, [])
+
+    def setUp(self):
+        discard_on_commit()
+
+    def complete(self, kind, q, **params):
+        response = self.client.get(reverse('cms:autocomplete_ajax'), dict(kind=kind, q=q, **params))
+        self.assertEqual(response.status_code, 200)
+        return [result['value'] for result in response.json()['results']]
+
+    def test_complete(self):
+        # 記事数の多い順, 同じなら名前順 (大文字・小文字は区別しない)
+        self.assertEqual(self.complete('tag', 'g'), ['graph', 'gcd', 'grundy'])
+        self.assertEqual(self.complete('tag', 'gr'), ['graph', 'grundy'])
+        self.assertEqual(self.complete('tag', 'gr', limit=1), ['graph'])
+        self.assertEqual(self.complete('category', 'G'), ['graph', 'Greedy'])
+        self.assertEqual(self.complete('user', 'g'), ['grid', 'Graph'])
+        self.assertEqual(self.complete('title', 'graph'), ['Graph coloring', 'graph theory'])
+        self.assertEqual(self.complete('tag', 'x'), [])
+        response = self.client.get(reverse('cms:autocomplete_ajax'), dict(kind='tag', q='gra'))
+        self.assertEqual(response.json()['results'][0]['label'], '記事数: 2')
+        self.assertEqual(self.client.get(reverse('cms:autocomplete_ajax'), dict(kind='x')).status_code, 400)
+
+    def test_refresh_on_write(self):
+        self.assertEqual(self.complete('tag', 'h'), [])
+        Tag.objects.create(tag='heap')
+        run_on_commit()
+        self.assertEqual(self.complete('tag', 'h'), ['heap'])
+        Tag.objects.get(pk='heap').delete()
+        run_on_commit()
+        self.assertEqual(self.complete('tag', 'h'), [])
+        # ログインでは変わらない
+        self.client.login(username='tree', password=PASSWORD)
+        self.assertFalse(connection.run_on_commit)
+
+    # 書き込みは該当する候補だけを挿入・削除・更新し, 索引全体は作り直さない
+    def test_incremental(self):
+        for kind in autocomplete.indexes:
+            self.complete(kind, 'g')
+        loaders = [mock.patch.object(index, 'loader', side_effect=AssertionError('rebuilt'))
+                   for index in autocomplete.indexes.values()]
+        for loader in loaders:
+            loader.start()
+            self.addCleanup(loader.stop)
+        self.client.login(username='tree', password=PASSWORD)
+        self.client.post(reverse('cms:article_add'),
+                         dict(title='Grundy number', content='本文', category='game', selected_tags=['grundy', 'gcd']))
+        article = Article.objects.get(title='Grundy number')
+        bulk.create_articles([dict(title='graph search', content='本文', category='graph', tags=['gcd'],
+                                   author=self.users[2].pk)])
+        # コミットまでは反映しない
+        self.assertEqual(self.complete('title', 'grundy'), [])
+        run_on_commit()
+        self.assertEqual(self.complete('title', 'grundy'), ['Grundy number'])
+        self.assertEqual(self.complete('title', 'graph'), ['Graph coloring', 'graph search', 'graph theory'])
+        self.assertEqual(self.complete('tag', 'g'), ['gcd', 'graph', 'grundy'])
+        self.assertEqual(self.complete('category', 'g'), ['graph', 'game', 'Greedy'])
+        self.assertEqual(self.complete('user', 'g'), ['grid', 'Graph'])
+        self.assertEqual(self.complete('user', 't', limit=1), ['tree'])
+        self.assertEqual(autocomplete.complete('user', 'tree')[0]['score'], 2)
+        bulk.delete_articles([article.pk])
+        User.objects.filter(username='grid').update(is_active=False)
+        User.objects.get(username='grid').save()
+        run_on_commit()
+        self.assertEqual(self.complete('title', 'grundy'), [])
+        self.assertEqual(self.complete('tag', 'g'), ['gcd', 'graph', 'grundy'])
+        self.assertEqual(autocomplete.complete('tag', 'grundy')[0]['score'], 1)
+        self.assertEqual(autocomplete.complete('user', 'tree')[0]['score'], 1)
+        self.assertEqual(self.complete('user', 'g'), ['Graph'])
+
+    # お気に入り数の増減でタイトルの順位も変わる (バッファ経由でも同じ)
+    def test_fav_num_changes_title_order(self):
+        self.assertEqual(self.complete('title', 'graph'), ['Graph coloring', 'graph theory'])
+        theory = Article.objects.get(title='graph theory')
+        Favorite.create_or_delete(theory, self.users[1])
+        run_on_commit()
+        self.assertEqual(self.complete('title', 'graph'), ['graph theory', 'Graph coloring'])
+        coloring = Article.objects.get(title='Graph coloring')
+        with override_settings(FAV_NUM_BUFFER={'ENABLED': True, 'FLUSH_INTERVAL': 3600}):
+            for user in self.users[1:]:
+                Favorite.create_or_delete(coloring, user)
+            fav_num_buffer.flush()
+        run_on_commit()
+        self.assertEqual(self.complete('title', 'graph'), ['Graph coloring', 'graph theory'])
+        self.assertEqual(autocomplete.complete('title', 'graph')[0]['score'], 2)
+
+    # 書き込みでは, 変化したキーの接頭辞の結果だけを忘れる
+    def test_forget_affected_prefixes(self):
+        index = autocomplete.PrefixIndex(lambda: [(f'{c}{i:02}', i, {}) for c in 'ab' for i in range(20)])
+        self.assertEqual([r['value'] for r in index.search('a', 1)], ['a19'])
+        self.assertEqual([r['value'] for r in index.search('b', 1)], ['b19'])
+        self.assertEqual(set(index._cache), {'a', 'b'})
+        index.apply('_put', 'a20', 20, {})
+        self.assertEqual(set(index._cache), {'b'})
+        self.assertEqual([r['value'] for r in index.search('a', 1)], ['a20'])
+
+    # 最初に作っている間にコミットされた書き込みも, 作り終えたら反映する
+    def test_apply_during_first_build(self):
+        def loader():
+            index.apply('_put', 'graph search', 0, {})
+            index.apply('_delete', ['greedy'])
+            return [('graph', 1, {}), ('greedy', 1, {})]
+
+        index = autocomplete.PrefixIndex(loader)
+        self.assertEqual([r['value'] for r in index.search('g')], ['graph', 'graph search'])
+        index.apply('_add_scores', {'graph search': 2})
+        self.assertEqual([r['value'] for r in index.search('g')], ['graph search', 'graph'])
+
+    # MAX_AGE 秒経つと裏で作り直す (その間は古い索引で答える)
+    @override_settings(AUTOCOMPLETE={'MAX_AGE': 0})
+    def test_rebuild_in_background(self):
+        index = autocomplete.indexes['tag']
+        self.complete('tag', 'g')
+        with mock.patch.object(autocomplete.PrefixIndex, '_rebuild_in_background') as rebuild:
+            self.assertEqual(self.complete('tag', 'g'), ['graph', 'gcd', 'grundy'])
+        rebuild.assert_called_once_with()
+        self.assertIsNotNone(index._entries)
+
+
+class ArticleEditTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.category = Category.objects.create(category='graph')
+        cls.tags = [Tag.objects.create(tag=f'tag{i}') for i in range(20)]
+        cls.article = create_article(cls.user, 'title', cls.category, cls.tags[:10])
+        UserStats.rebuild()
+
+    def setUp(self):
+        self.client.login(username='alice', password=PASSWORD)
+
+    def edit(self, category, tags, article_id=None):
+        url = reverse('cms:article_edit', args=[article_id]) if article_id else reverse('cms:article_add')
+        response = self.client.post(url, dict(title='title', content='content', category=category, selected_tags=tags))
+        return json.loads(response.content)
+
+    def article_nums(self, model):
+        return dict(model.objects.filter(article_num__gt=0).values_list('pk', 'article_num'))
+
+    def test_edit_tags(self):
+        tags = [f'tag{i}' for i in range(5, 15)] + [f'new{i}' for i in range(5)]
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.edit('tree', tags, self.article.pk)['status'], 0)
+        # タグの数によらず一定のクエリ数で済む
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(len(queries), 30, '\n'.join(queries))
+        self.assertEqual(Article.objects.get(pk=self.article.pk).get_tag_names(), sorted(tags))
+        self.assertEqual(self.article_nums(Tag), {tag: 1 for tag in tags})
+        self.assertEqual(self.article_nums(Category), {'tree': 1})
+        stats = UserStats.objects.get(pk=self.user.pk)
+        self.assertEqual(stats.get_tag_counts(), sorted((tag, 1) for tag in tags))
+        self.assertEqual(stats.get_category_counts(), [('tree', 1)])
+
+    def test_add(self):
+        self.assertEqual(self.edit('graph', ['tag0', 'heap', 'heap'])['status'], 0)
+        article = Article.objects.latest('pk')
+        self.assertEqual(article.author.user, self.user)
+        self.assertEqual(article.get_tag_names(), ['heap', 'tag0'])
+        self.assertEqual(Tag.objects.get(pk='tag0').article_num, 2)
+        self.assertEqual(Category.objects.get(pk='graph').article_num, 2)
+        self.assertEqual(UserStats.objects.get(pk=self.user.pk).article_num, 2)
+
+    def test_invalid(self):
+        result = self.edit('x' * 16, ['tag0', 'y' * 16], self.article.pk)
+        self.assertEqual(result['status'], 1)
+        self.assertIn('15 文字以下', result['err']['category'])
+        self.assertIn('y' * 16, result['err']['tag'])
+        self.assertFalse(Tag.objects.filter(pk='y' * 16).exists())
+
+
+class DeleteArticlesTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        cls.articles = [
+            create_article(cls.users[i % 2], f'title{i}', categories[i % 2], tags[:i % 3 + 1]) for i in range(10)
+        ]
+        for article in cls.articles[:5]:
+            Favorite.create_or_delete(article, cls.users[1])
+            ReadingHistory.objects.create(article=article, user=cls.users[1])
+        UserStats.rebuild()
+
+    def assertCounters(self):
+        # 削除後の記事数・統計が集計し直した値と一致する
+        for category in Category.objects.all():
+            self.assertEqual(category.article_num, ArticleCategory.objects.filter(category=category).count())
+        for tag in Tag.objects.all():
+            self.assertEqual(tag.article_num, ArticleTags.objects.filter(tag=tag).count())
+        user_ids = UserStats.objects.values_list('pk', flat=True)
+        self.assertEqual(UserStats.load(user_ids), UserStats.collect(user_ids))
+
+    def test_delete_articles(self):
+        ids = [article.pk for article in self.articles[:7]]
+        fav_num_buffer.add(ids[0], 1)
+        self.addCleanup(fav_num_buffer.discard)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(bulk.delete_articles(ids + [0]), 7)
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertLessEqual(len(queries), 30, '\n'.join(queries))
+        # 削除の前の SELECT で本文などを読まない
+        self.assertFalse([sql for sql in queries if '"cms_article"."content"' in sql])
+        # まだ反映されていないお気に入り数も捨てる
+        self.assertIsNone(fav_num_buffer.pending(ids[0]))
+        self.assertEqual(Article.objects.count(), 3)
+        self.assertFalse(Favorite.objects.exists())
+        self.assertFalse(ReadingHistory.objects.exists())
+        self.assertFalse(ArticleTags.objects.filter(article_id__in=ids).exists())
+        self.assertCounters()
+
+    def test_delete(self):
+        self.client.login(username='user0', password=PASSWORD)
+        self.client.get(reverse('cms:article_del', args=[self.articles[0].pk]))
+        self.assertFalse(Article.objects.filter(pk=self.articles[0].pk).exists())
+        self.assertCounters()
+
+    def test_admin_action(self):
+        User.objects.create_superuser('admin', PASSWORD)
+        self.client.login(username='admin', password=PASSWORD)
+        ids = [article.pk for article in self.articles[3:]]
+        response = self.client.post(reverse('admin:cms_article_changelist'),
+                                    {'action': 'delete_selected', 'post': 'yes', '_selected_action': ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Article.objects.count(), 3)
+        self.assertCounters()
+
+
+class ReconcileCountersTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(2)]
+        category = Category.objects.create(category='graph')
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        cls.articles = [create_article(cls.users[0], f'title{i}', category, tags[:i + 1]) for i in range(3)]
+        Favorite.create_or_delete(cls.articles[0], cls.users[1])
+        UserStats.rebuild()
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command('reconcile_counters', *args, '--chunk-size=2', verbosity=2, stdout=out)
+        return out.getvalue()
+
+    def test_no_drift(self):
+        self.assertIn('ずれはありませんでした', self.reconcile())
+
+    def test_fix(self):
+        # 一括更新などで数がずれた状態
+        Article.objects.filter(pk=self.articles[0].pk).update(fav_num=5)
+        Tag.objects.filter(pk='tag0').update(article_num=0)
+        Tag.objects.filter(pk='tag2').update(article_num=7)
+        Category.objects.update(article_num=1)
+        UserStats.objects.filter(pk=self.users[0].pk).update(article_num=10)
+
+        out = self.reconcile('--dry-run')
+        self.assertIn('Article.fav_num: 1 件のずれ', out)
+        self.assertIn('Tag.article_num: 2 件のずれ', out)
+        self.assertIn('tag2: 7 -> 1', out)
+        self.assertIn('Category.article_num: 1 件のずれ', out)
+        self.assertIn('UserStats: 1 件のずれ', out)
+        self.assertEqual(Tag.objects.get(pk='tag2').article_num, 7)
+
+        self.assertIn('5 件のずれを直しました', self.reconcile())
+        self.assertEqual(Article.objects.get(pk=self.articles[0].pk).fav_num, 1)
+        self.assertEqual(dict(Tag.objects.values_list('tag', 'article_num')), {'tag0': 3, 'tag1': 2, 'tag2': 1})
+        self.assertEqual(Category.objects.get(pk='graph').article_num, 3)
+        self.assertEqual(UserStats.objects.get(pk=self.users[0].pk).article_num, 3)
+        self.assertIn('ずれはありませんでした', self.reconcile())
+
+
+class ArticleSearchTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        category = Category.objects.create(category='graph')
+        cls.tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        # tag0 は全ての記事, tag1 は 7 件, tag2 は 'rare' だけ
+        cls.articles = [create_article(cls.user, f'title{i}', category, cls.tags[:1] + cls.tags[1:2] * (i % 2 == 0))
+                        for i in range(11)]
+        cls.articles.insert(0, create_article(cls.user, 'rare', category, cls.tags))
+
+    def search(self, **data):
+        return [row[1] for row in self.client.get(reverse('cms:search_api'), data).json()['rows']]
+
+    def test_tag_modes(self):
+        self.assertEqual(len(self.search(selected_tags=['tag1', 'tag2'])), 7)
+        self.assertEqual(self.search(selected_tags=['tag1', 'tag2'], tag_mode='all'), ['rare'])
+        self.assertEqual(len(self.search(selected_tags=['tag0'], tag_mode='all')), 10)
+
+    # 並び替えは ORDER_FIELDS の列だけ. それ以外の指定は既定の並び替えにする
+    def test_ordering_whitelist(self):
+        for search_or_order in ('content', 'author__user__password', '-author__user__password', 'search_rank', '--title'):
+            self.assertEqual(ArticleSearch(search_or_order=search_or_order).ordering, '-fav_num')
+            self.assertEqual(ArticleSearch(title='dfs', search_or_order=search_or_order).ordering, 'search_rank')
+        self.assertEqual(ArticleSearch(search_or_order='-author__user__username').ordering, '-author__user__username')
+        self.assertEqual(self.client.get(reverse('cms:search_api'), dict(search_or_order='content')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('cms:search_api'), dict(search_or_order='--title')).status_code, 200)
+
+    # タグなどとは JOIN せず, 重複除去もしない
+    def test_semi_join(self):
+        self.client.login(username='alice', password=PASSWORD)
+        with CaptureQueriesContext(connection) as context:
+            self.search(selected_tags=['tag0', 'tag2'], category='graph', check=['fav', 'read'])
+        sql = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertIn('EXISTS', sql)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotRegex(sql, r'JOIN "cms_(articletags|favorite|readinghistory)"')
+
+    # 当てはまる記事が多い条件は EXISTS, 少ない条件は IN
+    def test_plan(self):
+        def plan(**kwargs):
+            search = ArticleSearch(per_page=1, **kwargs)
+            return search.plan(search.semi_joins())
+
+        self.assertEqual(plan(tags=['tag0']), [True])
+        self.assertEqual(plan(tags=['tag2']), [False])
+        self.assertEqual(plan(tags=['tag0', 'tag2'], tag_mode='all'), [True, False])
+        # どちらも多い条件
+        self.assertEqual(plan(tags=['tag0', 'tag1'], tag_mode='all', search_or_order='title'), [True, True])
+        self.assertEqual(plan(tags=['tag0'], search_or_order='articlecategory__category'), [False])
+        self.assertEqual(plan(tags=['tag2'], title='title'), [True])
+
+    def test_checks(self):
+        anonymous = ArticleSearch(checks=['fav'], user=AnonymousUser())
+        self.assertEqual(anonymous.checks, ())
+        self.assertIsNotNone(anonymous.cache_params())
+        search = ArticleSearch(checks=['fav', 'unknown', 'fav'], user=self.user)
+        self.assertEqual(search.checks, ('fav',))
+        self.assertIsNone(search.cache_params())
+        Favorite.create_or_delete(self.articles[3], self.user)
+        self.client.login(username='alice', password=PASSWORD)
+        self.assertEqual(self.search(check=['fav']), ['title2'])
+
+    def test_facets(self):
+        def facets(**data):
+            return self.client.get(reverse('cms:search_api'), dict(facets=1, **data)).json()['facets']
+
+        self.assertEqual(facets(selected_tags=['tag1']), dict(
+            categories=[['graph', 7]], tags=[['tag0', 7], ['tag1', 7], ['tag2', 1]], capped=False))
+        self.assertEqual(facets(title='rare')['tags'], [['tag0', 1], ['tag1', 1], ['tag2', 1]])
+        self.assertEqual(facets(selected_tags=['tag0'], excluded_tags=['tag1'])['tags'], [['tag0', 5]])
+        # 条件がなければ保存しておいた記事数
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(ArticleSearch().facets()['tags'], [['tag0', 12], ['tag1', 7], ['tag2', 1]])
+        self.assertNotIn('GROUP BY', '\n'.join(query['sql'] for query in context.captured_queries))
+        # 指定がなければ数えない
+        self.assertIsNone(self.client.get(reverse('cms:search_api'), dict(title='rare')).json()['facets'])
+        searchcache.clear()
+        with mock.patch.object(articlesearch, 'FACET_CAP', 3), mock.patch.object(articlesearch, 'FACET_LIMIT', 2):
+            self.assertEqual(facets(selected_tags=['tag1']), dict(
+                categories=[['graph', 3]], tags=[['tag0', 3], ['tag1', 3]], capped=True))
+        response = self.client.get(reverse('cms:search_ajax'), dict(selected_tags=['tag2'], facets=1))
+        self.assertContains(response, 'value="tag2"')
+        self.assertEqual(response.context['facets']['categories'], [['graph', 1]])
+
+    def test_cache_params(self):
+        self.assertEqual(ArticleSearch(tags=['tag1', 'tag0', 'tag1']).cache_params(),
+                         ArticleSearch(tags=['tag0', 'tag1'], search_or_order='-fav_num').cache_params())
+        self.assertEqual(ArticleSearch(tags=['tag1'], tag_mode='all').cache_params(),
+                         ArticleSearch(tags=['tag1']).cache_params())
+        self.assertNotEqual(ArticleSearch(tags=['tag0', 'tag1'], tag_mode='all').cache_params(),
+                            ArticleSearch(tags=['tag0', 'tag1']).cache_params())
+
+
+class SemiJoinBenchmarkTestCase(CmsTestCase):
+    # 大きめのデータで, 準結合 (ArticleSearch) と以前の JOIN + DISTINCT の SQLite の実行量 (VM の命令数) を比べる
+    # 時間は環境によって揺れるので, 同じデータなら同じになる命令数で比べる
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('generate_corpus', '--users=100', '--articles=4000', '--categories=10', '--tags=100',
+                     '--favorites=4000', '--reads=4000', '--batch-size=1000', stdout=io.StringIO())
+        cls.tags = list(Tag.objects.order_by('-article_num', 'tag').values_list('tag', flat=True))
+        cls.category = Category.objects.order_by('-article_num').values_list('category', flat=True)[0]
+        cls.user = User.objects.annotate(n=Count('favorite')).order_by('-n')[0]
+
+    # 以前の検索 (views.search_articles) と同じ絞り込み
+    def join_distinct(self, search):
+        post_list = Article.objects.for_rows()
+        if search.category:
+            post_list = post_list.filter(articlecategory__category=search.category)
+        if search.tags and search.tag_mode == 'all':
+            for tag in search.tags:
+                post_list = post_list.filter(articletags__tag=tag)
+        elif search.tags:
+            post_list = post_list.filter(articletags__tag__in=search.tags)
+        if 'fav' in search.checks:
+            post_list = post_list.filter(favorite__user=search.user)
+        return post_list.distinct()
+
+    # 1 ページ分 (と, 準結合の場合は見積もり) の取得に要した VM の命令数 (100 単位) と, 記事の ID
+    @staticmethod
+    def steps(build, ordering):
+        connection.ensure_connection()
+        steps = []
+        connection.connection.set_progress_handler(lambda: steps.append(1) and 0, 100)
+        try:
+            ids = [article.pk for article in build().order_by(ordering, 'article_id')[:11]]
+        finally:
+            connection.connection.set_progress_handler(None, 100)
+        return len(steps), ids
+
+    # factor 倍以上少ないこと. slack は見積もりのクエリの分の余裕
+    def assertFaster(self, factor=1, slack=0, **kwargs):
+        for ordering in ('-fav_num', 'updated_at', 'title'):
+            search = ArticleSearch(search_or_order=ordering, **kwargs)
+            old_steps, old_ids = self.steps(lambda: self.join_distinct(search), ordering)
+            new_steps, new_ids = self.steps(lambda: search.filter(Article.objects.for_rows()), ordering)
+            self.assertEqual(new_ids, old_ids)
+            self.assertLessEqual(new_steps * factor, old_steps + slack, (kwargs, ordering))
+
+    def test_popular_tags(self):
+        self.assertFaster(factor=10, tags=self.tags[:1])
+        self.assertFaster(factor=10, tags=self.tags[:3])
+        self.assertFaster(factor=5, tags=self.tags[:2], tag_mode='all')
+
+    # 当てはまる記事が少なければどちらも速い
+    def test_rare_tag(self):
+        self.assertFaster(slack=2, tags=self.tags[-1:])
+
+    def test_category(self):
+        self.assertFaster(factor=10, category=self.category)
+        self.assertFaster(factor=2, category=self.category, tags=self.tags[:1])
+
+    def test_favorites(self):
+        self.assertFaster(factor=2, checks=['fav'], user=self.user)
+
+
+class BitmapTestCase(TestCase):
+
+    def test_operations(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            # 疎な区間 (array) と密な区間 (int) が混ざるように, 大きさと範囲を変える
+            a = {rng.randrange(rng.choice((100, 70000, 300000))) for _ in range(rng.choice((0, 10, 5000, 50000)))}
+            b = {rng.randrange(rng.choice((100, 70000, 300000))) for _ in range(rng.choice((0, 10, 5000, 50000)))}
+            x, y = bitmap.Bitmap(a), bitmap.Bitmap(b)
+            self.assertEqual((list(x), len(x)), (sorted(a), len(a)))
+            self.assertEqual(list(x & y), sorted(a & b))
+            self.assertEqual(list(x | y), sorted(a | b))
+            self.assertEqual(list(x - y), sorted(a - b))
+            self.assertEqual(list(bitmap.intersection([x, y, x | y])), sorted(a & b))
+            self.assertEqual(list(bitmap.union([x, y])), sorted(a | b))
+
+    def test_add_discard(self):
+        x = bitmap.Bitmap(range(0, 100000, 2))
+        y = x - bitmap.Bitmap([4])
+        for value in (1, 4, 65537, 200000):
+            y.add(value)
+        y.discard(0)
+        y.discard(99998)
+        self.assertEqual(list(y), sorted(set(range(2, 99998, 2)) | {1, 65537, 200000}))
+        self.assertTrue(1 in y and 0 not in y and 3 not in y)
+        # 元の集合は変わらない (区間を共有していても複製してから変更する)
+        self.assertEqual(list(x), list(range(0, 100000, 2)))
+
+    def test_compressed(self):
+        self.assertEqual(bitmap.Bitmap([1, 1000000, 5000000]).nbytes(), 6)
+        self.assertEqual(bitmap.Bitmap(range(65536)).nbytes(), 8192)
+
+
+# TestCase ではコミットされないので, 登録された on_commit の処理をここで実行する
+def run_on_commit():
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+
+# setUpTestData で登録された on_commit の処理を捨てる (索引を作った後で実行されると二重に反映される)
+def discard_on_commit():
+    connection.run_on_commit = []
+
+
+@override_settings(TAG_INDEX={'ENABLED': True, 'MAX_AGE': 3600})
+class TagIndexTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        cls.tags = [Tag.objects.create(tag=f'tag{i}') for i in range(4)]
+        cls.articles = [
+            create_article(cls.user, f'title{i}', cls.categories[i % 2], [tag for j, tag in enumerate(cls.tags) if i >> j & 1])
+            for i in range(16)
+        ]
+
+    def setUp(self):
+        discard_on_commit()
+
+    def ids(self, *indices):
+        return [self.articles[i].pk for i in indices]
+
+    def lookup(self, **kwargs):
+        return list(tagindex.lookup(**kwargs))
+
+    def test_lookup(self):
+        # i 番目の記事は i の j ビット目が立っていれば tag{j} を持ち, 分野は category{i % 2}
+        self.assertEqual(self.lookup(tags=['tag0']), self.ids(*range(1, 16, 2)))
+        self.assertEqual(self.lookup(tags=['tag0', 'tag1'], match_all=True), self.ids(3, 7, 11, 15))
+        self.assertEqual(self.lookup(tags=['tag2', 'tag3']), self.ids(*range(4, 16)))
+        self.assertEqual(self.lookup(tags=['tag2', 'tag3'], exclude_tags=['tag0', 'tag1']), self.ids(4, 8, 12))
+        self.assertEqual(self.lookup(category='category0', tags=['tag1'], exclude_tags=['tag2']), self.ids(2, 10))
+        self.assertEqual(self.lookup(category='category1', tags=['tag0'], match_all=True), self.ids(*range(1, 16, 2)))
+        self.assertEqual(self.lookup(tags=['no_such_tag']), [])
+
+    # 索引を使わない場合と同じ結果になること
+    def test_same_as_sql(self):
+        url = reverse('cms:search_api')
+        cases = [
+            dict(selected_tags=['tag0', 'tag3']),
+            dict(selected_tags=['tag0', 'tag3'], tag_mode='all'),
+            dict(category='category0', selected_tags=['tag1'], excluded_tags=['tag2']),
+            dict(selected_tags=['tag1'], excluded_tags=['tag0', 'tag3'], search_or_order='title'),
+            dict(category='category1', username='alice', search_or_order='-updated_at'),
+        ]
+        for data in cases:
+            indexed = self.client.get(url, data).json()['rows']
+            searchcache.clear()
+            with override_settings(TAG_INDEX={'ENABLED': False}):
+                self.assertEqual(self.client.get(url, data).json()['rows'], indexed, data)
+
+    # DB にはタグ・分野の条件を送らず, 当てはまった記事 ID だけを渡す
+    def test_id_list(self):
+        with CaptureQueriesContext(connection) as context:
+            rows = self.client.get(reverse('cms:search_api'), dict(selected_tags=['tag0', 'tag1'], tag_mode='all')).json()['rows']
+        self.assertEqual(sorted(row[0] for row in rows), self.ids(3, 7, 11, 15))
+        sql = '\n'.join(query['sql'] for query in context.captured_queries if 'cms_article"."title' in query['sql'])
+        self.assertIn(f'IN ({", ".join(map(str, self.ids(3, 7, 11, 15)))})', sql)
+        self.assertNotIn('"cms_articletags"."tag_id"', sql)
+        self.assertNotIn('"cms_articlecategory"."category_id" =', sql)
+
+    # 当てはまる記事が多ければ準結合で引く
+    def test_many(self):
+        search = ArticleSearch(tags=['tag0'])
+        with mock.patch.object(articlesearch, 'ID_LIST_MAX', 3):
+            sql = str(search.filter(Article.objects.all()).query)
+        self.assertIn('"cms_articletags"', sql)
+        self.assertEqual(len(self.search_ids(search)), 8)
+
+    @staticmethod
+    def search_ids(search):
+        return list(search.filter(Article.objects.all()).values_list('pk', flat=True))
+
+    # 書き込みはコミット時に差分として反映され, 作り直さない
+    def test_incremental(self):
+        self.lookup(tags=['tag0'])
+        with mock.patch.object(tagindex.TagIndex, '_load', side_effect=AssertionError('rebuilt')):
+            article = bulk.create_articles([dict(title='new', content='本文', category='category0', tags=['tag0', 'new_tag'],
+                                                 author=self.user.pk)])[0]
+            bulk.set_article_tags(self.articles[1].pk, ['tag3'])
+            ArticleTags(article=self.articles[2], tag=self.tags[0]).save()
+            article_category = ArticleCategory.objects.get(pk=self.articles[4].pk)
+            article_category.category = self.categories[1]
+            article_category.save()
+            bulk.delete_articles(self.ids(3))
+            # コミットまでは反映せず, 索引は使わない (このコミットされていない書き込みは, 索引からは他の書き込みに見える)
+            with mock.patch.object(tagindex.TagIndex, '_rebuild_in_background'):
+                self.assertIsNone(tagindex.lookup(tags=['new_tag']))
+            run_on_commit()
+            self.assertEqual(self.lookup(tags=['new_tag']), [article.pk])
+            self.assertEqual(self.lookup(tags=['tag0']), self.ids(2, *range(5, 16, 2)) + [article.pk])
+            self.assertEqual(self.lookup(tags=['tag3']), self.ids(1, *range(8, 16)))
+            self.assertEqual(self.lookup(category='category1'), self.ids(1, 4, *range(5, 16, 2)))
+            self.assertEqual(self.lookup(category='category0'), self.ids(0, 2, 6, 8, 10, 12, 14) + [article.pk])
+
+    # 他のプロセスで書き込まれた (このプロセスで bump していないのにバージョンが増えた) ら, 索引を使わずに作り直す
+    def test_other_process(self):
+        self.lookup(tags=['tag0'])
+        ArticleTags.objects.filter(article=self.articles[1], tag=self.tags[0]).delete()
+        ContentVersion.objects.filter(pk=1).update(version=F('version') + 1)
+        discard_on_commit()
+        with mock.patch.object(tagindex.TagIndex, '_rebuild_in_background') as rebuild:
+            self.assertIsNone(ArticleSearch(tags=['tag0']).indexed_ids())
+            response = self.client.get(reverse('cms:search_api'), dict(selected_tags=['tag0']))
+        rebuild.assert_called_with()
+        self.assertEqual(len(response.json()['rows']), 7)
+        tagindex.index.build()
+        self.assertEqual(self.lookup(tags=['tag0']), self.ids(*range(3, 16, 2)))
+        self.assertEqual(len(ArticleSearch(tags=['tag0']).indexed_ids()), 7)
+
+    @override_settings(TAG_INDEX={'ENABLED': False})
+    def test_disabled(self):
+        self.assertIsNone(ArticleSearch(tags=['tag0']).indexed_ids())
+        self.assertEqual(len(self.search_ids(ArticleSearch(tags=['tag0']))), 8)
+
+
+class QueryPlanTestCase(CmsTestCase):
+    # 検索・並び替えのすべての組み合わせで, どのテーブルも索引なしで全件走査されないことを確かめる
+    # 本番の DB も ANALYZE しない (sqlite_stat1 がない) ので, SQLite の索引の選び方は表の行数によらず, 小さい表でも同じになる
+    # どの条件を EXISTS にするか (ArticleSearch.plan) は行数の見積もりで決まるので, 見積もりを差し替えて両方を確かめる
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        articles = [create_article(cls.user, f'title{i}', categories[i % 2], tags[i % 3:]) for i in range(12)]
+        Favorite.create_or_delete(articles[0], cls.user)
+        ReadingHistory.objects.create(article=articles[1], user=cls.user)
+
+    @staticmethod
+    def explain(sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[3] for row in cursor.fetchall()]
+
+    # 索引を使わない走査 ("SCAN cms_article" など. 全文検索の仮想テーブルは除く) を返す
+    # 索引の順の走査 ("SCAN cms_article USING INDEX ...") でも, 並べ替える (1 ページ分で止まらない) なら含める
+    def full_scans(self, sql):
+        details = self.explain(sql)
+        scans = [detail for detail in details if re.fullmatch(r'SCAN (TABLE )?(cms|users)_\w+', detail)]
+        if 'USE TEMP B-TREE FOR ORDER BY' in details:
+            scans += [detail for detail in details if re.match(r'SCAN (cms|users)_\w+ USING ', detail)]
+        return scans
+
+    # 並べ替えるしかない並び替え (絞り込みなしで, 他の表の列で並び替える) かどうか
+    @staticmethod
+    def sorts_all(data):
+        ordering = data.get('search_or_order', '').lstrip('-')
+        conditions = set(data) - {'search_or_order', 'cursor'}
+        return ordering and ordering not in STREAMING_FIELDS and not conditions
+
+    # (SQL, 実行計画) のリスト. 検索結果のキャッシュは使わない
+    def captured_plans(self, url, data):
+        searchcache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        plans = [(query['sql'], self.explain(query['sql']))
+                 for query in context.captured_queries if query['sql'].startswith('SELECT')]
+        return response, plans
+
+    def assertNoFullScan(self, url, data):
+        response, plans = self.captured_plans(url, data)
+        for sql, _ in plans:
+            scans = self.full_scans(sql)
+            if self.sorts_all(data) and sql.startswith('SELECT "cms_article"'):
+                # 全件を並べ替える (test_orderings で実行計画を確かめる)
+                continue
+            self.assertEqual(scans, [], f'{data}\n{sql}')
+        return response
+
+    # 1 ページ分の記事を取り出すクエリと総件数を数えるクエリの, (SQL, 実行計画)
+    def page_plans(self, url, data):
+        _, plans = self.captured_plans(url, data)
+        page = [plan for plan in plans if plan[0].startswith('SELECT "cms_article"."article_id", "cms_article"."title"')]
+        count = [plan for plan in plans if plan[0].startswith('SELECT COUNT(*) FROM (')]
+        self.assertEqual((len(page), len(count)), (1, 1), data)
+        # 総件数は COUNT_CAP 件までしか数えない
+        self.assertTrue(count[0][0].endswith(f'LIMIT {COUNT_CAP + 1}) subquery'), count[0][0])
+        return page[0][1], count[0][1]
+
+    # plan が lines を連続して含む
+    def assertPlanContains(self, plan, lines, msg=None):
+        self.assertTrue(any(plan[i:i + len(lines)] == lines for i in range(len(plan))), (msg, plan))
+
+    # 絞り込みがなければ, 索引の順に並び替えられるものは並び替えの索引を 1 ページ分だけ走査する
+    # 他の表の列での並び替えだけは全件を読んで並べ替える. 総件数は索引を COUNT_CAP 件まで走査する
+    def test_orderings(self):
+        for ordering in self.orderings():
+            field = (ordering or '-fav_num').lstrip('-')
+            page, count = self.page_plans(reverse('cms:search_api'), dict(search_or_order=ordering))
+            if field in STREAMING_FIELDS:
+                self.assertEqual(page[0], f'SCAN cms_article USING INDEX article_{field}_idx', ordering)
+                self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', page, ordering)
+            else:
+                self.assertIn('USE TEMP B-TREE FOR ORDER BY', page, ordering)
+            self.assertTrue(re.fullmatch(r'SCAN cms_article USING COVERING INDEX \w+', count[1]), count)
+
+    # 絞り込む記事の少ない条件は IN にし, その条件の索引で記事を引いてから並べ替える
+    def test_in(self):
+        for ordering in self.orderings():
+            with mock.patch.object(ArticleSearch, 'estimate', return_value=(10 ** 6, [100])):
+                page, count = self.page_plans(
+                    reverse('cms:search_api'), dict(category='category0', search_or_order=ordering))
+            for plan in (page, count):
+                self.assertPlanContains(plan, [
+                    'SEARCH cms_article USING INTEGER PRIMARY KEY (rowid=?)',
+                    'LIST SUBQUERY 1',
+                    'SEARCH U0 USING COVERING INDEX articlecategory_category_idx (category_id=?)',
+                ], ordering)
+
+    # 絞り込む記事の多い条件は EXISTS にし, 並び替えの索引の順に走査しながら条件の索引で確かめる
+    def test_exists(self):
+        for field in STREAMING_FIELDS:
+            for ordering in (field, f'-{field}'):
+                with mock.patch.object(ArticleSearch, 'estimate', return_value=(10 ** 6, [5 * 10 ** 5])):
+                    page, count = self.page_plans(
+                        reverse('cms:search_api'), dict(category='category0', search_or_order=ordering))
+                self.assertEqual(page[0], f'SCAN cms_article USING INDEX article_{field}_idx', ordering)
+                self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', page, ordering)
+                # 記事の分野は記事 ID が主キー
+                self.assertPlanContains(
+                    page, ['CORRELATED SCALAR SUBQUERY 1', 'SEARCH U0 USING INTEGER PRIMARY KEY (rowid=?)'], ordering)
+
+    # ユーザーページは執筆者の索引でそのユーザーの記事を引く
+    def test_user_page(self):
+        for ordering in self.orderings():
+            page, count = self.page_plans(
+                reverse('cms:user_page_api', args=[self.user.pk]), dict(search_or_order=ordering))
+            for plan in (page, count):
+                self.assertTrue(
+                    any(re.fullmatch(r'SEARCH cms_author USING COVERING INDEX \w+ \(user_id=\?\)', d) for d in plan),
+                    (ordering, plan))
+                self.assertIn('SEARCH cms_article USING INTEGER PRIMARY KEY (rowid=?)', plan, ordering)
+
+    def orderings(self):
+        yield ''
+        for field in ORDER_FIELDS:
+            yield field
+            yield f'-{field}'
+
+    # 次のページのカーソル (HTML と JSON のどちらの応答からも)
+    @staticmethod
+    def next_cursor(response):
+        if response['Content-Type'] == 'application/json':
+            return response.json()['page']['next_cursor']
+        return response.context['page_obj'].next_cursor
+
+    def assertSearchNoFullScan(self, url):
+        self.client.login(username='alice', password=PASSWORD)
+        filters = [
+            {}, dict(username='alice'), dict(title='title'), dict(category='category0'),
+            dict(selected_tags=['tag1', 'tag2']), dict(check=['author']), dict(check=['fav']), dict(check=['read']),
+            dict(username='alice', category='category1', selected_tags=['tag2'], check=['author', 'fav', 'read']),
+        ]
+        for data in filters:
+            for ordering in self.orderings():
+                params = dict(data, search_or_order=ordering)
+                response = self.assertNoFullScan(url, params)
+                # 2 ページ目以降 (keyset の条件付き)
+                cursor = self.next_cursor(response)
+                if cursor:
+                    self.assertNoFullScan(url, dict(params, cursor=cursor))
+
+    def assertUserPageNoFullScan(self, url):
+        for ordering in self.orderings():
+            response = self.assertNoFullScan(url, dict(search_or_order=ordering))
+            cursor = self.next_cursor(response)
+            if cursor:
+                self.assertNoFullScan(url, dict(search_or_order=ordering, cursor=cursor))
+
+    def test_search_ajax(self):
+        self.assertSearchNoFullScan(reverse('cms:search_ajax'))
+
+    def test_search_api(self):
+        self.assertSearchNoFullScan(reverse('cms:search_api'))
+
+    def test_user_page_ajax(self):
+        self.assertUserPageNoFullScan(reverse('cms:user_page_ajax', args=[self.user.pk]))
+
+    def test_user_page_api(self):
+        self.assertUserPageNoFullScan(reverse('cms:user_page_api', args=[self.user.pk]))
+
+
+class ProductionDatabaseTestCase(TransactionTestCase):
+    # 本番用の DB の設定 (WAL など) で, お気に入りの登録 / 解除と記事の閲覧を並行して行っても
+    # "database is locked" にならないことを確かめる (ファイルの DB が必要なので, 一時ファイルに作る)
+
+    THREADS = 8
+    ROUNDS = 15
+
+    def setUp(self):
+        # 非同期のビューのスレッドプールが, 前のテストの DB への接続を持ち越さないようにする
+        asyncdb.shutdown()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.original_settings = connections.databases[DEFAULT_DB_ALIAS]
+        self.original_connection = connections[DEFAULT_DB_ALIAS]
+        settings_dict = dict(self.original_settings, **settings.DATABASE_PROFILES['production'])
+        settings_dict['NAME'] = os.path.join(self.tempdir.name, 'db.sqlite3')
+        # 以降に作られる接続 (各スレッドの接続) はこの設定を使う
+        connections.databases[DEFAULT_DB_ALIAS] = settings_dict
+        connections[DEFAULT_DB_ALIAS] = load_backend(settings_dict['ENGINE']).DatabaseWrapper(settings_dict, DEFAULT_DB_ALIAS)
+        call_command('migrate', verbosity=0)
+
+    def tearDown(self):
+        asyncdb.shutdown()
+        connections[DEFAULT_DB_ALIAS].close()
+        connections.databases[DEFAULT_DB_ALIAS] = self.original_settings
+        connections[DEFAULT_DB_ALIAS] = self.original_connection
+        self.tempdir.cleanup()
+        for buffer in buffers.buffers:
+            buffer.discard()
+        pagecache.clear()
+        searchcache.clear()
+        tagindex.invalidate()
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            pragmas = {}
+            for name in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store'):
+                cursor.execute(f'PRAGMA {name}')
+                pragmas[name] = cursor.fetchone()[0]
+        self.assertEqual(pragmas, dict(journal_mode='wal', synchronous=1, cache_size=-65536,
+                                       mmap_size=268435456, temp_store=2))
+
+    def test_concurrent_requests(self):
+        users = [User.objects.create_user(f'user{i}', PASSWORD) for i in range(self.THREADS)]
+        category = Category.objects.create(category='graph')
+        tag = Tag.objects.create(tag='dfs')
+        articles = [create_article(users[0], f'title{i}', category, [tag]) for i in range(3)]
+        errors = []
+        start = threading.Barrier(self.THREADS)
+
+        def run(user):
+            client = Client()
+            client.force_login(user)
+            start.wait()
+            try:
+                for i in range(self.ROUNDS):
+                    article = articles[i % len(articles)]
+                    for url in (reverse('cms:fav_ajax', args=[article.pk]),
+                                reverse('cms:article_view', args=[article.pk])):
+                        response = client.get(url)
+                        if response.status_code != 200:
+                            errors.append(f'{url}: {response.status_code}')
+            except Exception as e:
+                errors.append(repr(e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=[user]) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        # お気に入り数も食い違っていない
+        for article in Article.objects.all():
+            self.assertEqual(article.fav_num, Favorite.objects.filter(article=article).count())
+
+
+class MetricsTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        cls.staff = User.objects.create_user('admin', PASSWORD, is_staff=True)
+        category = Category.objects.create(category='graph')
+        cls.article = create_article(cls.user, 'dfs', category, [])
+
+    def setUp(self):
+        metrics.reset()
+
+    def get_metrics(self):
+        self.client.login(username='admin', password=PASSWORD)
+        response = self.client.get(reverse('cms:metrics'))
+        self.client.logout()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_staff_only(self):
+        self.client.login(username='alice', password=PASSWORD)
+        self.assertEqual(self.client.get(reverse('cms:metrics')).status_code, 302)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.buckets()), [(1, 2), (5, 3), ('+Inf', 4)])
+        self.assertEqual((histogram.sum, histogram.count), (14, 4))
+
+    def test_request_metrics(self):
+        url = reverse('cms:article_view', args=[self.article.pk])
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        self.client.get(url)
+        self.client.get('/no/such/page/')
+        text = self.get_metrics()
+        view = 'view="cms:article_view"'
+        self.assertIn(f'algopedia_request_duration_seconds_count{{{view}}} 2', text)
+        self.assertIn(f'algopedia_request_duration_seconds_bucket{{{view},le="+Inf"}} 2', text)
+        # 1 回目のクエリ数の区間に数えられている
+        queries = len(context.captured_queries)
+        bound = next(bound for bound in metrics.HISTOGRAMS[1][2] if queries <= bound)
+        self.assertIn(f'algopedia_db_queries_bucket{{{view},le="{bound}"}}', text)
+        self.assertIn(f'algopedia_template_duration_seconds_count{{{view}}} 2', text)
+        self.assertIn(f'algopedia_request_duration_seconds_count{{view="{metrics.UNRESOLVED}"}} 1', text)
+        self.assertIn('# TYPE algopedia_db_duration_seconds histogram', text)
+
+    # ASGI でも, 同期のビューが (別のスレッドで) 実行したクエリを数える
+    def test_sync_view_under_asgi(self):
+        url = reverse('cms:article_view', args=[self.article.pk])
+        with CaptureQueriesContext(connection) as context:
+            response = async_to_sync(AsyncClient().get)(url)
+        self.assertEqual(response.status_code, 200)
+        histograms = metrics._histograms['cms:article_view']
+        self.assertEqual(histograms['algopedia_db_queries'].sum, len(context.captured_queries))
+
+    def test_template_time(self):
+        self.client.get(reverse('cms:index'))
+        histograms = metrics._histograms['cms:index']
+        self.assertGreater(histograms['algopedia_template_duration_seconds'].sum, 0)
+        self.assertGreater(histograms['algopedia_db_queries'].sum, 0)
+
+    @override_settings(METRICS={'ENABLED': True, 'SLOW_QUERIES': 2, 'SLOW_QUERY_MIN_DURATION': 0})
+    def test_slow_queries(self):
+        url = reverse('cms:search_ajax')
+        with self.assertLogs('cms.metrics', 'INFO') as logs:
+            self.client.get(url)
+        self.assertTrue(all('slow query in cms:search_ajax' in line for line in logs.output))
+        slow = metrics.slow_queries('cms:search_ajax')
+        self.assertEqual(len(slow), 2)
+        self.assertGreaterEqual(slow[0][0], slow[1][0])
+
+    @override_settings(METRICS={'ENABLED': False})
+    def test_disabled(self):
+        self.client.get(reverse('cms:index'))
+        self.assertNotIn('cms:index', metrics.render())
+
+
+class AsyncViewsTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        category = Category.objects.create(category='graph')
+        cls.article = create_article(cls.user, 'dfs', category, [])
+
+    def use_pool(self, max_workers):
+        override = override_settings(ASYNC_VIEWS={'MAX_WORKERS': max_workers})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(asyncdb.shutdown)
+
+    def test_views_are_async(self):
+        for view in (views.fav_ajax, views.autocomplete_ajax, views.search_ajax, views.user_page_ajax):
+            self.assertTrue(asyncio.iscoroutinefunction(view), view.__name__)
+
+    def test_views(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse('cms:fav_ajax', args=[self.article.article_id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Article.objects.get(pk=self.article.pk).fav_num, 1)
+        response = client.get(reverse('cms:search_ajax'), dict(title='dfs'))
+        self.assertContains(response, 'dfs')
+        response = client.get(reverse('cms:user_page_ajax', args=[self.user.id]))
+        self.assertContains(response, 'dfs')
+        response = client.get(reverse('cms:autocomplete_ajax'), dict(kind='title', q='d'))
+        self.assertEqual([result['value'] for result in response.json()['results']], ['dfs'])
+        # ログインしていなければログインページへ
+        response = Client().get(reverse('cms:fav_ajax', args=[self.article.article_id]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_supersede_running_query(self):
+        self.use_pool(2)
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            with connection.cursor() as cursor:
+                # 中断されなければ数十秒かかる
+                cursor.execute('WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 500000000) '
+                               'SELECT count(*) FROM c')
+                return cursor.fetchone()[0]
+
+        async def scenario():
+            first = asyncio.ensure_future(asyncdb.run(slow, supersede='key'))
+            await sync_to_async(started.wait, thread_sensitive=False)()
+            await asyncio.sleep(0.1)
+            second = await asyncdb.run(lambda: 'second', supersede='key')
+            with self.assertRaises(asyncdb.Superseded):
+                await first
+            return second
+
+        start = time.perf_counter()
+        self.assertEqual(async_to_sync(scenario)(), 'second')
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(asyncdb._jobs, {})
+
+    def test_supersede_queued(self):
+        self.use_pool(1)
+        release = threading.Event()
+        calls = []
+
+        def call(name):
+            calls.append(name)
+            return name
+
+        async def scenario():
+            blocking = asyncio.ensure_future(asyncdb.run(release.wait))
+            queued = asyncio.ensure_future(asyncdb.run(call, 'queued', supersede='key'))
+            await asyncio.sleep(0.1)
+            latest = asyncio.ensure_future(asyncdb.run(call, 'latest', supersede='key'))
+            # 先のものは順番待ちのまま中断される
+            with self.assertRaises(asyncdb.Superseded):
+                await queued
+            release.set()
+            await blocking
+            return await latest
+
+        self.assertEqual(async_to_sync(scenario)(), 'latest')
+        self.assertEqual(calls, ['latest'])
+
+    def test_supersede_key(self):
+        request = RequestFactory().get('/', HTTP_X_TAB_ID='tab')
+        self.assertIsNone(views.supersede_key(request, 'search_ajax'))
+        request.COOKIES[settings.CSRF_COOKIE_NAME] = 'token'
+        self.assertEqual(views.supersede_key(request, 'search_ajax'), ('search_ajax', 'token', 'tab'))
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        self.assertEqual(views.supersede_key(request, 'search_ajax'), ('search_ajax', 'session', 'tab'))
+        # タブの識別子がなければ中断しない. 別のタブのリクエストは別のキーになる
+        other = RequestFactory().get('/')
+        other.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        self.assertIsNone(views.supersede_key(other, 'search_ajax'))
+        other.META['HTTP_X_TAB_ID'] = 'other'
+        self.assertNotEqual(views.supersede_key(other, 'search_ajax'), views.supersede_key(request, 'search_ajax'))
+
+
+class GenerateCorpusTestCase(CmsTestCase):
+
+    def generate(self, *args):
+        out = io.StringIO()
+        call_command('generate_corpus', '--users=20', '--articles=120', '--categories=4', '--tags=15',
+                     '--favorites=300', '--reads=200', '--batch-size=50', *args, stdout=out)
+        return out.getvalue()
+
+    def snapshot(self):
+        return [(row['title'], row['category'], row['tags'], row['author'], row['fav_num'])
+                for row in export.iter_rows()]
+
+    def test_generate(self):
+        out = self.generate()
+        self.assertIn('ユーザー 20 人, 記事 120 件, お気に入り 300 件, 閲覧履歴 200 件を生成しました', out)
+        self.assertEqual(User.objects.filter(username__startswith='corpus').count(), 20)
+        self.assertEqual(Article.objects.count(), 120)
+        self.assertEqual(Favorite.objects.count(), 300)
+        self.assertEqual(ReadingHistory.objects.count(), 200)
+        # 保存しておいた数が食い違っていない
+        for name, *_ in counters.COUNTERS:
+            self.assertEqual(counters.reconcile(name, fix=False), {}, name)
+        self.assertEqual(counters.reconcile_user_stats(fix=False), {})
+        self.assertEqual(UserStats.objects.count(), 20)
+        # お気に入りは一部の記事に集中する
+        fav_nums = sorted(Article.objects.values_list('fav_num', flat=True), reverse=True)
+        self.assertGreater(sum(fav_nums[:12]), sum(fav_nums[12:]) / 2)
+
+    def test_deterministic(self):
+        self.generate('--seed=1')
+        first = self.snapshot()
+        bulk.delete_articles(Article.objects.values_list('pk', flat=True))
+        User.objects.all().delete()
+        self.generate('--seed=1')
+        self.assertEqual(self.snapshot(), first)
+        bulk.delete_articles(Article.objects.values_list('pk', flat=True))
+        self.generate('--seed=2')
+        self.assertNotEqual(self.snapshot(), first)
+
+    def test_password(self):
+        self.generate('--users=1', '--articles=0', '--password', PASSWORD)
+        self.assertTrue(self.client.login(username='corpus0', password=PASSWORD))
+
+
+class BenchmarkTestCase(CmsTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', PASSWORD)
+        categories = [Category.objects.create(category=f'category{i}') for i in range(2)]
+        tags = [Tag.objects.create(tag=f'tag{i}') for i in range(3)]
+        for i in range(15):
+            create_article(cls.user, f'title{i} dfs', categories[i % 2], tags[i % 3:])
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tempdir.name, name)
+
+    def run_benchmark(self, name, *args):
+        call_command('benchmark', '--requests=3', '--warmup=1', '-o', self.path(name), *args, stdout=io.StringIO())
+        with open(self.path(name), encoding='utf-8') as file:
+            return json.load(file)
+
+    def test_scenarios_cover_urls(self):
+        from cms import benchmark, urls
+
+        self.assertEqual(set(benchmark.SCENARIOS), {pattern.name for pattern in urls.urlpatterns})
+
+    # 起動中のサーバーに送る CSRF の Cookie とトークンで, CSRF の検査を通る
+    def test_live_headers(self):
+        from cms import benchmark
+
+        headers = benchmark._live_headers(mock.Mock(clients=dict(anonymous=Client())))['anonymous']
+        client = Client(enforce_csrf_checks=True)
+        name, value = headers['Cookie'].split('=', 1)
+        client.cookies[name] = value
+        url = reverse('cms:category_create')
+        self.assertEqual(client.post(url, HTTP_X_CSRFTOKEN='x' * 64).status_code, 403)
+        self.assertNotEqual(client.post(url, HTTP_X_CSRFTOKEN=headers['X-CSRFToken']).status_code, 403)
+
+    def test_in_process(self):
+        result = self.run_benchmark('a.json')
+        self.assertEqual(result['meta']['mode'], 'in-process')
+        self.assertEqual(set(result['routes']), set(result['meta']['routes']))
+        for route, stats in result['routes'].items():
+            self.assertEqual(stats['requests'], 3, route)
+            self.assertEqual(stats['errors'], 0, route)
+            self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+            self.assertLessEqual(stats['p95_ms'], stats['p99_ms'])
+            self.assertIsNotNone(stats['queries_per_request'])
+        self.assertEqual(result['total']['requests'], 3 * len(result['routes']))
+
+    def test_skip_writes(self):
+        articles = Article.objects.count()
+        result = self.run_benchmark('a.json', '--skip-writes')
+        self.assertFalse(set(result['routes']) & {'article_add', 'article_edit', 'article_del', 'fav_ajax'})
+        self.assertEqual(Article.objects.count(), articles)
+        self.assertFalse(Favorite.objects.exists())
+
+    def test_compare(self):
+        def write(name, p95, queries):
+            stats = dict(requests=10, errors=0, mean_ms=p95 / 2, throughput_rps=100.0, queries_per_request=queries,
+                         p50_ms=p95 / 2, p95_ms=p95, p99_ms=p95 * 2)
+            with open(self.path(name), 'w', encoding='utf-8') as file:
+                json.dump(dict(meta=dict(mode='in-process', concurrency=1), total=stats,
+                               routes=dict(index=stats, search_ajax=stats)), file)
+
+        write('base.json', 10.0, 4)
+        write('same.json', 10.5, 4)
+        out = io.StringIO()
+        call_command('benchmark', '--compare', self.path('base.json'), self.path('same.json'), stdout=out)
+        self.assertIn('悪化したルートはありません', out.getvalue())
+        write('slow.json', 20.0, 5)
+        with self.assertRaisesMessage(CommandError, '2 件のルートが悪化しました'):
+            call_command('benchmark', '--compare', self.path('base.json'), self.path('slow.json'), stdout=io.StringIO())
+
+
+class BenchmarkLiveTestCase(LiveServerTestCase):
+
+    def tearDown(self):
+        asyncdb.shutdown()
+        for buffer in buffers.buffers:
+            buffer.discard()
+        pagecache.clear()
+        searchcache.clear()
+        tagindex.invalidate()
+        autocomplete.invalidate()
+
+    # テスト用の DB はスレッド間で共有するメモリ上の DB で, 書き込みが重なるとロックのエラーになるので並列にしない
+    def test_live(self):
+        user = User.objects.create_user('alice', PASSWORD)
+        category = Category.objects.create(category='graph')
+        for i in range(12):
+            create_article(user, f'title{i}', category, [])
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'live.json')
+            call_command('benchmark', '--requests=4', '--warmup=0', '--live', self.live_server_url,
+                         '--concurrency=1', '--routes', 'index', 'article_view', 'fav_ajax', 'search_ajax',
+                         '-o', path, stdout=io.StringIO())
+            with open(path, encoding='utf-8') as file:
+                result = json.load(file)
+        self.assertEqual(result['meta']['mode'], 'live')
+        for route, stats in result['routes'].items():
+            self.assertEqual((stats['requests'], stats['errors']), (4, 0), route)
+            self.assertIsNone(stats['queries_per_request'])
+        self.assertGreater(result['total']['throughput_rps'], 0)
@@ -21,9 +21,16 @@ urlpatterns = [
     path('category/create', views.category_create, name='category_create'),
     # タグ
     path('tag/create', views.tag_create, name='tag_create'),
+    # 書き出し
+    path('export/', views.export_articles, name='export_articles'),
+    # 計測値 (Prometheus)
+    path('metrics/', views.metrics_view, name='metrics'),
     # Ajax
-    path('ajax/tag/add/<str:additional_tag>', views.tag_add_ajax, name='tag_add_ajax'),
-    path('ajax/search/<int:page>', views.search_ajax, name='search_ajax'),
+    path('ajax/autocomplete/', views.autocomplete_ajax, name='autocomplete_ajax'),
+    path('ajax/search/', views.search_ajax, name='search_ajax'),
     path('ajax/fav/<int:article_id>/', views.fav_ajax, name='fav_ajax'),
-    path('ajax/user_page/<int:user_id>/<int:page>', views.user_page_ajax, name='user_page_ajax'),
+    path('ajax/user_page/<int:user_id>/', views.user_page_ajax, name='user_page_ajax'),
+    # JSON API (cms.api)
+    path('api/v1/search/', views.search_api, name='search_api'),
+    path('api/v1/user/<int:user_id>/articles/', views.user_page_api, name='user_page_api'),
 ]
@@ -1,15 +1,23 @@
 import json
-from datetime import datetime
 
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import PageNotAnInteger, Paginator, EmptyPage
-from django.http import HttpResponse
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template import loader
+from django.utils import timezone
+from django.views.decorators.http import condition
 
 # Create your views here.
-from cms.forms import SignUpForm, TagForm, CategoryForm, ArticleForm
-from cms.models import Article, Category, Tag, ArticleCategory, ArticleTags, Author, Favorite, ReadingHistory
+from cms import api, asyncdb, autocomplete, bulk, conditional, export, metrics, pagecache, searchcache
+from cms.articlesearch import ArticleSearch, get_ordering
+from cms.forms import SignUpForm, TagForm, CategoryForm, ArticleForm, validate_category_name, validate_tag_name
+from cms.models import Article, Category, Tag, ArticleCategory, Author, Favorite, ReadingHistory, UserStats
+from cms.paging import KeysetPaginator, load_cursor
 from users.models import User
 
 
@@ -26,53 +34,96 @@ def signup(request):
 
 
 # 記事のページ
+@transaction.non_atomic_requests
 def article_view(request, article_id):
-    article = get_object_or_404(Article, pk=article_id)
+    # 閲覧者ごとに変わる部分に必要な列と, キャッシュの確認に使う更新日時だけを取得する
+    article = get_object_or_404(
+        Article.objects.only('article_id', 'title', 'fav_num', 'updated_at').annotate(author_user_id=F('author__user')),
+        pk=article_id)
     user: User = request.user
     # ログイン中かどうか
     if user.is_authenticated:
         # 閲覧履歴の更新 (なければ挿入)
-        ReadingHistory.objects.update_or_create(article=article, user=user)
+        ReadingHistory.record(article=article, user=user)
         # 既にお気に入りに設定しているか
         fav = Favorite.exists(article=article, user=user)
     else:
         fav = False
+    # 前回から変わっていなければ (ETag / Last-Modified) 描画せずに 304 を返す
+    # お気に入り数・タグの付け替え・執筆者の名前の変更は記事の更新日時に反映されないので, サイト全体の内容のバージョンも見る
+    version = conditional.content_version(request)
+    etag = conditional.make_etag(article.article_id, article.updated_at, article.fav_num, version.version, user.pk, fav)
+    last_modified = max(article.updated_at, version.updated_at)
+    response = conditional.not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
     context = {
         'article': article,
         'fav': fav,
+        # 閲覧者によらない部分はキャッシュから
+        'parts': pagecache.get_article_parts(article.article_id, article.updated_at),
     }
-    return render(request, 'cms/pages/article.html', context)
+    return conditional.set_headers(render(request, 'cms/pages/article.html', context), etag, last_modified)
+
+
+# Ajax のビュー (fav_ajax, autocomplete_ajax, search_ajax, user_page_ajax) と JSON API は非同期で,
+# DB を使う処理 (_ で始まる同期の関数) は cms.asyncdb のスレッドプールで実行する
+# 検索・並び替え・入力補完は, 同じタブから新しいリクエストが届いたら古い方を中断する (409 を返す)
+
+
+# 同じ利用者 (セッション. なければ CSRF の Cookie) の同じタブ (X-Tab-Id ヘッダー) の新しいリクエストで中断するためのキー
+# タブの識別子はページの JS (cms/js/custom.js) が付ける. 付いていなければ中断しない
+# (利用者だけをキーにすると, 2 つのタブで検索したときに互いを中断してしまう)
+def supersede_key(request, *names):
+    client = request.COOKIES.get(settings.SESSION_COOKIE_NAME) or request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    tab = request.headers.get('X-Tab-Id')
+    return (*names, client, tab) if client and tab else None
+
+
+# 新しいリクエストで中断した場合の応答
+def superseded():
+    return HttpResponse('新しいリクエストにより中断しました', status=409, content_type='text/plain; charset=utf-8')
 
 
-# お気に入り登録 / 解除のトグルスイッチ
 @login_required
-def fav_ajax(request, article_id):
-    article = get_object_or_404(Article, pk=article_id)
+@transaction.atomic
+def _fav_ajax(request, article_id):
+    article = get_object_or_404(Article.objects.only('article_id', 'fav_num'), pk=article_id)
+    # article.fav_num は更新後の値になるので読み直さない
     has_created = Favorite.create_or_delete(article=article, user=request.user)
-    article = get_object_or_404(Article, pk=article_id)
     return render(request, "cms/components/fav.html", dict(fav=has_created, article=article))
 
 
+# お気に入り登録 / 解除のトグルスイッチ
+@transaction.non_atomic_requests
+async def fav_ajax(request, article_id):
+    return await asyncdb.run(_fav_ajax, request, article_id)
+
+
 # 記事の新規作成 or 編集. article_id が None なら新規作成
 @login_required
 def article_edit(request, article_id=None):
     if article_id:
-        article = get_object_or_404(Article, pk=article_id)
+        article = get_object_or_404(Article.objects.annotate(author_user_id=F('author__user')), pk=article_id)
         # 記事の執筆者とログイン中のユーザーが異なる場合はログインページに飛ぶ
-        if request.user != article.author.user:
+        if article.author_user_id != request.user.id:
             errors = ["編集権限がありません．記事作成者のアカウントにログインして下さい"]
             return render(request, "cms/pages/login.html", dict(errors=errors))
     if request.method == 'POST':
         # エラーメッセージ
         err = dict(title="", content="", category="", tag={})
         err_tpl = "cms/components/field_errors.html"
-        forms = []
 
         # 入力内容
         title = request.POST.get("title")
         content = request.POST.get("content")
-        category_name = request.POST.get('category')
-        tag_names = request.POST.getlist('selected_tags')
+        category_name = (request.POST.get('category') or '').strip()
+        # 重複を除く (順序は保つ)
+        tag_names = []
+        for tag_name in request.POST.getlist('selected_tags'):
+            tag_name = tag_name.strip()
+            if tag_name not in tag_names:
+                tag_names.append(tag_name)
 
         article_form = ArticleForm(data=dict(title=title, content=content))
         if article_form.is_valid():
@@ -85,34 +136,21 @@ def article_edit(request, article_id=None):
             err["title"] = loader.render_to_string(err_tpl, dict(errors=err_title))
             err["content"] = loader.render_to_string(err_tpl, dict(errors=err_content))
 
-        category = Category.get_or_none(category=category_name)
-        # カテゴリが存在しない場合は新規作成する
-        if category is None:
-            category_form = CategoryForm(data=dict(category=category_name))
-            if category_form.is_valid():
-                category_name = category_form.cleaned_data.get('category')
-                category = Category(category=category_name)
-            else:
-                # エラーメッセージ
-                err_category = "category" in category_form.errors and category_form.errors["category"]
-                err["category"] = loader.render_to_string(err_tpl, dict(errors=err_category))
-            forms.append(category_form)
-
-        tags = []
+        # 存在しないカテゴリ・タグは新規作成するので, 名前だけを検証する
+        # 既にあるものはまとめて 1 回で取得する
+        if not Category.exists(category=category_name):
+            try:
+                validate_category_name(category_name)
+            except ValidationError as e:
+                err["category"] = loader.render_to_string(err_tpl, dict(errors=e.messages))
+        existing_tags = set(Tag.objects.filter(tag__in=tag_names).values_list('tag', flat=True))
         for tag_name in tag_names:
-            tag = Tag.get_or_none(tag=tag_name)
-            # タグが存在しない場合は新規作成する
-            if tag is None:
-                tag_form = TagForm(data=dict(tag=tag_name))
-                if tag_form.is_valid():
-                    tag_name = tag_form.cleaned_data.get('tag')
-                    tag = Tag(tag=tag_name)
-                else:
-                    # エラーメッセージ
-                    err_tag = "tag" in tag_form.errors and tag_form.errors['tag']
-                    err["tag"][tag_name] = loader.render_to_string(err_tpl, dict(errors=err_tag))
-                forms.append(tag_form)
-            tags.append(tag)
+            if tag_name in existing_tags:
+                continue
+            try:
+                validate_tag_name(tag_name)
+            except ValidationError as e:
+                err["tag"][tag_name] = loader.render_to_string(err_tpl, dict(errors=e.messages))
 
         # 入力に何らかの不備があった場合 (status=1)
         if err["title"] or err["content"] or err["category"] or err["tag"]:
@@ -121,46 +159,32 @@ def article_edit(request, article_id=None):
                 json.dumps(dict(status=1, err=err)),
                 content_type="text/javascript")
 
-        for form in forms:
-            form.save()
-
-        # add
-        if article_id is None:
-            article = Article(title=title, content=content)
-            article.save()
-            ArticleCategory(article=article, category=category).save()
-            for tag in tags:
-                tag.save()
-                ArticleTags(article=article, tag=tag).save()
-            Author(article=article, user=request.user).save()
-        # edit
-        else:
-            article = Article.objects.get(pk=article_id)
-            article_category = article.articlecategory
-            old_category = article_category.category
-            new_category = Category.objects.get(category=category_name)
-
-            # カテゴリが変更された場合はつじつま合わせをする必要がある
-            if old_category != new_category:
-                old_category.article_num -= 1
-                old_category.save()
-                article_category.category = new_category
-                article_category.save()
-
-            # タグ付けの更新
-            for old_tag in ArticleTags.objects.filter(article=article).exclude(tag__in=tags):
-                old_tag.delete()
-
-            # 新しいタグ付け
-            for new_tag in tags:
-                if not ArticleTags.exists(article, new_tag):
-                    ArticleTags(article=article, tag=new_tag).save()
-
-            # 記事の情報を更新
-            article.title = title
-            article.content = content
-            article.updated_at = datetime.now()
-            article.save()
+        with transaction.atomic():
+            Category.objects.bulk_create([Category(category=category_name)], ignore_conflicts=True)
+            # add
+            if article_id is None:
+                article = Article(title=title, content=content)
+                article.save()
+                ArticleCategory(article=article, category_id=category_name).save()
+                bulk.set_article_tags(article.article_id, tag_names)
+                Author(article=article, user=request.user).save()
+            # edit
+            else:
+                # カテゴリが変更された場合 (変更前のカテゴリの記事数は ArticleCategory.save で減らす)
+                article_category = ArticleCategory.objects.get(pk=article_id)
+                if article_category.category_id != category_name:
+                    article_category.category_id = category_name
+                    article_category.save()
+
+                # タグ付けの更新 (付け外しと記事数の増減はまとめて行う)
+                bulk.set_article_tags(article_id, tag_names)
+
+                # 記事の情報を更新
+                article.title = title
+                article.content = content
+                article.updated_at = timezone.now()
+                # お気に入り数は書き戻さない (同時に登録 / 解除されても失われないように)
+                article.save(update_fields=['title', 'content', 'updated_at'])
 
         # 入力が valid だったので status=0
         return HttpResponse(
@@ -171,10 +195,8 @@ def article_edit(request, article_id=None):
 
 # 記事 form の初期化
 def init_article_form(request, article_id=None):
-    context = {
-        "categories": Category.objects.all(),
-        "tags": Tag.objects.all(),
-    }
+    # 分野・タグの候補は入力補完 (autocomplete_ajax) で取得する
+    context = {}
     if article_id is not None:
         context["article"] = get_object_or_404(Article, pk=article_id)
     return render(request, 'cms/pages/article_edit.html', context)
@@ -215,140 +237,142 @@ def tag_create(request):
     return render(request, 'cms/pages/create_tag.html', dict(form=form))
 
 
-# ページング
-def paginate_queryset(queryset, count, page=1):
-    paginator = Paginator(queryset, count)
-    try:
-        page_obj = paginator.page(page)
-    except PageNotAnInteger:
-        page_obj = paginator.page(1)
-    except EmptyPage:
-        page_obj = paginator.page(paginator.num_pages)
-    return page_obj
+# 総件数はこの件数までしか数えない
+COUNT_CAP = 1000
+
 
+# ページング (keyset 方式). cursor は前のページで発行された次/前のページの位置
+def paginate_queryset(queryset, ordering, count, cursor=None):
+    paginator = KeysetPaginator(queryset, per_page=count, ordering=ordering, count_cap=COUNT_CAP)
+    return paginator.page(cursor)
 
-# トップ画面
+
+# トップ画面 (記事一覧は search_api と同じ JSON をクライアントで描画する)
+@transaction.non_atomic_requests
 def index(request):
     # デフォルトでは新着順に記事を表示
-    post_list = Article.objects.all().order_by('-updated_at')
-    page_obj = paginate_queryset(post_list, 10)
+    post_list = Article.objects.for_rows()
+    page_obj = paginate_queryset(post_list, ordering='-updated_at', count=10)
     context = {
-        'post_list': page_obj.object_list,
-        'page_obj': page_obj,
-        'categories': Category.objects.all(),
-        'tags': Tag.objects.all(),
+        # 続きのページも新着順で取得する
+        'articles': api.payload(page_obj, '-updated_at'),
     }
     return render(request, 'cms/pages/index.html', context)
 
 
-# Ajax でタグを追加する (db への insert とは別)
-def tag_add_ajax(request, additional_tag):
-    return render(request, "cms/components/tag.html", dict(tag=additional_tag))
-
-
-# Ajax で記事検索 or 並べ替えクエリを処理する
-def search_ajax(request, page):
-    # 検索結果を格納する QuerySet
-    post_list = Article.objects.all()
-
-    # 検索パラメータ取得
-    username = request.GET.get("username")
-    title = request.GET.get("title")
-    category = request.GET.get("category")
-
-    # 選択されたタグのリスト
-    selected_tags = request.GET.getlist("selected_tags")
-
-    # チェックボックスの入力 (リスト)
-    checks = request.GET.getlist('check')
-
-    # 検索 or 並び替え
-    search_or_order = request.GET.get("search_or_order")
-
-    if username:
-        # 指定したユーザーが執筆した記事
-        post_list = post_list.filter(author__user__username=username)
-
-    if title:
-        # 指定した文字列を連続部分文字列として含むタイトルを持つ記事 (LIKE)
-        post_list = post_list.filter(title__icontains=title)
-
-    if category:
-        # 指定したカテゴリを持つ記事
-        post_list = post_list.filter(articlecategory__category=category)
-
-    if selected_tags:
-        # 指定したいずれかのタグを持つ記事
-        post_list = post_list.filter(articletags__tag__in=selected_tags)
-
-    for check_val in checks:
-        # ログイン中のユーザー
-        user: User = request.user
-
-        if not user:
-            break
-
-        if check_val == 'author':
-            # 書いた記事
-            post_list = post_list.filter(author__user=user)
+def _autocomplete_ajax(request):
+    kind = request.GET.get('kind')
+    if kind not in autocomplete.indexes:
+        return HttpResponseBadRequest(f'kind は {", ".join(sorted(autocomplete.indexes))} のいずれかにしてください')
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        limit = 10
+    results = autocomplete.complete(kind, request.GET.get('q', ''), limit)
+    for result in results:
+        result['label'] = f'{autocomplete.LABELS[kind]}: {result["score"]}'
+    return JsonResponse(dict(kind=kind, results=results))
+
+
+# 入力補完の候補. kind=tag|category|title|user, q=入力中の文字列 (前方一致), limit=件数
+@transaction.non_atomic_requests
+async def autocomplete_ajax(request):
+    try:
+        return await asyncdb.run(
+            _autocomplete_ajax, request, supersede=supersede_key(request, 'autocomplete_ajax', request.GET.get('kind')))
+    except asyncdb.Superseded:
+        return superseded()
+
+
+# 検索結果の 1 ページ分. kind は post_list の取得方法の名前 (取得方法ごとに別々にキャッシュする)
+# GET パラメータ facets が指定されていれば, 分野・タグごとの記事数 (ArticleSearch.facets) も求めて page_obj.facets にする
+# (指定がなければ None. 記事数もページと一緒にキャッシュする)
+def search_page(request, post_list, kind):
+    search = ArticleSearch.from_request(request, per_page=10)
+    cursor = request.GET.get("cursor")
+    facets = bool(request.GET.get("facets"))
+
+    def compute():
+        page_obj = paginate_queryset(search.filter(post_list), ordering=search.ordering, count=10, cursor=cursor)
+        page_obj.facets = search.facets() if facets else None
+        return page_obj
+
+    # カーソルは署名を外した内容で比べる
+    params = search.cache_params()
+    if params is not None:
+        state = load_cursor(cursor, search.ordering)
+        params = (kind, facets) + params + (tuple(sorted(state.items())) if state is not None else None,)
+    return searchcache.get_or_compute(request, params, compute)
+
+
+@condition(etag_func=conditional.list_etag, last_modified_func=conditional.list_last_modified)
+def _search_ajax(request):
+    page_obj = search_page(request, Article.objects.for_list(), 'list')
+    context = {
+        'post_list': page_obj.object_list,
+        'page_obj': page_obj,
+        'search_or_order': request.GET.get("search_or_order"),
+        'facets': page_obj.facets,
+    }
+    return render(request, 'cms/components/article_list.html', context)
 
-        if check_val == 'fav':
-            # お気に入りした記事
-            post_list = post_list.filter(favorite__user=user)
 
-        if check_val == 'read':
-            # 閲覧した記事
-            post_list = post_list.filter(readinghistory__user=user)
+# Ajax で記事検索 or 並べ替えクエリを処理する (HTML)
+@transaction.non_atomic_requests
+async def search_ajax(request):
+    try:
+        return await asyncdb.run(_search_ajax, request, supersede=supersede_key(request, 'search_ajax'))
+    except asyncdb.Superseded:
+        return superseded()
 
-    # 検索結果の並び替え
-    if search_or_order != "search":
-        # 例えば, "fav_num" ならお気に入り数の昇順, "-fav_num" なら降順
-        post_list = post_list.order_by(search_or_order)
-    else:
-        # デフォルトではお気に入り数の降順
-        post_list = post_list.order_by('-fav_num')
 
-    # 検索結果を distinct にする
-    post_list = post_list.distinct()
+@condition(etag_func=conditional.list_etag, last_modified_func=conditional.list_last_modified)
+def _search_api(request):
+    page_obj = search_page(request, Article.objects.for_rows(), 'rows')
+    return api.response(page_obj, request.GET.get("search_or_order"), page_obj.facets)
 
-    # ページング
-    page_obj = paginate_queryset(queryset=post_list, count=10, page=page)
 
-    context = {
-        'post_list': page_obj.object_list,
-        'page_obj': page_obj,
-        'search_or_order': search_or_order,
-    }
-    return render(request, 'cms/components/article_list.html', context)
+# 記事検索 or 並べ替え (JSON. パラメータは search_ajax と同じ)
+@transaction.non_atomic_requests
+async def search_api(request):
+    try:
+        return await asyncdb.run(_search_api, request, supersede=supersede_key(request, 'search_api'))
+    except asyncdb.Superseded:
+        return superseded()
 
 
 # ユーザーページ
+@transaction.non_atomic_requests
 def user_page(request, user_id):
     user = get_object_or_404(User, pk=user_id)
     # ページ主の書いた記事だけを取得
-    post_list = user.author_articles()
+    post_list = user.author_articles().for_rows()
     # ページング
-    page_obj = paginate_queryset(post_list, count=10)
+    page_obj = paginate_queryset(post_list, ordering='article_id', count=10)
     context = {
-        'skip_author': True,
         'has_authority': user == request.user,
         'user': user,
-        'post_list': page_obj.object_list,
-        'page_obj': page_obj,
+        # サイドバーの統計は保存しておいた集計結果を使う
+        'stats': UserStats.get_or_build(user),
+        # 記事一覧は user_page_api と同じ JSON をクライアントで描画する
+        'articles': api.payload(page_obj),
     }
     return render(request, 'cms/pages/user_page.html', context)
 
 
-# ユーザーページでの記事の並び替え/ページング処理
-def user_page_ajax(request, user_id, page):
+# ページ主の書いた記事 post_list を並び替え (search_or_order) て, (1 ページ分, search_or_order) を返す
+def paginate_user_articles(request, post_list):
+    search_or_order = request.GET.get("search_or_order") or "search"
+    ordering = get_ordering(search_or_order, default='article_id')
+    page_obj = paginate_queryset(post_list, ordering=ordering, count=10, cursor=request.GET.get("cursor"))
+    return page_obj, search_or_order
+
+
+@condition(etag_func=conditional.list_etag, last_modified_func=conditional.list_last_modified)
+def _user_page_ajax(request, user_id):
     user = get_object_or_404(User, pk=user_id)
     # ページ主の書いた記事だけを取得
-    post_list = user.author_articles()
-    # 並び替え
-    search_or_order = request.GET.get("search_or_order") or "search"
-    if search_or_order != "search":
-        post_list = post_list.order_by(search_or_order)
-    page_obj = paginate_queryset(post_list, count=10, page=page)
+    page_obj, search_or_order = paginate_user_articles(request, user.author_articles().for_list())
     context = {
         'skip_author': True,
         'has_authority': user == request.user,
@@ -357,3 +381,56 @@ def user_page_ajax(request, user_id, page):
         'search_or_order': search_or_order,
     }
     return render(request, 'cms/components/article_list.html', context)
+
+
+# ユーザーページでの記事の並び替え/ページング処理 (HTML)
+@transaction.non_atomic_requests
+async def user_page_ajax(request, user_id):
+    try:
+        return await asyncdb.run(
+            _user_page_ajax, request, user_id, supersede=supersede_key(request, 'user_page_ajax'))
+    except asyncdb.Superseded:
+        return superseded()
+
+
+@condition(etag_func=conditional.list_etag, last_modified_func=conditional.list_last_modified)
+def _user_page_api(request, user_id):
+    user = get_object_or_404(User, pk=user_id)
+    page_obj, search_or_order = paginate_user_articles(request, user.author_articles().for_rows())
+    return api.response(page_obj, search_or_order)
+
+
+# ユーザーページでの記事の並び替え/ページング処理 (JSON. パラメータは user_page_ajax と同じ)
+@transaction.non_atomic_requests
+async def user_page_api(request, user_id):
+    try:
+        return await asyncdb.run(
+            _user_page_api, request, user_id, supersede=supersede_key(request, 'user_page_api'))
+    except asyncdb.Superseded:
+        return superseded()
+
+
+# 記事の書き出し (スタッフのみ). format=jsonl|csv, since=更新日時 (この日時以降に更新された記事のみ)
+@transaction.non_atomic_requests
+@staff_member_required
+def export_articles(request):
+    file_format = request.GET.get('format') or 'jsonl'
+    if file_format not in export.FORMATS:
+        return HttpResponseBadRequest(f'format は {", ".join(sorted(export.FORMATS))} のいずれかにしてください')
+    since = None
+    if request.GET.get('since'):
+        try:
+            since = export.parse_since(request.GET['since'])
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    response = StreamingHttpResponse(
+        export.lines(file_format, since=since), content_type=f'{export.FORMATS[file_format]}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="articles.{file_format}"'
+    return response
+
+
+# リクエストごとの計測値 (スタッフのみ). Prometheus のテキスト形式
+@transaction.non_atomic_requests
+@staff_member_required
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -8,7 +8,8 @@ from django.db import models
 
 
 # Create your models here.
-from cms.models import Article
+from cms import pagecache
+from cms.models import Article, ContentVersion
 
 
 class UserManager(BaseUserManager):
@@ -78,6 +79,16 @@ class User(AbstractBaseUser, PermissionsMixin):
         verbose_name = _('user')
         verbose_name_plural = _('users')
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        renamed = self.pk is not None and (update_fields is None or 'username' in update_fields) and \
+            User.objects.filter(pk=self.pk).exclude(username=self.username).exists()
+        super(User, self).save(*args, **kwargs)
+        if renamed:
+            # 記事のページ・一覧に表示するユーザー名が変わるので, キャッシュと ETag を古くする
+            pagecache.invalidate_articles(list(self.author_articles().values_list('pk', flat=True)))
+            ContentVersion.bump()
+
     # お気に入りに登録した記事
     def favorite_articles(self):
         return Article.objects.filter(favorite__user=self)